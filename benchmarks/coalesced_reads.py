@@ -0,0 +1,81 @@
+"""
+    Benchmark of coalesced super-reads (ops/region_planner.py) against one read_region() per patch, on a synthetic
+    pyramidal TIFF.
+
+    python -m benchmarks.coalesced_reads [--size 16384] [--patch-size 256] [--max-mb 64]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from openslide import OpenSlide
+
+from camelyon16.ops.region_planner import iter_coalesced_patches
+from camelyon16.ops.synthetic_wsi import generate_synthetic_slide
+
+
+def run_per_patch(wsi_path, xs, ys, level, patch_size):
+    slide = OpenSlide(wsi_path)
+    start_time = time.time()
+    checksum = 0
+    for x, y in zip(xs, ys):
+        patch = np.array(slide.read_region((int(x), int(y)), level, patch_size))
+        checksum += int(patch[0, 0, 0])
+    elapsed = time.time() - start_time
+    slide.close()
+    return elapsed, checksum
+
+
+def run_coalesced(wsi_path, xs, ys, level, patch_size, max_bytes):
+    slide = OpenSlide(wsi_path)
+    start_time = time.time()
+    checksum = 0
+    for _, patch in iter_coalesced_patches(slide, xs, ys, level, patch_size, max_bytes=max_bytes):
+        checksum += int(patch[0, 0, 0])
+    elapsed = time.time() - start_time
+    slide.close()
+    return elapsed, checksum
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=16384, help='level 0 width and height of the synthetic slide')
+    parser.add_argument('--patch-size', type=int, default=256)
+    parser.add_argument('--max-mb', type=int, default=64, help='memory budget of a super-read')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        wsi_path = generate_synthetic_slide(tmp_dir, 'Normal_001', args.size, args.size, levels=5,
+                                            num_lesions=0).wsi_path
+        patch_size = (args.patch_size, args.patch_size)
+
+        # contiguous grid aligned with the TIFF tiles, the same grid shifted by half a tile, a half overlapping
+        # grid (PATCH_OVERLAP = 0.5, or heatmaps at a level whose downsample is smaller than the patch size) and a
+        # sparser grid at level 1
+        cases = []
+        step = args.patch_size
+        for name, offset, stride, level, spacing in [('level 0 aligned grid', 0, step, 0, 1),
+                                                     ('level 0 unaligned grid', step // 2, step, 0, 1),
+                                                     ('level 0 half overlap grid', 0, step // 2, 0, 1),
+                                                     ('level 1 every other patch', 0, 2 * step, 1, 2)]:
+            grid = np.arange(offset, args.size - 2 * step * spacing, stride * spacing)
+            grid_x, grid_y = np.meshgrid(grid, grid)
+            cases.append((name, grid_x.ravel(), grid_y.ravel(), level))
+
+        print('%-28s %8s %14s %14s %8s' % ('case', 'patches', 'per-patch/s', 'coalesced/s', 'speedup'))
+        for name, xs, ys, level in cases:
+            per_patch_time, per_patch_checksum = run_per_patch(wsi_path, xs, ys, level, patch_size)
+            coalesced_time, coalesced_checksum = run_coalesced(wsi_path, xs, ys, level, patch_size,
+                                                               args.max_mb * 1024 * 1024)
+            assert per_patch_checksum == coalesced_checksum, 'Coalesced patches differ from per-patch reads'
+            print('%-28s %8d %14.1f %14.1f %7.2fx' % (name, len(xs), len(xs) / per_patch_time,
+                                                      len(xs) / coalesced_time, per_patch_time / coalesced_time))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+    Throughput of the slide level pipeline (WSIOps, PatchExtractor, the heatmap patch tiler and the streaming
+    heatmap reader) on synthetic Tumor / Normal slides written by ops/synthetic_wsi.py, so that it runs on any
+    machine without the CAMELYON16 data. Slides are generated from a seed, two runs with the same arguments process
+    the same pixels.
+
+    python -m benchmarks.wsi_throughput [--size 16384] [--patch-size 256] [--seed 0] [--formats directory,shards]
+        [--false-patches 250]
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import cv2
+
+import camelyon16.utils as utils
+from camelyon16.ops.heatmap_stream import HeatmapStream, get_tissue_pixels
+from camelyon16.ops.patch_writer import get_patch_writer
+from camelyon16.ops.synthetic_wsi import generate_synthetic_slide
+from camelyon16.ops.tissue_cache import load_tissue_mask
+from camelyon16.ops.wsi_ops import PatchExtractor, WSIOps
+
+
+def timed(fn):
+    """
+        :return: elapsed seconds, result of fn(), the chatter printed by the pipeline is swallowed
+    """
+    start_time = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = fn()
+    return time.time() - start_time, result
+
+
+def report(name, elapsed, count, unit):
+    print('%-48s %8d %-8s %8.2fs %10.1f %s/s' % (name, count, unit, elapsed, count / max(elapsed, 1e-9), unit))
+
+
+def count_files(directory):
+    return sum(len(files) for _, _, files in os.walk(directory))
+
+
+def synthetic_heatmap(tumor_gt_mask, seed):
+    """
+        Tumor probabilities at the resolution of tumor_gt_mask: the blurred ground truth plus noise, so that the
+        heatmap has both false positive and false negative regions to mine.
+    """
+    rng = np.random.RandomState(seed)
+    truth = (cv2.cvtColor(tumor_gt_mask, cv2.COLOR_BGR2GRAY) > 0).astype(np.float32)
+    heatmap = cv2.GaussianBlur(truth, (0, 0), 3) + rng.normal(0, 0.35, size=truth.shape).astype(np.float32)
+    return np.clip(heatmap, 0, 1)
+
+
+def run_wsi_ops(tumor, normal, cache_dir):
+    wsi_ops = WSIOps()
+    elapsed, (wsi_image, rgb_image, wsi_mask, tumor_gt_mask, level_used) = timed(
+        lambda: WSIOps.read_wsi_tumor(tumor.wsi_path, tumor.mask_path))
+    report('WSIOps.read_wsi_tumor', elapsed, 1, 'slides')
+    elapsed, _ = timed(lambda: WSIOps.read_wsi_normal(normal.wsi_path))
+    report('WSIOps.read_wsi_normal', elapsed, 1, 'slides')
+    elapsed, (bounding_boxes, _, image_open) = timed(lambda: wsi_ops.find_roi_bbox(rgb_image))
+    report('WSIOps.find_roi_bbox (%d ROIs)' % len(bounding_boxes), elapsed, 1, 'slides')
+
+    for state in ('cold', 'warm'):
+        elapsed, _ = timed(lambda: load_tissue_mask(tumor.wsi_path, level=level_used, lower_hsv=(40, 40, 40),
+                                                    upper_hsv=(200, 200, 200), cache_dir=cache_dir))
+        report('tissue mask cache (%s)' % state, elapsed, 1, 'slides')
+    return wsi_image, rgb_image, wsi_mask, tumor_gt_mask, level_used, bounding_boxes, image_open
+
+
+def run_patch_extractor(tumor, normal, output_formats, work_dir):
+    wsi_ops = WSIOps()
+    for output_format in output_formats:
+        # the directory writer appends the patch names to the directory as is
+        save_dir = os.path.join(work_dir, 'patches-' + output_format) + os.sep
+        os.makedirs(save_dir)
+
+        def extract_tumor():
+            wsi_image, rgb_image, wsi_mask, tumor_gt_mask, level_used = WSIOps.read_wsi_tumor(tumor.wsi_path,
+                                                                                             tumor.mask_path)
+            bounding_boxes = wsi_ops.find_roi_bbox_tumor_gt_mask(np.array(tumor_gt_mask))
+            writer = get_patch_writer(save_dir, 'Tumor_001-positive', output_format=output_format)
+            count = PatchExtractor.extract_positive_patches_from_tumor_region(
+                wsi_image, tumor_gt_mask, level_used, bounding_boxes, save_dir, None, 0, wsi_mask, writer=writer)
+            writer.close()
+
+            bounding_boxes, _, image_open = wsi_ops.find_roi_bbox(rgb_image)
+            writer = get_patch_writer(save_dir, 'Tumor_001-negative', output_format=output_format)
+            count = PatchExtractor.extract_negative_patches_from_tumor_wsi(
+                wsi_image, tumor_gt_mask, image_open, level_used, bounding_boxes, save_dir, None, count,
+                writer=writer)
+            writer.close()
+            return count
+
+        def extract_normal():
+            wsi_image, rgb_image, level_used = WSIOps.read_wsi_normal(normal.wsi_path)
+            bounding_boxes, _, image_open = wsi_ops.find_roi_bbox(rgb_image)
+            writer = get_patch_writer(save_dir, 'Normal_001-negative', output_format=output_format)
+            count = PatchExtractor.extract_negative_patches_from_normal_wsi(
+                wsi_image, image_open, level_used, bounding_boxes, save_dir, None, 0, writer=writer)
+            writer.close()
+            return count
+
+        elapsed, count = timed(extract_tumor)
+        report('PatchExtractor tumor slide (%s)' % output_format, elapsed, count, 'patches')
+        elapsed, count = timed(extract_normal)
+        report('PatchExtractor normal slide (%s)' % output_format, elapsed, count, 'patches')
+
+
+def run_heatmap(wsi_image, wsi_mask, tumor_gt_mask, level_used, bounding_boxes, image_open, seed, work_dir,
+                max_false_patches, tile_window):
+    heatmap_prob = synthetic_heatmap(tumor_gt_mask, seed)
+    pos_dir, neg_dir = os.path.join(work_dir, 'false-pos') + os.sep, os.path.join(work_dir, 'false-neg') + os.sep
+    os.makedirs(pos_dir)
+    os.makedirs(neg_dir)
+    elapsed, _ = timed(lambda: PatchExtractor.extract_patches_from_heatmap_false_region_tumor(
+        wsi_image, wsi_mask, tumor_gt_mask, image_open, heatmap_prob, level_used, bounding_boxes, pos_dir, neg_dir,
+        'pos_', 'neg_', 0, max_patches=max_false_patches))
+    report('heatmap false region mining (tumor)', elapsed, count_files(pos_dir) + count_files(neg_dir), 'patches')
+
+    # a tile_window x tile_window window in the middle of the first ROI, the full slide is one patch per tissue
+    # pixel
+    x, y, width, height = bounding_boxes[0]
+    bounding_box = (x + max(0, (width - tile_window) // 2), y + max(0, (height - tile_window) // 2),
+                    min(width, tile_window), min(height, tile_window))
+    # stand-in model: fraction of the patch painted in synthetic_wsi.TUMOR_COLOR (green channel well below the
+    # tissue color's)
+    stream = HeatmapStream(lambda images: (images[:, :, :, 1] < 95).mean(axis=(1, 2)))
+    elapsed, heatmap = timed(lambda: stream.run(wsi_image, image_open, [bounding_box],
+                                                WSIOps.get_mag_factor(wsi_image, level_used)))
+    report('streaming heatmap (HeatmapStream, no model)', elapsed,
+           len(get_tissue_pixels(image_open, [bounding_box])[0]), 'patches')
+    elapsed, (adaptive, counts) = timed(lambda: stream.run_adaptive(wsi_image, image_open, [bounding_box],
+                                                                    WSIOps.get_mag_factor(wsi_image, level_used)))
+    report('adaptive heatmap (max abs diff %.3f)' % np.abs(adaptive - heatmap).max(), elapsed,
+           counts.lattice + counts.refined, 'patches')
+
+    try:
+        from camelyon16.postprocess.extract_patches_heatmap import extract_patch_from_bb
+    except ImportError as e:
+        print('%-48s skipped (%s)' % ('heatmap patch tiler', e))
+        return
+
+    heat_map_dir = os.path.join(work_dir, 'heatmap-patches') + os.sep
+    os.makedirs(heat_map_dir)
+    elapsed, _ = timed(lambda: extract_patch_from_bb(0, bounding_box, wsi_image, image_open, level_used,
+                                                     heat_map_dir))
+    report('heatmap patch tiler (extract_patch_from_bb)', elapsed, count_files(heat_map_dir), 'patches')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=16384, help='level 0 width and height of the synthetic slides')
+    parser.add_argument('--tile-size', type=int, default=256, help='TIFF tile size of the synthetic slides')
+    parser.add_argument('--patch-size', type=int, default=256,
+                        help='overrides utils.PATCH_SIZE_W / PATCH_SIZE_H for the PatchExtractor cases')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--formats', default='directory,shards,manifest', help='patch output formats to compare')
+    parser.add_argument('--false-patches', type=int, default=250,
+                        help='false positive / false negative budget of the heatmap mining case')
+    parser.add_argument('--tile-window', type=int, default=16,
+                        help='ROI window (low resolution pixels) handed to the heatmap patch tiler')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic slides and the outputs')
+    args = parser.parse_args()
+
+    utils.PATCH_SIZE_W = utils.PATCH_SIZE_H = args.patch_size
+    work_dir = tempfile.mkdtemp()
+    try:
+        start_time = time.time()
+        slide_dir = os.path.join(work_dir, 'slides')
+        tumor = generate_synthetic_slide(slide_dir, 'Tumor_001', args.size, args.size, args.tile_size,
+                                         seed=args.seed)
+        normal = generate_synthetic_slide(slide_dir, 'Normal_001', args.size, args.size, args.tile_size,
+                                          num_lesions=0, seed=args.seed + 1)
+        print('Synthetic slides (%d x %d) written in %.1fs to %s' % (args.size, args.size, time.time() - start_time,
+                                                                     slide_dir))
+
+        cache_dir = os.path.join(work_dir, 'tissue-cache')
+        utils.TISSUE_MASK_CACHE_DIR = None
+        wsi_image, _, wsi_mask, tumor_gt_mask, level_used, bounding_boxes, image_open = run_wsi_ops(tumor, normal,
+                                                                                                    cache_dir)
+        run_patch_extractor(tumor, normal, args.formats.split(','), work_dir)
+        run_heatmap(wsi_image, wsi_mask, tumor_gt_mask, level_used, bounding_boxes, image_open, args.seed, work_dir,
+                    args.false_patches, args.tile_window)
+    finally:
+        if args.keep:
+            print('Outputs kept in %s' % work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -307,21 +307,27 @@ def image_preprocessing(image_buffer, train, thread_id):
 
 def parse_example_proto_heatmap(example_serialized):
     """
-        Parses an Example proto containing a training example of an image.
+        Parses an Example proto containing a heatmap patch.
 
+        Returns:
+          image_buffer: Tensor tf.string containing the contents of a PNG file.
+          coordinates: Tensor tf.int64 [3], (row, col, level) of the patch in the
+            heatmap.
     """
     # Dense features in Example proto.
     # Arjun - updated
     feature_map = {
         'image/encoded': tf.FixedLenFeature([], dtype=tf.string,
                                             default_value=''),
-        'image/patch_name': tf.FixedLenFeature([], dtype=tf.string,
-                                               default_value='')
+        'image/row': tf.FixedLenFeature([], dtype=tf.int64, default_value=-1),
+        'image/col': tf.FixedLenFeature([], dtype=tf.int64, default_value=-1),
+        'image/level': tf.FixedLenFeature([], dtype=tf.int64, default_value=-1)
     }
 
     features = tf.parse_single_example(example_serialized, feature_map)
+    coordinates = tf.stack([features['image/row'], features['image/col'], features['image/level']])
 
-    return features['image/encoded'], features['image/patch_name']
+    return features['image/encoded'], coordinates
 
 
 def parse_example_proto(example_serialized):
@@ -489,4 +495,7 @@ def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
         tf.summary.image('images', images)
         # tf.summary.image('images', images)
 
+        if dataset.is_heatmap_data():
+            # (row, col, level) of every patch
+            return images, tf.reshape(label_index_batch, [batch_size, 3])
         return images, tf.reshape(label_index_batch, [batch_size])
@@ -45,7 +45,7 @@ MOVING_AVERAGE_DECAY = 0.9999
 
 
 def inference(images, num_classes, for_training=False, restore_logits=True,
-              scope=None):
+              scope=None, dense_image_size=None):
     """Build Inception v3 model architecture.
 
     See here for reference: http://arxiv.org/abs/1512.00567
@@ -60,10 +60,13 @@ def inference(images, num_classes, for_training=False, restore_logits=True,
         Useful for fine-tuning a model with different num_classes.
       scope: optional prefix string identifying the ImageNet tower.
       reuse: weather to reuse weights or not (used for evaluation)
+      dense_image_size: size of the training images when images are larger
+        tiles to evaluate densely, see slim.inception.inception_v3().
 
     Returns:
-      Logits. 2-D float Tensor.
-      Auxiliary Logits. 2-D float Tensor of side-head. Used for training only.
+      Logits. 2-D float Tensor, 4-D [batch, rows, cols, classes] when dense.
+      Auxiliary Logits. 2-D float Tensor of side-head. Used for training only,
+        None when dense.
     """
     # Arjun - check
     # Parameters for BatchNorm.
@@ -85,13 +88,14 @@ def inference(images, num_classes, for_training=False, restore_logits=True,
                 num_classes=num_classes,
                 is_training=for_training,
                 restore_logits=restore_logits,
-                scope=scope)
+                scope=scope,
+                dense_image_size=dense_image_size)
 
     # Add summaries for viewing model statistics on TensorBoard.
     _activation_summaries(end_points)
 
     # Grab the logits associated with the side head. Employed during training.
-    auxiliary_logits = end_points['aux_logits']
+    auxiliary_logits = end_points.get('aux_logits')
 
     return logits, auxiliary_logits, end_points['predictions']
 
@@ -32,6 +32,7 @@ import tensorflow as tf
 
 from camelyon16.inception import image_processing
 from camelyon16.inception import inception_model as inception
+from camelyon16.inception import manifest_inputs
 from camelyon16.inception.dataset import Dataset
 from camelyon16.inception.slim import slim
 import camelyon16.utils as utils
@@ -62,6 +63,9 @@ tf.app.flags.DEFINE_boolean('fine_tune', False,
 tf.app.flags.DEFINE_string('pretrained_model_checkpoint_path', utils.FINE_TUNE_MODEL_CKPT_PATH,
                            """If specified, restore this pretrained model """
                            """before beginning any training.""")
+tf.app.flags.DEFINE_string('manifest_path', '',
+                           """If specified, train on the patches of this coordinate """
+                           """manifest (file or directory), read from the WSIs on the fly.""")
 
 # **IMPORTANT**
 # Please note that this learning rate schedule is heavily dependent on the
@@ -224,9 +228,14 @@ def train(dataset):
         # Override the number of preprocessing threads to account for the increased
         # number of GPU towers.
         num_preprocess_threads = FLAGS.num_preprocess_threads * FLAGS.num_gpus
-        images, labels = image_processing.distorted_inputs(
-            dataset,
-            num_preprocess_threads=num_preprocess_threads)
+        feeder = None
+        if FLAGS.manifest_path:
+            # read the patches of a coordinate manifest straight from the WSIs
+            images, labels, feeder = manifest_inputs.manifest_inputs(FLAGS.manifest_path, train=True)
+        else:
+            images, labels = image_processing.distorted_inputs(
+                dataset,
+                num_preprocess_threads=num_preprocess_threads)
 
         input_summaries = copy.copy(tf.get_collection(tf.GraphKeys.SUMMARIES))
 
@@ -338,35 +347,42 @@ def train(dataset):
             print('%s: Pre-trained model restored from %s' %
                   (datetime.now(), FLAGS.pretrained_model_checkpoint_path))
 
-        # Start the queue runners.
-        tf.train.start_queue_runners(sess=sess)
-
-        summary_writer = tf.summary.FileWriter(
-            FLAGS.train_dir,
-            graph_def=sess.graph.as_graph_def(add_shapes=True))
-
-        for step in range(FLAGS.max_steps):
-            start_time = time.time()
-            _, loss_value = sess.run([train_op, loss])
-            duration = time.time() - start_time
-
-            assert not np.isnan(loss_value), 'Model diverged with loss = NaN'
-
-            if step % 10 == 0:
-                examples_per_sec = FLAGS.batch_size / float(duration)
-                format_str = ('%s: step %d, loss = %.2f (%.1f examples/sec; %.3f '
-                              'sec/batch)')
-                print(format_str % (datetime.now(), step, loss_value,
-                                    examples_per_sec, duration))
-
-            if step % 100 == 0:
-                summary_str = sess.run(summary_op)
-                summary_writer.add_summary(summary_str, step)
-
-            # Save the model checkpoint periodically.
-            if step % 5000 == 0 or (step + 1) == FLAGS.max_steps:
-                checkpoint_path = os.path.join(FLAGS.train_dir, 'model.ckpt')
-                saver.save(sess, checkpoint_path, global_step=step)
+        try:
+            # Start the queue runners.
+            tf.train.start_queue_runners(sess=sess)
+            if feeder is not None:
+                feeder.start(sess)
+
+            summary_writer = tf.summary.FileWriter(
+                FLAGS.train_dir,
+                graph_def=sess.graph.as_graph_def(add_shapes=True))
+
+            for step in range(FLAGS.max_steps):
+                start_time = time.time()
+                _, loss_value = sess.run([train_op, loss])
+                duration = time.time() - start_time
+
+                assert not np.isnan(loss_value), 'Model diverged with loss = NaN'
+
+                if step % 10 == 0:
+                    examples_per_sec = FLAGS.batch_size / float(duration)
+                    format_str = ('%s: step %d, loss = %.2f (%.1f examples/sec; %.3f '
+                                  'sec/batch)')
+                    print(format_str % (datetime.now(), step, loss_value,
+                                        examples_per_sec, duration))
+
+                if step % 100 == 0:
+                    summary_str = sess.run(summary_op)
+                    summary_writer.add_summary(summary_str, step)
+
+                # Save the model checkpoint periodically.
+                if step % 5000 == 0 or (step + 1) == FLAGS.max_steps:
+                    checkpoint_path = os.path.join(FLAGS.train_dir, 'model.ckpt')
+                    saver.save(sess, checkpoint_path, global_step=step)
+        finally:
+            if feeder is not None:
+                # shuts the feeding thread and the worker pool down
+                feeder.stop(sess)
 
 
 dataset = Dataset(DATA_SET_NAME, utils.data_subset[0])
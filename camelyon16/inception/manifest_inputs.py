@@ -0,0 +1,272 @@
+"""Read training patches lazily from the WSIs listed in a coordinate manifest.
+
+ Instead of decoding patches that were extracted and packed into TFRecords
+ up front, the regions listed in a manifest (see ops/patch_writer.py,
+ ManifestPatchWriter) are read straight from the slides by a pool of worker
+ processes. Every worker keeps its own OpenSlide handles, at most
+ utils.MANIFEST_OPEN_SLIDES of them, so handles are never shared across
+ processes.
+
+ -- Provide processed image data for a network:
+ manifest_inputs: Construct batches of examples from a manifest.
+
+ -- Python side:
+ ManifestPatchSource: Iterate over batches of decoded patches.
+ ManifestFeeder: Feed the batches of a ManifestPatchSource into a TF queue.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+from openslide import OpenSlide
+
+import camelyon16.utils as utils
+from camelyon16.inception import image_processing  # defines the batch_size and image_size flags
+from camelyon16.ops.patch_writer import read_manifests
+from camelyon16.ops.slide_reader import CachedSlide
+from camelyon16.ops.wsi_ops import WSIOps
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_integer('num_manifest_workers', 8,
+                            """Number of processes reading patches from the WSIs.""")
+
+# Seconds ManifestFeeder.stop() waits for the feeding thread.
+FEEDER_JOIN_SECS = 10
+
+# Per worker process state, set by _init_worker().
+_slide_paths = None
+_slides = None
+_cache_bytes = None
+_max_open_slides = None
+
+
+def find_slide_paths(slide_ids, slide_dirs):
+    """Map slide ids of a manifest to the WSI files.
+
+    Args:
+      slide_ids: iterable of strings, e.g. 'Tumor_001'.
+      slide_dirs: list of directories holding the '<slide id>.tif' files.
+    Returns:
+      dict mapping every slide id to the path of its WSI.
+    Raises:
+      ValueError: if a slide cannot be found.
+    """
+    slide_paths = {}
+    for slide_dir in slide_dirs:
+        for path in glob.glob(os.path.join(slide_dir, '*.tif')):
+            slide_paths.setdefault(utils.get_filename_from_path(path), path)
+
+    missing = [slide_id for slide_id in set(slide_ids) if slide_id not in slide_paths]
+    if missing:
+        raise ValueError('WSIs not found for %d slides: %s' % (len(missing), ', '.join(sorted(missing))))
+    return {slide_id: slide_paths[slide_id] for slide_id in set(slide_ids)}
+
+
+def _init_worker(slide_paths, cache_bytes, max_open_slides=None):
+    global _slide_paths, _slides, _cache_bytes, _max_open_slides
+    _slide_paths = slide_paths
+    _slides = OrderedDict()
+    _cache_bytes = cache_bytes
+    _max_open_slides = max_open_slides or utils.MANIFEST_OPEN_SLIDES
+
+
+def _get_slide(slide_id):
+    """Open slide of a worker process, the least recently used one is closed beyond _max_open_slides.
+
+    The tile cache budget of the worker is shared by its open slides, without
+    a budget the slides are read through plain OpenSlide handles.
+    """
+    slide = _slides.pop(slide_id, None)
+    if slide is None:
+        while len(_slides) >= _max_open_slides:
+            _slides.popitem(last=False)[1].close()
+        if _cache_bytes:
+            slide = CachedSlide(_slide_paths[slide_id], _cache_bytes // _max_open_slides)
+        else:
+            slide = OpenSlide(_slide_paths[slide_id])
+    _slides[slide_id] = slide
+    return slide
+
+
+def _read_patch(args):
+    """Read one manifest row in a worker process."""
+    slide_id, level, x, y, width, height, image_size = args
+    slide = _get_slide(slide_id)
+
+    # the level 0 footprint of the patch is read from the coarsest level that still covers image_size
+    downsample = WSIOps.get_mag_factor(slide, int(level))
+    region_size = (int(round(int(width) * downsample)), int(round(int(height) * downsample)))
+    patch = WSIOps.read_region_scaled(slide, (int(x), int(y)), region_size, (image_size, image_size))
+    return np.ascontiguousarray(patch[:, :, :3])
+
+
+class ManifestPatchSource(object):
+    """Batches of patches read on the fly from the slides of a manifest."""
+
+    def __init__(self, manifest, slide_paths, image_size=None, num_workers=None, shuffle=True, seed=12345,
+                 cache_bytes=None):
+        """Initializes the source and starts its worker pool.
+
+        Args:
+          manifest: MANIFEST_DTYPE structured array.
+          slide_paths: dict mapping slide ids to WSI paths, see find_slide_paths().
+          image_size: patches are resized to image_size x image_size,
+            defaults to FLAGS.image_size.
+          num_workers: size of the process pool, defaults to
+            FLAGS.num_manifest_workers.
+          shuffle: reshuffle the manifest at every epoch.
+          seed: seed of the shuffling, makes the order repeatable.
+          cache_bytes: tile cache of every worker, shared by its open slides.
+            Defaults to utils.TILE_CACHE_BYTES divided by the number of
+            workers, and to none when shuffling: random reads hardly ever
+            hit a cached tile.
+        """
+        self.manifest = manifest
+        self.image_size = image_size or FLAGS.image_size
+        self.shuffle = shuffle
+        self._rng = np.random.RandomState(seed)
+        num_workers = num_workers or FLAGS.num_manifest_workers
+        if cache_bytes is None:
+            cache_bytes = 0 if shuffle else utils.TILE_CACHE_BYTES // num_workers
+        self._pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                          initargs=(slide_paths, cache_bytes))
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def _epoch_order(self):
+        if not self.shuffle:
+            return np.arange(len(self.manifest))
+        return self._rng.permutation(len(self.manifest))
+
+    def iter_batches(self, batch_size, num_epochs=None):
+        """Yield batches of patches.
+
+        Args:
+          batch_size: integer, the last incomplete batch of an epoch is
+            carried over to the next one.
+          num_epochs: integer, None loops forever.
+        Yields:
+          images: uint8 array [batch_size, image_size, image_size, 3].
+          labels: int32 array [batch_size].
+        """
+        epoch = 0
+        images, labels = [], []
+        while num_epochs is None or epoch < num_epochs:
+            order = self._epoch_order()
+            rows = self.manifest[order]
+            args = ((row['slide'], row['level'], row['x'], row['y'], row['width'], row['height'], self.image_size)
+                    for row in rows)
+            for patch, label in zip(self._pool.imap(_read_patch, args, chunksize=4), rows['label']):
+                images.append(patch)
+                labels.append(label)
+                if len(images) == batch_size:
+                    yield np.stack(images), np.array(labels, dtype=np.int32)
+                    images, labels = [], []
+            epoch += 1
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+class ManifestFeeder(object):
+    """Feeds the batches of a ManifestPatchSource into a TF queue from a background thread."""
+
+    def __init__(self, source, batch_size, capacity):
+        self.source = source
+        self.batch_size = batch_size
+        image_size = source.image_size
+        self._images = tf.placeholder(tf.uint8, [None, image_size, image_size, 3])
+        self._labels = tf.placeholder(tf.int32, [None])
+        self.queue = tf.FIFOQueue(capacity=capacity, dtypes=[tf.uint8, tf.int32],
+                                  shapes=[[image_size, image_size, 3], []])
+        self._enqueue = self.queue.enqueue_many([self._images, self._labels])
+        self._close = self.queue.close(cancel_pending_enqueues=True)
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def _run(self, sess, coord):
+        try:
+            for images, labels in self.source.iter_batches(self.batch_size):
+                if self._stop_event.is_set() or (coord is not None and coord.should_stop()):
+                    break
+                sess.run(self._enqueue, feed_dict={self._images: images, self._labels: labels})
+        except tf.errors.CancelledError:
+            pass
+        except Exception as e:
+            if coord is None:
+                raise
+            coord.request_stop(e)
+
+    def start(self, sess, coord=None):
+        """Start the feeding thread, call it next to tf.train.start_queue_runners()."""
+        self._thread = threading.Thread(target=self._run, args=(sess, coord))
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def stop(self, sess):
+        """Stop the feeding thread and the worker pool of the source, call it in a finally block."""
+        self._stop_event.set()
+        # cancels a pending enqueue of the thread
+        sess.run(self._close)
+        if self._thread is not None:
+            self._thread.join(FEEDER_JOIN_SECS)
+        self.source.close()
+
+
+def manifest_inputs(manifest_paths, batch_size=None, train=True, num_workers=None, slide_dirs=None):
+    """Construct batches of examples read lazily from the slides of manifests.
+
+    The returned tensors match the ones of image_processing.distorted_inputs():
+    float images with the channel wise mean of every image subtracted.
+
+    Args:
+      manifest_paths: path of a manifest, a directory of manifests or a list
+        of both.
+      batch_size: integer, number of examples in batch, defaults to
+        FLAGS.batch_size.
+      train: boolean, shuffle the examples at every epoch.
+      num_workers: integer, number of processes reading the slides.
+      slide_dirs: list of directories holding the WSIs, defaults to
+        utils.MANIFEST_SLIDE_DIRS.
+
+    Returns:
+      images: 4D float Tensor [batch_size, FLAGS.image_size, FLAGS.image_size, 3].
+      labels: 1-D integer Tensor of [batch_size].
+      feeder: ManifestFeeder, start it once the session exists.
+    """
+    if not batch_size:
+        batch_size = FLAGS.batch_size
+    if slide_dirs is None:
+        slide_dirs = utils.MANIFEST_SLIDE_DIRS
+
+    manifest = read_manifests(manifest_paths)
+    if not len(manifest):
+        raise ValueError('No patches found in %s' % (manifest_paths,))
+    slide_paths = find_slide_paths(manifest['slide'], slide_dirs)
+    print('Manifest: %d patches from %d slides.' % (len(manifest), len(slide_paths)))
+
+    with tf.name_scope('manifest_processing'), tf.device('/cpu:0'):
+        source = ManifestPatchSource(manifest, slide_paths, num_workers=num_workers, shuffle=train)
+        feeder = ManifestFeeder(source, batch_size, capacity=FLAGS.input_queue_memory_factor * batch_size)
+        images, labels = feeder.queue.dequeue_many(batch_size)
+
+        # same scaling and channel wise mean subtraction as image_processing.image_preprocessing()
+        images = tf.image.convert_image_dtype(images, dtype=tf.float32)
+        mean = tf.reduce_mean(images, axis=[1, 2], keep_dims=True)
+        images = tf.subtract(images, mean)
+
+        tf.summary.image('images', images)
+
+    return images, tf.reshape(labels, [batch_size]), feeder
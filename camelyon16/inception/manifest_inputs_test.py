@@ -0,0 +1,80 @@
+"""Tests for manifest_inputs."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+import camelyon16.utils as utils
+from camelyon16.inception import manifest_inputs
+from camelyon16.ops.array_slide import ArraySlide
+from camelyon16.ops.patch_writer import MANIFEST_DTYPE, ManifestPatchWriter, read_manifests
+from camelyon16.ops.synthetic_wsi import generate_synthetic_slide
+
+
+class ManifestRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        rng = np.random.RandomState(0)
+        self.slide = ArraySlide(rng.randint(0, 255, size=(128, 160, 4)).astype(np.uint8), level_downsamples=(1.0, 2.0))
+        manifest_inputs._init_worker({}, 0)
+        manifest_inputs._slides['Tumor_001'] = self.slide
+
+    def testWriterToWorkerRead(self):
+        manifest_path = os.path.join(self.work_dir, 'Tumor_001.manifest.npy')
+        writer = ManifestPatchWriter(manifest_path)
+        # a grid patch read at level 1 and a heatmap patch read at level 0, with their own sizes
+        writer.write('Tumor_001_8_4', None, slide='Tumor_001', x=8, y=4, level=1, label=1, tumor_fraction=0.5,
+                     width=16, height=12)
+        writer.write('Tumor_001_40_20', None, slide='Tumor_001', x=40, y=20, level=0, label=0, width=32, height=32)
+        writer.close()
+
+        manifest = read_manifests(self.work_dir)
+        self.assertEqual(manifest['width'].tolist(), [16, 32])
+        self.assertEqual(manifest['height'].tolist(), [12, 32])
+        self.assertEqual(manifest['level'].tolist(), [1, 0])
+
+        patches = [manifest_inputs._read_patch((row['slide'], row['level'], row['x'], row['y'], row['width'],
+                                                row['height'], 16)) for row in manifest]
+        # 16 x 12 level 1 pixels are 32 x 24 level 0 pixels, read from level 0 and reduced to 16 x 16
+        expected = cv2.resize(self.slide.levels[0][4:28, 8:40], (16, 16), interpolation=cv2.INTER_AREA)
+        np.testing.assert_array_equal(patches[0], expected[:, :, :3])
+        # 32 x 32 level 0 pixels at 16 x 16 are level 1 as is
+        np.testing.assert_array_equal(patches[1], self.slide.levels[1][10:26, 20:36, :3])
+
+    def testLeastRecentlyUsedSlideIsClosed(self):
+        synthetic = generate_synthetic_slide(self.work_dir, name='Normal_001', width=256, height=256, tile_size=128,
+                                             levels=2, num_lesions=0)
+        manifest_inputs._init_worker({'Normal_001': synthetic.wsi_path}, 0, max_open_slides=2)
+        first, second = [ArraySlide(self.slide.levels[0], level_downsamples=(1.0, 2.0)) for _ in range(2)]
+        manifest_inputs._slides['Tumor_001'] = first
+        manifest_inputs._slides['Tumor_002'] = second
+
+        manifest_inputs._read_patch(('Tumor_001', 0, 0, 0, 16, 16, 16))
+        patch = manifest_inputs._read_patch(('Normal_001', 0, 32, 32, 64, 64, 32))
+        self.assertEqual(patch.shape, (32, 32, 3))
+        self.assertEqual(list(manifest_inputs._slides), ['Tumor_001', 'Normal_001'])
+        self.assertTrue(second.closed)
+        self.assertFalse(first.closed)
+        manifest_inputs._slides.popitem()[1].close()
+
+    def testManifestsWithoutPatchSize(self):
+        old_dtype = np.dtype([(name, MANIFEST_DTYPE[name]) for name in MANIFEST_DTYPE.names
+                              if name not in ('width', 'height')])
+        rows = np.array([('Tumor_001', 1, 8, 4, 1, 0.5)], dtype=old_dtype)
+        manifest_path = os.path.join(self.work_dir, 'Tumor_001.manifest.npy')
+        with open(manifest_path, 'wb') as f:
+            np.save(f, rows)
+
+        manifest = read_manifests(manifest_path)
+        self.assertEqual(manifest.dtype, MANIFEST_DTYPE)
+        self.assertEqual((manifest['width'][0], manifest['height'][0]), (utils.PATCH_SIZE_W, utils.PATCH_SIZE_H))
+        self.assertEqual((manifest['x'][0], manifest['tumor_fraction'][0]), (8, 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -48,6 +48,20 @@ import tensorflow as tf
 from camelyon16.inception.slim import ops
 from camelyon16.inception.slim import scopes
 
+# Input pixels between two neighbouring outputs of the dense logit map.
+OUTPUT_STRIDE = 32
+
+
+def feature_map_size(image_size):
+    """Side of the last feature map (mixed_8x8x2048b) of an image_size input."""
+    size = (image_size - 3) // 2 + 1  # conv0
+    size -= 2  # conv1
+    size = (size - 3) // 2 + 1  # pool1
+    size -= 2  # conv4
+    size = (size - 3) // 2 + 1  # pool2
+    size = (size - 3) // 2 + 1  # mixed_16x16x768a
+    return (size - 3) // 2 + 1  # mixed_16x16x1280a
+
 
 def inception_v3(inputs,
                  dropout_keep_prob=0.8,
@@ -55,7 +69,8 @@ def inception_v3(inputs,
                  is_training=True,
                  restore_logits=True,
                  scope='',
-                 reuse=None):
+                 reuse=None,
+                 dense_image_size=None):
     """Latest Inception from http://arxiv.org/abs/1512.00567.
 
       "Rethinking the Inception Architecture for Computer Vision"
@@ -72,9 +87,18 @@ def inception_v3(inputs,
         Useful for fine-tuning a model with different num_classes.
       scope: Optional scope for op_scope.
       reuse: weather to reuse weights or not (used for evaluation)
+      dense_image_size: if set, inputs are tiles of any size larger than the
+        image_size x image_size images the model was trained on. The final
+        pooling slides over the tile and the logits layer is applied at every
+        position, so the same variables give one prediction per
+        dense_image_size window, every OUTPUT_STRIDE pixels. The windows see
+        their neighbours through the SAME padded layers, so the predictions
+        differ slightly from the ones of cropped images. There is no
+        auxiliary head.
 
     Returns:
-      a list containing 'logits', 'aux_logits' Tensors.
+      a list containing 'logits', 'aux_logits' Tensors. With dense_image_size
+      the logits are [batch_size, rows, cols, num_classes].
     """
     # end_points will collect relevant activations for external use, for example
     # summaries or losses.
@@ -248,19 +272,20 @@ def inception_v3(inputs,
                     net = tf.concat_v2([branch1x1, branch7x7, branch7x7dbl, branch_pool], 3)
                     end_points['mixed_16x16x768e'] = net
                 # Auxiliary Head logits
-                aux_logits = tf.identity(end_points['mixed_16x16x768e'])
-                with tf.variable_scope('aux_logits'):
-                    aux_logits = ops.avg_pool(aux_logits, [5, 5], stride=3,
-                                              padding='VALID')
-                    aux_logits = ops.conv2d(aux_logits, 128, [1, 1], scope='proj')
-                    # Shape of feature map before the final layer.
-                    shape = aux_logits.get_shape()
-                    aux_logits = ops.conv2d(aux_logits, 768, shape[1:3], stddev=0.01,
-                                            padding='VALID')
-                    aux_logits = ops.flatten(aux_logits)
-                    aux_logits = ops.fc(aux_logits, num_classes, activation=None,
-                                        stddev=0.001, restore=restore_logits)
-                    end_points['aux_logits'] = aux_logits
+                if dense_image_size is None:
+                    aux_logits = tf.identity(end_points['mixed_16x16x768e'])
+                    with tf.variable_scope('aux_logits'):
+                        aux_logits = ops.avg_pool(aux_logits, [5, 5], stride=3,
+                                                  padding='VALID')
+                        aux_logits = ops.conv2d(aux_logits, 128, [1, 1], scope='proj')
+                        # Shape of feature map before the final layer.
+                        shape = aux_logits.get_shape()
+                        aux_logits = ops.conv2d(aux_logits, 768, shape[1:3], stddev=0.01,
+                                                padding='VALID')
+                        aux_logits = ops.flatten(aux_logits)
+                        aux_logits = ops.fc(aux_logits, num_classes, activation=None,
+                                            stddev=0.001, restore=restore_logits)
+                        end_points['aux_logits'] = aux_logits
                 # mixed_8: 8 x 8 x 1280.
                 # Note that the scope below is not changed to not void previous
                 # checkpoints.
@@ -317,6 +342,23 @@ def inception_v3(inputs,
                     net = tf.concat_v2([branch1x1, branch3x3, branch3x3dbl, branch_pool], 3)
                     end_points['mixed_8x8x2048b'] = net
                 # Final pooling and prediction
+                if dense_image_size is not None:
+                    with tf.variable_scope('logits'):
+                        pool_size = feature_map_size(dense_image_size)
+                        net = ops.avg_pool(net, [pool_size, pool_size], stride=1,
+                                           padding='VALID', scope='pool')
+                        # rows x cols x 2048, the logits layer is a 1 x 1 convolution
+                        dense_shape = tf.shape(net)
+                        net = tf.reshape(net, [-1, 2048])
+                        logits = ops.fc(net, num_classes, activation=None, scope='logits',
+                                        restore=restore_logits)
+                        predictions = tf.nn.softmax(logits)
+                        output_shape = tf.concat_v2([dense_shape[:3], [num_classes]], 0)
+                        logits = tf.reshape(logits, output_shape)
+                        end_points['logits'] = logits
+                        end_points['predictions'] = tf.reshape(predictions, output_shape,
+                                                               name='predictions')
+                    return logits, end_points
                 with tf.variable_scope('logits'):
                     shape = net.get_shape()
                     net = ops.avg_pool(net, shape[1:3], padding='VALID', scope='pool')
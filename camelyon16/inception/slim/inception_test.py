@@ -54,6 +54,19 @@ class InceptionTest(tf.test.TestCase):
       self.assertListEqual(pre_pool.get_shape().as_list(),
                            [batch_size, 8, 8, 2048])
 
+  def testBuildDenseLogits(self):
+    height, width = 256 + 2 * 32, 256 + 3 * 32
+    num_classes = 2
+    with self.test_session() as sess:
+      inputs = tf.random_uniform((1, height, width, 3))
+      logits, end_points = inception.inception_v3(inputs, num_classes,
+                                                  is_training=False,
+                                                  dense_image_size=256)
+      self.assertFalse('aux_logits' in end_points)
+      sess.run(tf.initialize_all_variables())
+      output = sess.run(end_points['predictions'])
+      self.assertEquals(output.shape, (1, 3, 4, num_classes))
+
   def testVariablesSetDevice(self):
     batch_size = 5
     height, width = 299, 299
@@ -0,0 +1,53 @@
+"""Array backed stand in for OpenSlide, shared by the tests of the slide readers."""
+import numpy as np
+from openslide import PROPERTY_NAME_MPP_X, PROPERTY_NAME_MPP_Y
+from PIL import Image
+
+
+class ArraySlide(object):
+    """
+        Slide with one (rows, cols, 4) uint8 array per level. Every read is recorded in reads as
+        (location, level, size), pixels outside of a level are 0.
+    """
+
+    def __init__(self, pixels, level_downsamples=(1.0,), levels=None, tile_size=None, mpp=None,
+                 filename='Tumor_001.tif'):
+        """
+            :param pixels: level 0
+            :param level_downsamples: one per level
+            :param levels: the arrays of the other levels, defaults to pixels subsampled by the downsamples
+            :param tile_size: adds the tile size properties of a tiled TIFF
+            :param mpp: adds the microns per pixel properties
+        """
+        self.level_downsamples = tuple(level_downsamples)
+        if levels is None:
+            levels = [pixels[::int(downsample), ::int(downsample)] for downsample in self.level_downsamples[1:]]
+        self.levels = [pixels] + list(levels)
+        self.level_count = len(self.levels)
+        self.level_dimensions = tuple((level.shape[1], level.shape[0]) for level in self.levels)
+        self.properties = {}
+        if tile_size:
+            for level in range(self.level_count):
+                self.properties['openslide.level[%d].tile-width' % level] = str(tile_size)
+                self.properties['openslide.level[%d].tile-height' % level] = str(tile_size)
+        if mpp:
+            self.properties[PROPERTY_NAME_MPP_X] = str(mpp)
+            self.properties[PROPERTY_NAME_MPP_Y] = str(mpp)
+        self._filename = filename
+        self.reads = []
+        self.closed = False
+
+    def read_region_array(self, location, level, size):
+        self.reads.append((tuple(location), level, tuple(size)))
+        downsample = self.level_downsamples[level]
+        x, y = int(location[0] / downsample), int(location[1] / downsample)
+        region = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+        window = self.levels[level][y: y + size[1], x: x + size[0]]
+        region[:window.shape[0], :window.shape[1]] = window
+        return region
+
+    def read_region(self, location, level, size):
+        return Image.fromarray(self.read_region_array(location, level, size))
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,94 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+
+import camelyon16.utils as utils
+
+AUCInterval = namedtuple('AUCInterval', ['auc', 'lower', 'upper', 'replicates'])
+
+
+def bootstrap_counts(labels, num_replicates, rng):
+    """
+        Stratified bootstrap: every replicate draws as many positives and negatives as labels has, with replacement.
+
+        :return: (num_replicates, n) int array, how many times every sample is drawn by every replicate
+    """
+    labels = np.asarray(labels)
+    counts = np.zeros((num_replicates, len(labels)), dtype=np.int64)
+    for positive in (True, False):
+        members = np.nonzero((labels == 1) == positive)[0]
+        draws = rng.randint(0, len(members), size=(num_replicates, len(members)))
+        # one bincount over all replicates, replicate b counts into [b * n, (b + 1) * n)
+        offsets = (np.arange(num_replicates) * len(members))[:, None]
+        counts[:, members] = np.bincount((draws + offsets).ravel(),
+                                         minlength=num_replicates * len(members)).reshape(num_replicates, -1)
+    return counts
+
+
+def weighted_auc(labels, scores, counts):
+    """
+        Mann-Whitney AUC of every row of counts, samples weighted by how many times they are drawn. The samples are
+        sorted once and grouped by tied scores, so all the replicates are ranked with a few array operations.
+
+        :param labels: 1 for positives
+        :param scores: higher for positives
+        :param counts: (num_replicates, n) weights, e.g. bootstrap_counts()
+        :return: (num_replicates,) AUCs, ties count one half
+    """
+    labels, scores = np.asarray(labels), np.asarray(scores, dtype=np.float64)
+    counts = np.atleast_2d(counts)
+    order = np.argsort(scores, kind='stable')
+    sorted_scores = scores[order]
+    group_starts = np.r_[0, np.nonzero(np.diff(sorted_scores))[0] + 1]
+    is_positive = (labels[order] == 1)
+    sorted_counts = counts[:, order]
+    positives = np.add.reduceat(sorted_counts * is_positive, group_starts, axis=1)
+    negatives = np.add.reduceat(sorted_counts * ~is_positive, group_starts, axis=1)
+    negatives_below = np.cumsum(negatives, axis=1) - negatives
+    u = np.sum(positives * (negatives_below + 0.5 * negatives), axis=1)
+    return u / (positives.sum(axis=1) * negatives.sum(axis=1)).astype(np.float64)
+
+
+def auc_confidence_interval(labels, scores, num_replicates=None, confidence=0.95, seed=0):
+    """
+        :param labels: 1 for positives
+        :param scores: higher for positives
+        :param num_replicates: defaults to utils.AUC_BOOTSTRAP_REPLICATES
+        :param confidence: coverage of the percentile interval
+        :param seed: of the resampling
+        :return: AUCInterval, replicates holds the bootstrap AUCs
+    """
+    num_replicates = num_replicates or utils.AUC_BOOTSTRAP_REPLICATES
+    auc = weighted_auc(labels, scores, np.ones(len(labels), dtype=np.int64))[0]
+    replicates = weighted_auc(labels, scores, bootstrap_counts(labels, num_replicates, np.random.RandomState(seed)))
+    alpha = (1 - confidence) / 2
+    lower, upper = np.percentile(replicates, [100 * alpha, 100 * (1 - alpha)])
+    return AUCInterval(auc, lower, upper, replicates)
+
+
+def paired_auc_test(labels, scores_a, scores_b, num_replicates=None, seed=0):
+    """
+        Two sided bootstrap test of AUC(a) == AUC(b) for two models scoring the same slides: both models are scored
+        on the same replicates and the observed difference is compared to the standard deviation of the replicated
+        differences, as pROC's roc.test(method='bootstrap').
+
+        :return: (auc_a, auc_b, p_value)
+    """
+    num_replicates = num_replicates or utils.AUC_BOOTSTRAP_REPLICATES
+    counts = bootstrap_counts(labels, num_replicates, np.random.RandomState(seed))
+    ones = np.ones(len(labels), dtype=np.int64)
+    auc_a, auc_b = weighted_auc(labels, scores_a, ones)[0], weighted_auc(labels, scores_b, ones)[0]
+    differences = weighted_auc(labels, scores_a, counts) - weighted_auc(labels, scores_b, counts)
+    deviation = np.std(differences, ddof=1)
+    if deviation == 0:
+        return auc_a, auc_b, 1.0 if auc_a == auc_b else 0.0
+    return auc_a, auc_b, math.erfc(abs(auc_a - auc_b) / deviation / math.sqrt(2))
+
+
+def reference_auc_test(interval, reference_auc):
+    """
+        One sided bootstrap p-value of AUC > reference_auc, for published results without per slide scores (e.g.
+        the curves of utils / plot_rocs.py): the fraction of replicates not above it.
+    """
+    return float(np.mean(interval.replicates <= reference_auc))
@@ -0,0 +1,45 @@
+"""Tests for auc_bootstrap."""
+import unittest
+
+import numpy as np
+from sklearn.metrics import roc_auc_score
+
+from camelyon16.ops.auc_bootstrap import auc_confidence_interval, bootstrap_counts, paired_auc_test, \
+    reference_auc_test, weighted_auc
+
+
+class AUCBootstrapTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.labels = (rng.uniform(size=130) < 0.4).astype(np.int64)
+        # rounded scores, ties between positives and negatives
+        self.scores = np.round(rng.normal(size=130) + 1.2 * self.labels, 1)
+        self.noisy_scores = self.scores + rng.normal(size=130) * 2
+
+    def testReplicatesMatchSklearn(self):
+        counts = bootstrap_counts(self.labels, 20, np.random.RandomState(1))
+        # stratified: every replicate keeps the class sizes
+        np.testing.assert_array_equal(counts[:, self.labels == 1].sum(axis=1), (self.labels == 1).sum())
+        aucs = weighted_auc(self.labels, self.scores, counts)
+        for row, replicate_auc in zip(counts, aucs):
+            indices = np.repeat(np.arange(len(row)), row)
+            self.assertAlmostEqual(replicate_auc, roc_auc_score(self.labels[indices], self.scores[indices]))
+
+    def testConfidenceIntervalAndTests(self):
+        interval = auc_confidence_interval(self.labels, self.scores, num_replicates=2000)
+        self.assertAlmostEqual(interval.auc, roc_auc_score(self.labels, self.scores))
+        self.assertTrue(interval.lower < interval.auc < interval.upper)
+        self.assertEqual(len(interval.replicates), 2000)
+        self.assertLess(reference_auc_test(interval, interval.lower - 0.05), 0.01)
+        self.assertGreater(reference_auc_test(interval, interval.upper + 0.05), 0.99)
+
+        _, _, p_value = paired_auc_test(self.labels, self.scores, self.scores, num_replicates=500)
+        self.assertEqual(p_value, 1.0)
+        auc_a, auc_b, p_value = paired_auc_test(self.labels, self.scores, self.noisy_scores, num_replicates=2000)
+        self.assertGreater(auc_a, auc_b)
+        self.assertLess(p_value, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+from collections import namedtuple
+
+import numpy as np
+
+import camelyon16.utils as utils
+from camelyon16.ops.heatmap_stream import HeatmapStream
+from camelyon16.ops.region_planner import read_region
+
+# location: level 0 origin of the tile, size: (width, height) at level 0, rows / cols: heatmap pixels scored by the
+# tile, out_rows / out_cols: their positions in the dense output map of the tile
+DenseTile = namedtuple('DenseTile', ['location', 'size', 'rows', 'cols', 'out_rows', 'out_cols'])
+
+# HeatmapBatch of a single tile, image: (h, w, 3) uint8 RGB
+DenseBatch = namedtuple('DenseBatch', ['rows', 'cols', 'image', 'out_rows', 'out_cols'])
+
+
+def plan_dense_tiles(rows, cols, mag_factor, tile_size=None, patch_size=None, output_stride=None):
+    """
+        Groups the heatmap pixels (rows, cols) into tiles of about tile_size x tile_size level 0 pixels. A fully
+        convolutional model evaluates a tile in one pass into a dense map holding the prediction of the patch_size
+        window at (out_col, out_row) * output_stride of the tile, the patch of heatmap pixel (row, col) is the window
+        nearest to its origin (col, row) * mag_factor.
+
+        :param tile_size: defaults to utils.DENSE_TILE_SIZE
+        :param patch_size: defaults to utils.PATCH_SIZE
+        :param output_stride: defaults to utils.DENSE_OUTPUT_STRIDE
+        :return: list of DenseTile, in row major order of the tiles
+    """
+    tile_size = tile_size or utils.DENSE_TILE_SIZE
+    patch_size = patch_size or utils.PATCH_SIZE
+    output_stride = output_stride or utils.DENSE_OUTPUT_STRIDE
+    assert tile_size >= patch_size, 'Tiles (%d) smaller than the patches (%d)' % (tile_size, patch_size)
+    if len(rows) == 0:
+        return []
+
+    # heatmap pixels per tile side
+    cells = max(1, int((tile_size - patch_size) // mag_factor) + 1)
+    tile_rows, tile_cols = rows // cells, cols // cells
+    keys = tile_rows * (tile_cols.max() + 1) + tile_cols
+    order = np.argsort(keys, kind='mergesort')
+    starts = np.flatnonzero(np.diff(keys[order])) + 1
+
+    tiles = []
+    for indices in np.split(order, starts):
+        tile_row, tile_col = tile_rows[indices[0]], tile_cols[indices[0]]
+        x, y = int(round(tile_col * cells * mag_factor)), int(round(tile_row * cells * mag_factor))
+        out_rows = np.maximum(np.round((rows[indices] * mag_factor - y) / output_stride), 0).astype(np.int64)
+        out_cols = np.maximum(np.round((cols[indices] * mag_factor - x) / output_stride), 0).astype(np.int64)
+        size = (int(out_cols.max()) * output_stride + patch_size, int(out_rows.max()) * output_stride + patch_size)
+        tiles.append(DenseTile((x, y), size, rows[indices], cols[indices], out_rows, out_cols))
+    return tiles
+
+
+class DenseHeatmapStream(HeatmapStream):
+    """
+        HeatmapStream evaluating whole tiles with a fully convolutional model instead of one patch per heatmap pixel,
+        the overlapping receptive fields of neighbouring patches are computed once. run() and run_adaptive() work
+        unchanged, the reader threads read tiles and every tile is a batch.
+    """
+
+    def __init__(self, predict_fn, tile_size=None, queue_batches=None, num_readers=None, patch_size=None,
+                 output_stride=None):
+        """
+
+        :param predict_fn: predict_fn(tiles) -> tumor probabilities, tiles is a (1, h, w, 3) uint8 array, the
+                           probabilities a (1, rows, cols) array, see plan_dense_tiles()
+        :param tile_size: defaults to utils.DENSE_TILE_SIZE
+        :param output_stride: defaults to utils.DENSE_OUTPUT_STRIDE
+        """
+        super(DenseHeatmapStream, self).__init__(predict_fn, batch_size=1, queue_batches=queue_batches,
+                                                 num_readers=num_readers, patch_size=patch_size)
+        self.tile_size = tile_size or utils.DENSE_TILE_SIZE
+        self.output_stride = output_stride or utils.DENSE_OUTPUT_STRIDE
+
+    def iter_batches(self, wsi_image, rows, cols, mag_factor):
+        for tile in plan_dense_tiles(rows, cols, mag_factor, self.tile_size, self.patch_size, self.output_stride):
+            image = read_region(wsi_image, tile.location, 0, tile.size)[:, :, :3]
+            yield DenseBatch(tile.rows, tile.cols, image, tile.out_rows, tile.out_cols)
+
+    def predict(self, batch):
+        probabilities = np.asarray(self.predict_fn(batch.image[None]))
+        probabilities = probabilities.reshape(probabilities.shape[-2:])
+        # a model resizing the tiles may round its last row / column away
+        out_rows = np.minimum(batch.out_rows, probabilities.shape[0] - 1)
+        out_cols = np.minimum(batch.out_cols, probabilities.shape[1] - 1)
+        return probabilities[out_rows, out_cols]
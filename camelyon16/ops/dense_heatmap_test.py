@@ -0,0 +1,55 @@
+"""Tests for dense_heatmap."""
+import unittest
+
+import numpy as np
+
+from camelyon16.ops.dense_heatmap import DenseHeatmapStream, plan_dense_tiles
+from camelyon16.ops.heatmap_stream import HeatmapStream, get_tissue_pixels
+from camelyon16.ops.heatmap_stream_test import mean_red
+from camelyon16.ops.array_slide import ArraySlide
+
+PATCH_SIZE = 16
+OUTPUT_STRIDE = 4
+
+
+def dense_mean_red(tiles):
+    """Fully convolutional mean_red: the mean of every PATCH_SIZE window, every OUTPUT_STRIDE pixels."""
+    red = np.pad(tiles[0, :, :, 0].astype(np.float64) / 255.0, ((1, 0), (1, 0)), mode='constant')
+    integral = red.cumsum(axis=0).cumsum(axis=1)
+    ys = np.arange(0, tiles.shape[1] - PATCH_SIZE + 1, OUTPUT_STRIDE)[:, None]
+    xs = np.arange(0, tiles.shape[2] - PATCH_SIZE + 1, OUTPUT_STRIDE)[None, :]
+    sums = (integral[ys + PATCH_SIZE, xs + PATCH_SIZE] - integral[ys, xs + PATCH_SIZE] -
+            integral[ys + PATCH_SIZE, xs] + integral[ys, xs])
+    return (sums / PATCH_SIZE ** 2)[None]
+
+
+class DenseHeatmapTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.slide = ArraySlide(rng.randint(0, 255, size=(160, 200, 4)).astype(np.uint8))
+        self.image_open = np.zeros((20, 25), dtype=np.uint8)
+        self.image_open[2:15, 3:20] = 255
+        self.bounding_boxes = [(3, 2, 10, 13), (15, 5, 5, 5)]
+
+    def testEveryPixelPlannedOnce(self):
+        rows, cols = get_tissue_pixels(self.image_open, self.bounding_boxes)
+        tiles = plan_dense_tiles(rows, cols, 8, tile_size=48, patch_size=PATCH_SIZE, output_stride=OUTPUT_STRIDE)
+        planned = np.concatenate([tile.rows * 100 + tile.cols for tile in tiles])
+        self.assertEqual(sorted(planned.tolist()), sorted((rows * 100 + cols).tolist()))
+        for tile in tiles:
+            self.assertLessEqual(max(tile.size), 48)
+            np.testing.assert_array_equal(tile.location[0] + tile.out_cols * OUTPUT_STRIDE, tile.cols * 8)
+            np.testing.assert_array_equal(tile.location[1] + tile.out_rows * OUTPUT_STRIDE, tile.rows * 8)
+
+    def testDenseHeatmapMatchesPatchHeatmap(self):
+        patches = HeatmapStream(mean_red, batch_size=7, num_readers=2, patch_size=PATCH_SIZE)
+        dense = DenseHeatmapStream(dense_mean_red, tile_size=48, num_readers=3, patch_size=PATCH_SIZE,
+                                   output_stride=OUTPUT_STRIDE)
+        expected = patches.run(self.slide, self.image_open, self.bounding_boxes, mag_factor=8)
+        heatmap = dense.run(self.slide, self.image_open, self.bounding_boxes, mag_factor=8)
+        np.testing.assert_allclose(heatmap, expected, rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
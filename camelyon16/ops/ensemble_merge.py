@@ -0,0 +1,144 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import camelyon16.utils as utils
+from camelyon16.ops.heatmap_store import HeatmapStore, read_heatmap_prob, write_heatmap_prob
+
+
+def merge_threshold(first, second, first_min=None, second_max=None):
+    """
+        Ensemble rule of the feature extraction: where the first model is confident (>= first_min) but the second
+        one is not (< second_max), the second model's probability wins, the first model's everywhere else.
+
+        :param first: probabilities of the first model, any shape
+        :param second: probabilities of the second model, same shape
+        :param first_min: defaults to utils.ENSEMBLE_FIRST_MIN
+        :param second_max: defaults to utils.ENSEMBLE_SECOND_MAX
+        :return: merged probabilities, a new array
+    """
+    first_min = utils.ENSEMBLE_FIRST_MIN if first_min is None else first_min
+    second_max = utils.ENSEMBLE_SECOND_MAX if second_max is None else second_max
+    return np.where((first >= first_min) & (second < second_max), second, first)
+
+
+def _like(merged, first):
+    # 8 bit heatmaps stay 8 bit, rounded rather than truncated
+    if np.issubdtype(first.dtype, np.integer):
+        merged = np.rint(merged)
+    return merged.astype(first.dtype)
+
+
+def merge_mean(first, second):
+    """
+        :return: pixel wise mean of the two models, in first's dtype
+    """
+    return _like((first.astype(np.float64) + second) / 2, first)
+
+
+def merge_max(first, second):
+    """
+        :return: pixel wise max of the two models
+    """
+    return np.maximum(first, second)
+
+
+def merge_geomean(first, second):
+    """
+        :return: pixel wise geometric mean of the two models, in first's dtype. Low whenever one of the models is
+                 low, a softer version of the threshold rule
+    """
+    return _like(np.sqrt(first.astype(np.float64) * second), first)
+
+
+MERGE_RULES = {
+    'threshold': merge_threshold,
+    'mean': merge_mean,
+    'max': merge_max,
+    'geomean': merge_geomean,
+}
+
+
+def merge_heatmaps(first, second, rule='threshold', **kwargs):
+    """
+        :param first: probabilities of the first model
+        :param second: probabilities of the second model, same shape
+        :param rule: key of MERGE_RULES
+        :param kwargs: thresholds of the 'threshold' rule, see merge_threshold()
+        :return: merged probabilities
+    """
+    assert rule in MERGE_RULES, 'Unknown merge rule %s, one of %s' % (rule, ', '.join(sorted(MERGE_RULES)))
+    assert first.shape == second.shape, 'Heatmaps of different shapes %s, %s' % (first.shape, second.shape)
+    return MERGE_RULES[rule](first, second, **kwargs)
+
+
+def merge_heatmap_files(first_path, second_path, merged_path, rule='threshold', **kwargs):
+    """
+        Merges the heatmaps of one slide and writes the result with write_heatmap_prob().
+
+        :return: merged_path
+    """
+    merged = merge_heatmaps(read_heatmap_prob(first_path), read_heatmap_prob(second_path), rule, **kwargs)
+    meta = {}
+    if os.path.isdir(first_path):
+        # the merged store describes the same grid as the first model's
+        first_meta = HeatmapStore(first_path).meta
+        meta = {key: first_meta[key] for key in ('slide_id', 'level', 'grid_stride', 'patch_size')}
+    write_heatmap_prob(merged_path, merged, model='%s(%s, %s)' % (rule, first_path, second_path), **meta)
+    return merged_path
+
+
+def get_heatmap_pairs(heatmap_dir, first_postfix, second_postfix):
+    """
+        :return: sorted list of (first_path, second_path) of the slides of heatmap_dir having both heatmaps
+    """
+    pairs = []
+    for first_path in sorted(glob.glob(os.path.join(heatmap_dir, '*%s' % first_postfix))):
+        second_path = first_path[:-len(first_postfix)] + second_postfix
+        if first_path != second_path and os.path.exists(second_path):
+            pairs.append((first_path, second_path))
+    return pairs
+
+
+def merge_heatmap_dir(heatmap_dir, first_postfix, second_postfix, merged_postfix, rule='threshold',
+                      num_workers=None, **kwargs):
+    """
+        Merges every heatmap pair of heatmap_dir in a process pool, one job per slide.
+
+        :param heatmap_dir: directory of the heatmaps, <wsi><first_postfix> and <wsi><second_postfix>
+        :param merged_postfix: the merged heatmaps are written to <wsi><merged_postfix>
+        :param rule: key of MERGE_RULES
+        :param num_workers: defaults to utils.EXTRACTION_NUM_WORKERS
+        :param kwargs: thresholds of the 'threshold' rule, see merge_threshold()
+        :return: list of the merged heatmap paths
+    """
+    if num_workers is None:
+        num_workers = utils.EXTRACTION_NUM_WORKERS
+    pairs = get_heatmap_pairs(heatmap_dir, first_postfix, second_postfix)
+    print('heatmap pairs: %d, rule: %s, workers: %d' % (len(pairs), rule, num_workers))
+
+    merged_paths = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(merge_heatmap_files, first_path, second_path,
+                                   first_path[:-len(first_postfix)] + merged_postfix, rule, **kwargs)
+                   for first_path, second_path in pairs]
+        for future in as_completed(futures):
+            merged_paths.append(future.result())
+            print('merged: %s (%d / %d)' % (merged_paths[-1], len(merged_paths), len(pairs)))
+    return sorted(merged_paths)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merges the heatmaps of two models, slide by slide.')
+    parser.add_argument('--heatmap-dir', default=utils.HEAT_MAP_DIR)
+    parser.add_argument('--first-postfix', default=utils.HEATMAP_PROB_POSTFIX)
+    parser.add_argument('--second-postfix', required=True, help='e.g. _prob_model8%s' % utils.HEATMAP_STORE_EXT)
+    parser.add_argument('--merged-postfix', default='_prob_ensemble%s' % utils.HEATMAP_STORE_EXT)
+    parser.add_argument('--rule', default='threshold', choices=sorted(MERGE_RULES))
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    merge_heatmap_dir(args.heatmap_dir, args.first_postfix, args.second_postfix, args.merged_postfix, args.rule,
+                      num_workers=args.workers)
@@ -0,0 +1,61 @@
+"""Tests for ensemble_merge."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from camelyon16.ops.ensemble_merge import merge_heatmap_dir, merge_heatmaps, merge_threshold
+from camelyon16.ops.heatmap_store import HeatmapStore, write_heatmap_store
+
+
+class EnsembleMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.first = rng.randint(0, 256, size=(40, 30, 1)).astype(np.uint8)
+        self.second = rng.randint(0, 256, size=(40, 30, 1)).astype(np.uint8)
+
+    def testThresholdMatchesPixelLoop(self):
+        expected = np.array(self.first)
+        for row in range(expected.shape[0]):
+            for col in range(expected.shape[1]):
+                if expected[row, col, 0] >= 0.90 * 255 and self.second[row, col, 0] < 0.50 * 255:
+                    expected[row, col, :] = self.second[row, col, :]
+        merged = merge_threshold(self.first, self.second, first_min=0.90 * 255, second_max=0.50 * 255)
+        np.testing.assert_array_equal(merged, expected)
+        self.assertEqual(merged.dtype, np.uint8)
+
+    def testRules(self):
+        first, second = self.first.astype(np.float64), self.second.astype(np.float64)
+        np.testing.assert_array_equal(merge_heatmaps(self.first, self.second, 'max'), np.maximum(first, second))
+        np.testing.assert_array_equal(merge_heatmaps(self.first, self.second, 'mean'),
+                                      np.rint((first + second) / 2))
+        np.testing.assert_array_equal(merge_heatmaps(self.first, self.second, 'geomean'),
+                                      np.rint(np.sqrt(first * second)))
+        with self.assertRaises(AssertionError):
+            merge_heatmaps(self.first, self.second, 'median')
+
+    def testMergeDirectory(self):
+        heatmap_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, heatmap_dir)
+        first, second = self.first[:, :, 0] / 255.0, self.second[:, :, 0] / 255.0
+        for slide_id in ('Tumor_001', 'Tumor_002'):
+            path = os.path.join(heatmap_dir, slide_id)
+            write_heatmap_store(path + '_prob.heatmap', first, slide_id=slide_id, level=6, grid_stride=64.0)
+            write_heatmap_store(path + '_prob_model8.heatmap', second, slide_id=slide_id)
+        write_heatmap_store(os.path.join(heatmap_dir, 'Tumor_003_prob.heatmap'), first)
+
+        merged_paths = merge_heatmap_dir(heatmap_dir, '_prob.heatmap', '_prob_model8.heatmap',
+                                         '_prob_mean.heatmap', rule='mean', num_workers=2)
+        self.assertEqual([os.path.basename(path) for path in merged_paths],
+                         ['Tumor_001_prob_mean.heatmap', 'Tumor_002_prob_mean.heatmap'])
+        store = HeatmapStore(merged_paths[1])
+        self.assertEqual(store.meta['slide_id'], 'Tumor_002')
+        self.assertEqual(store.meta['level'], 6)
+        np.testing.assert_allclose(store.read(), (first + second) / 2, atol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
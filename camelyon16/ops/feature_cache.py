@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+class FeatureCache(object):
+    """
+        # ==========================================================================================
+        # Content addressed on-disk cache of slide level feature vectors.
+        # ==========================================================================================
+
+        Entries are keyed by a hash of the heatmap and tissue mask the features are computed from
+        (plus the extraction parameters), not by the slide name, so regenerating or re-merging a
+        heatmap transparently produces a new entry while retraining a classifier or changing the
+        train / validation split reuses all of them. Bump CACHE_VERSION when the features change.
+        Each entry is a small <key>.json file.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def get_key(heatmap_prob, image_open, params=None):
+        sha1 = hashlib.sha1(json.dumps({'version': CACHE_VERSION,
+                                        'heatmap': [list(heatmap_prob.shape), heatmap_prob.dtype.str],
+                                        'image_open': list(image_open.shape),
+                                        'params': params}, sort_keys=True).encode('utf-8'))
+        sha1.update(np.ascontiguousarray(heatmap_prob).tobytes())
+        sha1.update(np.packbits(image_open > 0).tobytes())
+        return sha1.hexdigest()
+
+    def load(self, key):
+        try:
+            with open(os.path.join(self.cache_dir, key + '.json')) as f:
+                return json.load(f)['features']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def save(self, key, features, slide=None):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # write a private file first and rename it, so readers never see half written entries
+        entry_path = os.path.join(self.cache_dir, key + '.json')
+        tmp_path = '%s.tmp-%d' % (entry_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'slide': slide, 'features': [float(feature) for feature in features]}, f)
+        os.replace(tmp_path, entry_path)
+
+    def get(self, heatmap_prob, image_open, compute_fn, slide=None, params=None):
+        """
+            :param heatmap_prob: heatmap the features are computed from
+            :param image_open: tissue mask the features are computed from
+            :param compute_fn: compute_fn() -> list of features, called on a miss only
+            :param slide: name recorded in the entry, for humans
+            :param params: json serializable extraction parameters, part of the key
+            :return: list of features
+        """
+        key = self.get_key(heatmap_prob, image_open, params)
+        features = self.load(key)
+        if features is None:
+            features = compute_fn()
+            self.save(key, features, slide)
+        return features
@@ -0,0 +1,52 @@
+"""Tests for feature_cache."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from camelyon16.ops.feature_cache import FeatureCache
+
+
+class FeatureCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.heatmap_prob = rng.randint(0, 256, size=(40, 30, 1)).astype(np.uint8)
+        self.image_open = (rng.uniform(size=(40, 30)) > 0.5).astype(np.uint8) * 255
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def compute(self):
+        self.calls.append(1)
+        return [float(len(self.calls)), 0.25]
+
+    def testHitsUntilTheInputsChange(self):
+        cache = FeatureCache(self.cache_dir)
+        self.assertEqual(cache.get(self.heatmap_prob, self.image_open, self.compute, slide='Tumor_001'), [1.0, 0.25])
+        self.assertEqual(FeatureCache(self.cache_dir).get(self.heatmap_prob, self.image_open, self.compute),
+                         [1.0, 0.25])
+        self.assertEqual(len(self.calls), 1)
+
+        self.heatmap_prob[0, 0, 0] ^= 1
+        self.assertEqual(cache.get(self.heatmap_prob, self.image_open, self.compute), [2.0, 0.25])
+        self.assertEqual(cache.get(self.heatmap_prob, self.image_open, self.compute, params={'n_features': 2}),
+                         [3.0, 0.25])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def testCorruptEntryIsRecomputed(self):
+        cache = FeatureCache(self.cache_dir)
+        cache.get(self.heatmap_prob, self.image_open, self.compute)
+        key = FeatureCache.get_key(self.heatmap_prob, self.image_open)
+        with open(os.path.join(self.cache_dir, key + '.json'), 'w') as f:
+            f.write('{"features": [1.0')
+        self.assertEqual(cache.get(self.heatmap_prob, self.image_open, self.compute), [2.0, 0.25])
+        self.assertEqual(cache.load(key), [2.0, 0.25])
+
+
+if __name__ == '__main__':
+    unittest.main()
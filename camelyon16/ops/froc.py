@@ -0,0 +1,244 @@
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+from openslide import OpenSlide
+from scipy import ndimage
+
+import camelyon16.utils as utils
+from camelyon16.ops.region_features import get_inertia_eigvals
+
+CACHE_VERSION = 1
+
+FROCResult = namedtuple('FROCResult', ['fps', 'sensitivities', 'rate_sensitivities', 'average_sensitivity',
+                                       'num_slides', 'num_lesions'])
+
+
+def compute_evaluation_mask(mask, level=None, resolution=None, lesion_distance=None):
+    """
+        Lesion labels of a ground truth mask, as computeEvaluationMask() of the CAMELYON16 evaluation: tumor pixels
+        closer than lesion_distance / 2 microns are merged, holes are filled and the result is 8-connected labeled.
+
+        :param mask: tumor mask at level, non zero on tumor
+        :param level: pyramid level of mask, defaults to utils.FROC_MASK_LEVEL
+        :param resolution: microns per level 0 pixel, defaults to utils.FROC_PIXEL_RESOLUTION
+        :param lesion_distance: defaults to utils.FROC_LESION_DISTANCE
+        :return: (evaluation_mask, lesion_count), evaluation_mask is int32, 0 outside the lesions
+    """
+    level = utils.FROC_MASK_LEVEL if level is None else level
+    resolution = resolution or utils.FROC_PIXEL_RESOLUTION
+    lesion_distance = lesion_distance or utils.FROC_LESION_DISTANCE
+    distance = ndimage.distance_transform_edt(mask == 0)
+    lesions = ndimage.binary_fill_holes(distance < lesion_distance / (resolution * 2 ** level * 2))
+    evaluation_mask, lesion_count = ndimage.label(lesions, structure=np.ones((3, 3), dtype=bool))
+    return evaluation_mask.astype(np.int32), lesion_count
+
+
+def get_itc_labels(evaluation_mask, lesion_count, level=None, resolution=None, itc_max_length=None):
+    """
+        Labels of the isolated tumor cells: lesions whose major axis is shorter than itc_max_length microns.
+
+        :return: int32 array of labels
+    """
+    level = utils.FROC_MASK_LEVEL if level is None else level
+    resolution = resolution or utils.FROC_PIXEL_RESOLUTION
+    itc_max_length = itc_max_length or utils.FROC_ITC_MAX_LENGTH
+    if lesion_count == 0:
+        return np.zeros(0, dtype=np.int32)
+    l1, _ = get_inertia_eigvals(evaluation_mask, lesion_count)
+    major_axis_length = 4 * np.sqrt(l1)
+    return (np.nonzero(major_axis_length < itc_max_length / (resolution * 2 ** level))[0] + 1).astype(np.int32)
+
+
+def read_mask(mask_path, level):
+    mask_image = OpenSlide(mask_path)
+    assert level < mask_image.level_count, '%s has no level %d' % (mask_path, level)
+    mask = np.array(mask_image.read_region((0, 0), level, mask_image.level_dimensions[level]))[:, :, 0]
+    mask_image.close()
+    return mask
+
+
+class LesionLabelCache(object):
+    """
+        # ==========================================================================================
+        # On-disk cache of the evaluation masks (lesion label maps) and isolated tumor cell labels
+        # of the ground truth masks.
+        # ==========================================================================================
+
+        Entries are keyed by the mask path, its mtime and size and the evaluation parameters, like
+        the TissueMaskCache. Each entry is a compressed <key>.npz, written to a private file first
+        and renamed.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def get_key(mask_path, params):
+        stat = os.stat(mask_path)
+        key_source = json.dumps({'version': CACHE_VERSION,
+                                 'path': os.path.realpath(mask_path),
+                                 'mtime_ns': stat.st_mtime_ns,
+                                 'size': stat.st_size,
+                                 'params': params}, sort_keys=True)
+        return hashlib.sha1(key_source.encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        try:
+            with np.load(os.path.join(self.cache_dir, key + '.npz')) as entry:
+                return entry['evaluation_mask'], int(entry['lesion_count']), entry['itc_labels']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def save(self, key, evaluation_mask, lesion_count, itc_labels):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, evaluation_mask=evaluation_mask, lesion_count=lesion_count,
+                            itc_labels=itc_labels)
+        entry_path = os.path.join(self.cache_dir, key + '.npz')
+        tmp_path = '%s.tmp-%d' % (entry_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, entry_path)
+
+
+def load_evaluation_mask(mask_path, level=None, resolution=None, cache_dir=None):
+    """
+        :param mask_path: ground truth mask of a tumor slide
+        :param level: see compute_evaluation_mask()
+        :param resolution: see compute_evaluation_mask()
+        :param cache_dir: defaults to utils.FROC_LABEL_CACHE_DIR, caching is disabled if both are None
+        :return: (evaluation_mask, lesion_count, itc_labels)
+    """
+    level = utils.FROC_MASK_LEVEL if level is None else level
+    resolution = resolution or utils.FROC_PIXEL_RESOLUTION
+    params = {'level': level, 'resolution': resolution, 'lesion_distance': utils.FROC_LESION_DISTANCE,
+              'itc_max_length': utils.FROC_ITC_MAX_LENGTH}
+    cache_dir = utils.FROC_LABEL_CACHE_DIR if cache_dir is None else cache_dir
+    cache = None if cache_dir is None else LesionLabelCache(cache_dir)
+    key = None if cache is None else cache.get_key(mask_path, params)
+    entry = None if cache is None else cache.load(key)
+    if entry is None:
+        evaluation_mask, lesion_count = compute_evaluation_mask(read_mask(mask_path, level), level, resolution)
+        entry = evaluation_mask, lesion_count, get_itc_labels(evaluation_mask, lesion_count, level, resolution)
+        if cache is not None:
+            cache.save(key, *entry)
+    return entry
+
+
+def match_candidates(candidates, evaluation_masks, level=None):
+    """
+        Hits and false positives of the candidates of all the slides at once.
+
+        :param candidates: list with one (x, y, probability) tuple of arrays per slide, level 0 coordinates
+        :param evaluation_masks: list with one (evaluation_mask, lesion_count, itc_labels) per slide, None for
+                                 normal slides
+        :param level: level of the evaluation masks, defaults to utils.FROC_MASK_LEVEL
+        :return: (fp_probs, tp_probs, num_lesions): probabilities of the false positives, highest probability of
+                 every lesion (0 when missed and for the isolated tumor cells), lesions but the isolated tumor cells
+    """
+    level = utils.FROC_MASK_LEVEL if level is None else level
+    lesion_offsets = np.cumsum([0] + [0 if entry is None else entry[1] for entry in evaluation_masks])
+    itc = np.zeros(lesion_offsets[-1] + 1, dtype=bool)
+    hit_lesions, all_probs = [], []
+    for index, ((x, y, probs), entry) in enumerate(zip(candidates, evaluation_masks)):
+        probs = np.asarray(probs, dtype=np.float64)
+        lesion = np.zeros(len(probs), dtype=np.int64)
+        if entry is not None:
+            evaluation_mask, _, itc_labels = entry
+            itc[itc_labels + lesion_offsets[index]] = True
+            rows = np.clip(np.asarray(y, dtype=np.int64) >> level, 0, evaluation_mask.shape[0] - 1)
+            cols = np.clip(np.asarray(x, dtype=np.int64) >> level, 0, evaluation_mask.shape[1] - 1)
+            label = evaluation_mask[rows, cols].astype(np.int64)
+            lesion = np.where(label > 0, label + lesion_offsets[index], 0)
+        hit_lesions.append(lesion)
+        all_probs.append(probs)
+
+    hit_lesions = np.concatenate(hit_lesions) if hit_lesions else np.zeros(0, dtype=np.int64)
+    all_probs = np.concatenate(all_probs) if all_probs else np.zeros(0)
+    fp_probs = all_probs[hit_lesions == 0]
+    # highest probability of the candidates hitting every lesion, hits on isolated tumor cells are ignored and
+    # their entries stay 0 like the missed lesions', as in the reference implementation
+    hits = (hit_lesions > 0) & ~itc[hit_lesions]
+    lesion_probs = np.zeros(lesion_offsets[-1] + 1)
+    np.maximum.at(lesion_probs, hit_lesions[hits], all_probs[hits])
+    return fp_probs, lesion_probs[1:], int(lesion_offsets[-1] - itc.sum())
+
+
+def compute_froc(fp_probs, tp_probs, num_slides, num_lesions):
+    """
+        FROC curve, as computeFROC() of the CAMELYON16 evaluation: one point per distinct probability but the
+        lowest, plus (0, 0).
+
+        :return: (fps, sensitivities): false positives per slide and lesion sensitivity, decreasing thresholds
+    """
+    all_probs = np.unique(np.concatenate([fp_probs, tp_probs]))
+    thresholds = all_probs[1:]
+    sorted_fp, sorted_tp = np.sort(fp_probs), np.sort(tp_probs)
+    total_fps = len(sorted_fp) - np.searchsorted(sorted_fp, thresholds, side='left')
+    total_tps = len(sorted_tp) - np.searchsorted(sorted_tp, thresholds, side='left')
+    fps = np.append(total_fps, 0) / float(num_slides)
+    sensitivities = np.append(total_tps, 0) / float(num_lesions)
+    return fps, sensitivities
+
+
+def evaluate_froc(candidates, evaluation_masks, fp_rates=None, level=None):
+    """
+        :param candidates: see match_candidates()
+        :param evaluation_masks: see match_candidates()
+        :param fp_rates: false positives per slide of the average sensitivity, defaults to utils.FROC_FP_RATES
+        :return: FROCResult
+    """
+    fp_rates = fp_rates or utils.FROC_FP_RATES
+    fp_probs, tp_probs, num_lesions = match_candidates(candidates, evaluation_masks, level)
+    fps, sensitivities = compute_froc(fp_probs, tp_probs, len(candidates), num_lesions)
+    rate_sensitivities = np.interp(fp_rates, fps[::-1], sensitivities[::-1])
+    return FROCResult(fps, sensitivities, rate_sensitivities, float(np.mean(rate_sensitivities)), len(candidates),
+                      num_lesions)
+
+
+def read_candidates(csv_path):
+    """
+        Candidates of a slide in the CAMELYON16 submission format: one 'probability, x, y' line per lesion, level 0
+        coordinates.
+
+        :return: (x, y, probability) arrays
+    """
+    rows = np.loadtxt(csv_path, delimiter=',', ndmin=2)
+    if rows.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    return rows[:, 1].astype(np.int64), rows[:, 2].astype(np.int64), rows[:, 0]
+
+
+def evaluate_froc_dir(candidate_dir, mask_dir, level=None, cache_dir=None):
+    """
+        FROC of the <slide>.csv candidate files of candidate_dir, slides with a <slide>_Mask.tif in mask_dir are tumor
+        slides, the others normal ones.
+    """
+    candidate_paths = sorted(glob.glob(os.path.join(candidate_dir, '*.csv')))
+    candidates, evaluation_masks = [], []
+    for candidate_path in candidate_paths:
+        slide = utils.get_filename_from_path(candidate_path)
+        mask_path = os.path.join(mask_dir, slide + '_Mask.tif')
+        candidates.append(read_candidates(candidate_path))
+        evaluation_masks.append(load_evaluation_mask(mask_path, level, cache_dir=cache_dir)
+                                if os.path.exists(mask_path) else None)
+    return evaluate_froc(candidates, evaluation_masks, level=level)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lesion level FROC of CAMELYON16 candidate CSVs.')
+    parser.add_argument('candidate_dir', help='one <slide>.csv of probability, x, y lines per slide')
+    parser.add_argument('--mask-dir', default=utils.TUMOR_MASK_PATH, help='directory of the <slide>_Mask.tif files')
+    args = parser.parse_args()
+    result = evaluate_froc_dir(args.candidate_dir, args.mask_dir)
+    print('slides: %d, lesions: %d' % (result.num_slides, result.num_lesions))
+    for fp_rate, sensitivity in zip(utils.FROC_FP_RATES, result.rate_sensitivities):
+        print('sensitivity at %5.2f FP / slide: %.4f' % (fp_rate, sensitivity))
+    print('average sensitivity: %.4f' % result.average_sensitivity)
@@ -0,0 +1,104 @@
+"""Tests for froc."""
+import unittest
+
+import numpy as np
+from scipy import ndimage
+from skimage import measure
+
+from camelyon16.ops.froc import compute_evaluation_mask, evaluate_froc, get_itc_labels, match_candidates
+
+LEVEL = 5
+RESOLUTION = 0.243
+
+
+def reference_froc(candidates, masks):
+    """The loops of the CAMELYON16 Evaluation_FROC.py script."""
+    fp_lists, tp_lists, lesion_counts = [], [], []
+    for (xs, ys, probs), mask in zip(candidates, masks):
+        if mask is None:
+            fp_lists.append(list(probs))
+            tp_lists.append([])
+            lesion_counts.append(0)
+            continue
+        distance = ndimage.distance_transform_edt(255 - mask)
+        filled = ndimage.binary_fill_holes(distance < 75 / (RESOLUTION * 2 ** LEVEL * 2))
+        evaluation_mask = measure.label(filled, connectivity=2)
+        max_label = np.amax(evaluation_mask)
+        properties = measure.regionprops(evaluation_mask)
+        itc = [i + 1 for i in range(max_label)
+               if properties[i].axis_major_length < 275 / (RESOLUTION * 2 ** LEVEL)]
+        fp_probs, tp_probs = [], np.zeros(max_label)
+        for x, y, prob in zip(xs, ys, probs):
+            label = evaluation_mask[int(y / 2 ** LEVEL), int(x / 2 ** LEVEL)]
+            if label == 0:
+                fp_probs.append(prob)
+            elif label not in itc:
+                tp_probs[label - 1] = max(tp_probs[label - 1], prob)
+        fp_lists.append(fp_probs)
+        tp_lists.append(list(tp_probs))
+        lesion_counts.append(max_label - len(itc))
+
+    fps = [p for fp_probs in fp_lists for p in fp_probs]
+    tps = [p for tp_probs in tp_lists for p in tp_probs]
+    total_fps, total_tps = [], []
+    for threshold in sorted(set(fps + tps))[1:]:
+        total_fps.append((np.asarray(fps) >= threshold).sum())
+        total_tps.append((np.asarray(tps) >= threshold).sum())
+    total_fps.append(0)
+    total_tps.append(0)
+    return np.asarray(total_fps) / float(len(candidates)), np.asarray(total_tps) / float(sum(lesion_counts))
+
+
+class FROCTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.masks, self.candidates, self.evaluation_masks = [], [], []
+        for index in range(6):
+            mask = None
+            if index % 3 != 2:
+                mask = np.zeros((120, 100), dtype=np.uint8)
+                for _ in range(6):
+                    row, col, radius = rng.randint(5, 115), rng.randint(5, 95), rng.randint(0, 8)
+                    mask[max(row - radius, 0):row + radius + 1, max(col - radius, 0):col + radius + 1] = 255
+            self.masks.append(mask)
+            n = rng.randint(0, 60)
+            self.candidates.append((rng.randint(0, 100 * 2 ** LEVEL, n), rng.randint(0, 120 * 2 ** LEVEL, n),
+                                    np.round(rng.uniform(size=n), 2)))
+            if mask is None:
+                self.evaluation_masks.append(None)
+            else:
+                evaluation_mask, lesion_count = compute_evaluation_mask(mask, LEVEL, RESOLUTION)
+                self.evaluation_masks.append((evaluation_mask, lesion_count,
+                                              get_itc_labels(evaluation_mask, lesion_count, LEVEL, RESOLUTION)))
+
+    def testMatchesReferenceImplementation(self):
+        result = evaluate_froc(self.candidates, self.evaluation_masks, level=LEVEL)
+        fps, sensitivities = reference_froc(self.candidates, self.masks)
+        np.testing.assert_allclose(result.fps, fps)
+        np.testing.assert_allclose(result.sensitivities, sensitivities)
+        self.assertEqual(result.num_slides, 6)
+        self.assertEqual(len(result.rate_sensitivities), 6)
+        expected = np.mean(np.interp([0.25, 0.5, 1, 2, 4, 8], fps[::-1], sensitivities[::-1]))
+        self.assertAlmostEqual(result.average_sensitivity, expected)
+
+    def testIsolatedTumorCellHitsAreIgnored(self):
+        mask = np.zeros((60, 60), dtype=np.uint8)
+        mask[10:40, 10:40] = 255
+        mask[50, 50] = 255
+        evaluation_mask, lesion_count = compute_evaluation_mask(mask, LEVEL, RESOLUTION)
+        itc_labels = get_itc_labels(evaluation_mask, lesion_count, LEVEL, RESOLUTION)
+        self.assertEqual((lesion_count, list(itc_labels)), (2, [2]))
+
+        # one hit on the lesion, one on the isolated tumor cell, one false positive
+        candidates = [(np.array([20, 50, 5]) * 2 ** LEVEL, np.array([20, 50, 55]) * 2 ** LEVEL,
+                       np.array([0.9, 0.8, 0.7]))]
+        fp_probs, tp_probs, num_lesions = match_candidates(candidates, [(evaluation_mask, lesion_count, itc_labels)],
+                                                           level=LEVEL)
+        np.testing.assert_array_equal(fp_probs, [0.7])
+        np.testing.assert_array_equal(tp_probs, [0.9, 0])
+        self.assertEqual(num_lesions, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+from collections import namedtuple
+
+import numpy as np
+
+GridCandidates = namedtuple('GridCandidates', ['xs', 'ys', 'tissue_fraction', 'tumor_fraction'])
+
+
+def summed_area_table(mask):
+    """
+        Integral image of (mask != 0), padded with a leading row and column of zeros so that the sum over
+        mask[r0:r1, c0:c1] is sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0].
+    """
+    sat = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(mask != 0, axis=0), axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def window_fractions(sat, rows, cols, height, width):
+    """
+        Fraction of nonzero pixels in the windows mask[row: row + height, col: col + width] for all the
+        (row, col) pairs at once. Windows are clipped to the mask like numpy slicing would, windows that fall
+        completely outside of the mask get a fraction of 0.
+    """
+    n_rows, n_cols = sat.shape[0] - 1, sat.shape[1] - 1
+    r0 = np.clip(rows, 0, n_rows)
+    r1 = np.clip(rows + height, 0, n_rows)
+    c0 = np.clip(cols, 0, n_cols)
+    c1 = np.clip(cols + width, 0, n_cols)
+    sums = sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+    area = (r1 - r0) * (c1 - c0)
+    return np.where(area > 0, sums / np.maximum(area, 1), 0.0)
+
+
+class GridSampler(object):
+    """
+        # ==================================================================================================
+        # Vectorized grid candidate engine: summed area tables of the tissue and tumor masks are built once
+        # per slide, tissue/tumor fractions of every grid cell of a bounding box come out in one shot.
+        # ==================================================================================================
+    """
+
+    def __init__(self, mag_factor, image_open=None, tumor_gt_mask=None):
+        """
+
+        :param mag_factor: factor mapping low resolution mask coordinates to level 0 coordinates
+        :param image_open: low resolution tissue mask, if None every cell counts as tissue
+        :param tumor_gt_mask: low resolution (single channel) tumor mask, if None no cell contains tumor
+        """
+        self.mag_factor = mag_factor
+        self.tissue_sat = summed_area_table(image_open) if image_open is not None else None
+        self.tumor_sat = summed_area_table(tumor_gt_mask) if tumor_gt_mask is not None else None
+
+    def get_candidates(self, bounding_box, patch_size_w, patch_size_h, overlap=0.0):
+        """
+            Grid of patch origins (level 0 coordinates) covering a low resolution bounding box.
+
+            :param bounding_box: (x, y, width, height) in low resolution coordinates
+            :param patch_size_w: patch width in level 0 pixels
+            :param patch_size_h: patch height in level 0 pixels
+            :param overlap: fraction of the patch shared with the next grid cell, the stride is
+                            patch_size * (1 - overlap)
+            :return: GridCandidates, with the cells in row major order
+        """
+        assert 0.0 <= overlap < 1.0, 'overlap must be in [0, 1)'
+        mag_factor = self.mag_factor
+        stride_w = max(1, int(patch_size_w * (1.0 - overlap)))
+        stride_h = max(1, int(patch_size_h * (1.0 - overlap)))
+
+        b_x_start, b_y_start = int(bounding_box[0]), int(bounding_box[1])
+        b_x_end = b_x_start + int(bounding_box[2])
+        b_y_end = b_y_start + int(bounding_box[3])
+        xs = np.arange(start=int(b_x_start * mag_factor), stop=int(b_x_end * mag_factor), step=stride_w)
+        ys = np.arange(start=int(b_y_start * mag_factor), stop=int(b_y_end * mag_factor), step=stride_h)
+        xv, yv = np.meshgrid(xs, ys)
+        xv, yv = xv.ravel(), yv.ravel()
+
+        # patch corners and dimensions in low resolution coordinates
+        cols = (xv / mag_factor).astype(np.int64)
+        rows = (yv / mag_factor).astype(np.int64)
+        patch_dim_w = max(1, int(patch_size_w / mag_factor))
+        patch_dim_h = max(1, int(patch_size_h / mag_factor))
+
+        if self.tissue_sat is not None:
+            tissue_fraction = window_fractions(self.tissue_sat, rows, cols, patch_dim_h, patch_dim_w)
+        else:
+            tissue_fraction = np.ones(len(xv))
+        if self.tumor_sat is not None:
+            tumor_fraction = window_fractions(self.tumor_sat, rows, cols, patch_dim_h, patch_dim_w)
+        else:
+            tumor_fraction = np.zeros(len(xv))
+
+        return GridCandidates(xv, yv, tissue_fraction, tumor_fraction)
+
+    @staticmethod
+    def select(candidates, min_tissue_fraction=None, min_tumor_fraction=None, max_tumor_fraction=None):
+        """
+            Boolean mask of the candidates passing the thresholds, a threshold set to None is not applied.
+
+            :param candidates: GridCandidates
+            :param min_tissue_fraction: keep cells with tissue_fraction >= min_tissue_fraction
+            :param min_tumor_fraction: keep cells with tumor_fraction > min_tumor_fraction
+            :param max_tumor_fraction: keep cells with tumor_fraction <= max_tumor_fraction
+            :return:
+        """
+        keep = np.ones(len(candidates.xs), dtype=bool)
+        if min_tissue_fraction is not None:
+            keep &= candidates.tissue_fraction >= min_tissue_fraction
+        if min_tumor_fraction is not None:
+            keep &= candidates.tumor_fraction > min_tumor_fraction
+        if max_tumor_fraction is not None:
+            keep &= candidates.tumor_fraction <= max_tumor_fraction
+        return keep
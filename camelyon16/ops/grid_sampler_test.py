@@ -0,0 +1,55 @@
+"""Tests for grid_sampler."""
+import unittest
+
+import numpy as np
+
+from camelyon16.ops.grid_sampler import GridSampler, summed_area_table, window_fractions
+
+
+class GridSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.tissue = (rng.rand(60, 80) > 0.3).astype(np.uint8) * 255
+        self.tumor = np.zeros((60, 80), dtype=np.uint8)
+        self.tumor[20:35, 30:50] = 255
+
+    def testWindowFractionsMatchSlicing(self):
+        sat = summed_area_table(self.tissue)
+        rows = np.array([0, 10, 55, 59, 70])
+        cols = np.array([0, 75, 20, 79, 0])
+        fractions = window_fractions(sat, rows, cols, 8, 8)
+        for fraction, row, col in zip(fractions, rows, cols):
+            window = self.tissue[row: row + 8, col: col + 8]
+            expected = np.mean(window != 0) if window.size else 0.0
+            self.assertAlmostEqual(fraction, expected)
+
+    def testCandidatesMatchPerPatchMean(self):
+        mag_factor = 4
+        sampler = GridSampler(mag_factor, image_open=self.tissue, tumor_gt_mask=self.tumor)
+        candidates = sampler.get_candidates((5, 5, 60, 40), 32, 24)
+        for x, y, tissue_fraction, tumor_fraction in zip(*candidates):
+            col, row = int(x / mag_factor), int(y / mag_factor)
+            self.assertAlmostEqual(tissue_fraction, np.mean(self.tissue[row: row + 6, col: col + 8] != 0))
+            self.assertAlmostEqual(tumor_fraction, np.mean(self.tumor[row: row + 6, col: col + 8] != 0))
+
+    def testOverlapHalvesStride(self):
+        sampler = GridSampler(1)
+        candidates = sampler.get_candidates((0, 0, 64, 64), 32, 32)
+        overlapping = sampler.get_candidates((0, 0, 64, 64), 32, 32, overlap=0.5)
+        self.assertEqual(len(candidates.xs), 4)
+        self.assertEqual(len(overlapping.xs), 16)
+
+    def testSelect(self):
+        sampler = GridSampler(4, image_open=self.tissue, tumor_gt_mask=self.tumor)
+        candidates = sampler.get_candidates((0, 0, 80, 60), 32, 24)
+        positive = GridSampler.select(candidates, min_tumor_fraction=0.0)
+        negative = GridSampler.select(candidates, min_tissue_fraction=0.5, max_tumor_fraction=0.0)
+        self.assertTrue(np.all(candidates.tumor_fraction[positive] > 0))
+        self.assertTrue(np.all(candidates.tumor_fraction[negative] == 0))
+        self.assertTrue(np.all(candidates.tissue_fraction[negative] >= 0.5))
+        self.assertFalse(np.any(positive & negative))
+
+
+if __name__ == '__main__':
+    unittest.main()
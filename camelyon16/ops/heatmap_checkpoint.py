@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+import camelyon16.utils as utils
+
+CHECKPOINT_VERSION = 1
+
+
+class HeatmapCheckpoint(object):
+    """
+        # ==========================================================================================
+        # On-disk state of a heatmap being generated: the probabilities (heatmap.npy) and a mask of
+        # the pixels already evaluated (done.npy), both memory mapped, plus meta.json.
+        # ==========================================================================================
+
+        HeatmapStream marks every batch once its probabilities are in the heatmap, every flush_batches
+        batches the heatmap and then the mask are flushed to the disk, so the mask never claims pixels whose
+        probabilities were not written. Reopening the checkpoint of an interrupted run resumes from the last
+        flush. A checkpoint whose meta does not match (other shape, level, model, ...) is started over.
+    """
+
+    def __init__(self, checkpoint_dir, shape, meta=None, flush_batches=None):
+        """
+
+        :param checkpoint_dir: created if missing
+        :param shape: (rows, cols) or (rows, cols, channels) of the heatmap, the mask is (rows, cols)
+        :param meta: json serializable description of the run, e.g. slide, level_used and model
+        :param flush_batches: defaults to utils.HEATMAP_CHECKPOINT_FLUSH_BATCHES
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.flush_batches = flush_batches or utils.HEATMAP_CHECKPOINT_FLUSH_BATCHES
+        self._unflushed = 0
+        # through json so that it compares equal to the meta read back
+        self.meta = json.loads(json.dumps({'version': CHECKPOINT_VERSION, 'shape': [int(v) for v in shape],
+                                           'run': meta}))
+
+        heatmap_path = os.path.join(checkpoint_dir, 'heatmap.npy')
+        done_path = os.path.join(checkpoint_dir, 'done.npy')
+        if self._load_meta() == self.meta:
+            self.heatmap = np.load(heatmap_path, mmap_mode='r+')
+            self.done = np.load(done_path, mmap_mode='r+')
+            print('Resuming heatmap %s: %d pixels already evaluated' % (checkpoint_dir, self.done_count))
+            return
+
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        os.makedirs(checkpoint_dir)
+        self.heatmap = np.lib.format.open_memmap(heatmap_path, mode='w+', dtype=np.float32, shape=tuple(shape))
+        self.done = np.lib.format.open_memmap(done_path, mode='w+', dtype=np.bool_, shape=tuple(shape[:2]))
+        # meta.json last: a checkpoint without it is incomplete and started over
+        with open(os.path.join(checkpoint_dir, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+    def _load_meta(self):
+        try:
+            with open(os.path.join(self.checkpoint_dir, 'meta.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @property
+    def done_count(self):
+        return int(np.count_nonzero(self.done))
+
+    def get_pending(self, rows, cols):
+        """
+            :return: rows, cols of the heatmap pixels not evaluated yet
+        """
+        pending = ~self.done[rows, cols]
+        return rows[pending], cols[pending]
+
+    def mark_done(self, rows, cols):
+        self.done[rows, cols] = True
+        self._unflushed += 1
+        if self._unflushed >= self.flush_batches:
+            self.flush()
+
+    def flush(self):
+        self.heatmap.flush()
+        self.done.flush()
+        self._unflushed = 0
@@ -0,0 +1,232 @@
+import json
+import os
+import shutil
+
+import cv2
+import numpy as np
+
+import camelyon16.utils as utils
+
+STORE_VERSION = 1
+STORE_DTYPE = np.float16
+
+
+def get_level_path(store_dir, level):
+    return os.path.join(store_dir, 'level_%d.npy' % level)
+
+
+def to_chunks(heatmap, chunk_size):
+    """
+        (rows, cols) -> (chunk rows, chunk cols, chunk_size, chunk_size) float16, zero padded.
+    """
+    height, width = heatmap.shape
+    chunk_rows, chunk_cols = -(-height // chunk_size), -(-width // chunk_size)
+    padded = np.zeros((chunk_rows * chunk_size, chunk_cols * chunk_size), dtype=STORE_DTYPE)
+    padded[:height, :width] = heatmap
+    return padded.reshape(chunk_rows, chunk_size, chunk_cols, chunk_size).swapaxes(1, 2)
+
+
+def downsample_max(heatmap):
+    """
+        2 x 2 max pooling, small lesions stay visible in the low resolution levels.
+    """
+    height, width = heatmap.shape
+    padded = np.zeros((height + height % 2, width + width % 2), dtype=heatmap.dtype)
+    padded[:height, :width] = heatmap
+    return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(axis=(1, 3))
+
+
+def write_heatmap_store(store_dir, heatmap, slide_id=None, level=None, model=None, grid_stride=None,
+                        patch_size=None, chunk_size=None):
+    """
+        Writes a heatmap store: meta.json and one chunked float16 array per pyramid level (level_<n>.npy, memory
+        mapped by HeatmapStore). Level n + 1 is the 2 x 2 max pooling of level n, down to the first level that fits
+        in a single chunk. An existing store is replaced.
+
+        :param heatmap: (rows, cols) tumor probabilities in [0, 1]
+        :param slide_id: name of the WSI
+        :param level: WSI pyramid level of the heatmap pixels (level_used)
+        :param model: name or checkpoint of the model the probabilities come from
+        :param grid_stride: level 0 pixels between two heatmap pixels (mag_factor)
+        :param patch_size: level 0 size of the patches scored per heatmap pixel, defaults to utils.PATCH_SIZE
+        :param chunk_size: defaults to utils.HEATMAP_STORE_CHUNK_SIZE
+    """
+    chunk_size = chunk_size or utils.HEATMAP_STORE_CHUNK_SIZE
+    heatmap = np.asarray(heatmap, dtype=np.float32)
+    assert heatmap.ndim == 2, 'Expected a single channel heatmap, got shape %s' % (heatmap.shape,)
+
+    parent_dir = os.path.dirname(os.path.abspath(store_dir))
+    if not os.path.exists(parent_dir):
+        os.makedirs(parent_dir, exist_ok=True)
+    # write into a private directory first and rename it, so readers never see half written stores
+    tmp_dir = '%s.tmp-%d' % (store_dir.rstrip(os.sep), os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    shapes = []
+    level_heatmap = heatmap
+    while True:
+        np.save(get_level_path(tmp_dir, len(shapes)), to_chunks(level_heatmap, chunk_size))
+        shapes.append(list(level_heatmap.shape))
+        if max(level_heatmap.shape) <= chunk_size:
+            break
+        level_heatmap = downsample_max(level_heatmap)
+
+    meta = {'version': STORE_VERSION,
+            'slide_id': slide_id,
+            'level': None if level is None else int(level),
+            'model': model,
+            'grid_stride': None if grid_stride is None else float(grid_stride),
+            'patch_size': int(patch_size or utils.PATCH_SIZE),
+            'chunk_size': chunk_size,
+            'dtype': np.dtype(STORE_DTYPE).name,
+            'shapes': shapes}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # directories cannot be renamed over each other: the previous store is moved aside and only deleted once the
+    # new one is in place, a crash in between leaves it at <store_dir>.old-<pid>
+    old_dir = None
+    if os.path.exists(store_dir):
+        old_dir = '%s.old-%d' % (store_dir.rstrip(os.sep), os.getpid())
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(store_dir, old_dir)
+    os.rename(tmp_dir, store_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+class HeatmapStore(object):
+    """
+        # ==========================================================================================
+        # Read side of write_heatmap_store(): windows of any pyramid level are assembled from the
+        # memory mapped chunks they overlap, nothing else is read from the disk.
+        # ==========================================================================================
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        assert self.meta['version'] == STORE_VERSION, 'Unsupported heatmap store version %s' % self.meta['version']
+        self.chunk_size = self.meta['chunk_size']
+        self._chunks = {}
+
+    @property
+    def level_count(self):
+        return len(self.meta['shapes'])
+
+    def shape(self, level=0):
+        return tuple(self.meta['shapes'][level])
+
+    def get_chunks(self, level=0):
+        if level not in self._chunks:
+            self._chunks[level] = np.load(get_level_path(self.store_dir, level), mmap_mode='r')
+        return self._chunks[level]
+
+    def read_window(self, location, size, level=0):
+        """
+            :param location: (x, y) of the top left pixel in level coordinates
+            :param size: (width, height), pixels outside of the heatmap are 0
+            :return: float32 array (height, width)
+        """
+        x, y = location
+        width, height = size
+        window = np.zeros((height, width), dtype=np.float32)
+        rows, cols = self.shape(level)
+        x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + width, cols), min(y + height, rows)
+        if x0 >= x1 or y0 >= y1:
+            return window
+
+        chunks = self.get_chunks(level)
+        size = self.chunk_size
+        for chunk_row in range(y0 // size, (y1 - 1) // size + 1):
+            for chunk_col in range(x0 // size, (x1 - 1) // size + 1):
+                top, left = chunk_row * size, chunk_col * size
+                r0, r1 = max(y0, top), min(y1, top + size)
+                c0, c1 = max(x0, left), min(x1, left + size)
+                window[r0 - y: r1 - y, c0 - x: c1 - x] = chunks[chunk_row, chunk_col, r0 - top: r1 - top,
+                                                                c0 - left: c1 - left]
+        return window
+
+    def read(self, level=0):
+        rows, cols = self.shape(level)
+        return self.read_window((0, 0), (cols, rows), level)
+
+    def find_window(self, threshold):
+        """
+            Bounding box of the level 0 pixels >= threshold, refined from the coarsest level down. A max pooled
+            pixel below threshold has no pixel >= threshold under it, so every level only reads the window of the
+            hits of the level above.
+
+            :return: (x, y, width, height) in level 0 pixels, None if no pixel reaches threshold
+        """
+        level = self.level_count - 1
+        rows, cols = self.shape(level)
+        x, y, width, height = 0, 0, cols, rows
+        while True:
+            hit_rows, hit_cols = np.nonzero(self.read_window((x, y), (width, height), level) >= threshold)
+            if len(hit_rows) == 0:
+                return None
+            x, y = x + hit_cols.min(), y + hit_rows.min()
+            width, height = hit_cols.max() - hit_cols.min() + 1, hit_rows.max() - hit_rows.min() + 1
+            if level == 0:
+                return int(x), int(y), int(width), int(height)
+            level -= 1
+            rows, cols = self.shape(level)
+            x, y = 2 * x, 2 * y
+            width, height = min(2 * width, cols - x), min(2 * height, rows - y)
+
+
+def write_heatmap_prob(heatmap_prob_path, heatmap_prob, **meta):
+    """
+        Heatmap stores for paths ending with utils.HEATMAP_STORE_EXT (meta goes to write_heatmap_store()), 8 bit
+        images of heatmap_prob * 255 otherwise.
+    """
+    if heatmap_prob_path.endswith(utils.HEATMAP_STORE_EXT):
+        write_heatmap_store(heatmap_prob_path, heatmap_prob, **meta)
+    else:
+        cv2.imwrite(heatmap_prob_path, heatmap_prob * 255)
+
+
+def read_heatmap_image(heatmap_prob_path):
+    heatmap_prob = cv2.imread(heatmap_prob_path, cv2.IMREAD_GRAYSCALE)
+    assert heatmap_prob is not None, 'Failed to read heatmap %s.' % heatmap_prob_path
+    return heatmap_prob.astype(np.float32) / 255
+
+
+def read_heatmap_prob(heatmap_prob_path, location=None, size=None):
+    """
+        float32 (rows, cols) probabilities of a heatmap store, or of an 8 bit heatmap image scaled back to [0, 1].
+        Stores only read the chunks of the requested window, images are read whole and cropped.
+
+        :param location: (x, y) of the top left pixel of the window, None reads the whole heatmap
+        :param size: (width, height) of the window, pixels outside of the heatmap are 0
+    """
+    if os.path.isdir(heatmap_prob_path):
+        store = HeatmapStore(heatmap_prob_path)
+        if location is None:
+            return store.read()
+        return store.read_window(location, size)
+
+    heatmap_prob = read_heatmap_image(heatmap_prob_path)
+    if location is None:
+        return heatmap_prob
+    (x, y), (width, height) = location, size
+    window = np.zeros((height, width), dtype=np.float32)
+    crop = heatmap_prob[max(y, 0): y + height, max(x, 0): x + width]
+    window[max(-y, 0): max(-y, 0) + crop.shape[0], max(-x, 0): max(-x, 0) + crop.shape[1]] = crop
+    return window
+
+
+def find_heatmap_window(heatmap_prob_path, threshold):
+    """
+        Bounding box (x, y, width, height) of the pixels >= threshold of a heatmap store (see
+        HeatmapStore.find_window()) or image, None if there are none.
+    """
+    if os.path.isdir(heatmap_prob_path):
+        return HeatmapStore(heatmap_prob_path).find_window(threshold)
+    rows, cols = np.nonzero(read_heatmap_image(heatmap_prob_path) >= threshold)
+    if len(rows) == 0:
+        return None
+    return int(cols.min()), int(rows.min()), int(cols.max() - cols.min() + 1), int(rows.max() - rows.min() + 1)
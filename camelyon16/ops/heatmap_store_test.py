@@ -0,0 +1,82 @@
+"""Tests for heatmap_store."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from camelyon16.ops.heatmap_store import HeatmapStore, find_heatmap_window, read_heatmap_prob, write_heatmap_prob, \
+    write_heatmap_store
+
+
+class HeatmapStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.tmp_dir, 'Tumor_001_prob.heatmap')
+        self.heatmap = np.random.RandomState(0).uniform(0, 1, size=(70, 45)).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testWindowsAndPyramid(self):
+        write_heatmap_store(self.store_dir, self.heatmap, slide_id='Tumor_001', level=6, model='model5',
+                            grid_stride=64.0, chunk_size=16)
+        store = HeatmapStore(self.store_dir)
+        self.assertEqual(store.meta['slide_id'], 'Tumor_001')
+        self.assertEqual(store.meta['grid_stride'], 64.0)
+        self.assertEqual([store.shape(level) for level in range(store.level_count)],
+                         [(70, 45), (35, 23), (18, 12), (9, 6)])
+
+        np.testing.assert_allclose(store.read(), self.heatmap, atol=1e-3)
+        window = store.read_window((40, 60), (10, 15))
+        np.testing.assert_allclose(window[:10, :5], self.heatmap[60:, 40:], atol=1e-3)
+        self.assertTrue(np.all(window[10:] == 0) and np.all(window[:, 5:] == 0))
+        np.testing.assert_allclose(store.read(1)[:2, :2], [[self.heatmap[:2, :2].max(), self.heatmap[:2, 2:4].max()],
+                                                           [self.heatmap[2:4, :2].max(), self.heatmap[2:4, 2:4].max()]],
+                                   atol=1e-3)
+
+    def testStoreAndImageReadTheSame(self):
+        png_path = os.path.join(self.tmp_dir, 'Tumor_001_prob.png')
+        write_heatmap_prob(png_path, self.heatmap)
+        write_heatmap_prob(self.store_dir, self.heatmap)
+        self.assertEqual(cv2.imread(png_path).shape, (70, 45, 3))
+        self.assertEqual(read_heatmap_prob(self.store_dir).shape, (70, 45))
+        # the image holds the probabilities rounded to 8 bits, the store float16 ones
+        np.testing.assert_allclose(read_heatmap_prob(self.store_dir), read_heatmap_prob(png_path), atol=0.5 / 255 + 1e-3)
+
+        for path in (self.store_dir, png_path):
+            window = read_heatmap_prob(path, (40, -5), (10, 15))
+            self.assertEqual(window.dtype, np.float32)
+            np.testing.assert_allclose(window[5:, :5], read_heatmap_prob(path)[:10, 40:])
+            self.assertTrue(np.all(window[:5] == 0) and np.all(window[:, 5:] == 0))
+
+    def testFindWindow(self):
+        heatmap = np.zeros((300, 200), dtype=np.float32)
+        heatmap[37, 150] = 0.95
+        heatmap[201:240, 61:64] = 0.6
+        png_path = os.path.join(self.tmp_dir, 'Tumor_001_prob.png')
+        write_heatmap_prob(png_path, heatmap)
+        write_heatmap_store(self.store_dir, heatmap, chunk_size=16)
+        store = HeatmapStore(self.store_dir)
+        self.assertEqual(store.level_count, 6)
+
+        self.assertEqual(store.find_window(0.5), (61, 37, 90, 203))
+        self.assertEqual(store.find_window(0.9), (150, 37, 1, 1))
+        self.assertIsNone(store.find_window(0.99))
+        for path in (self.store_dir, png_path):
+            self.assertEqual(find_heatmap_window(path, 0.5), (61, 37, 90, 203))
+            self.assertIsNone(find_heatmap_window(path, 0.99))
+
+    def testReplaceStore(self):
+        write_heatmap_store(self.store_dir, self.heatmap)
+        write_heatmap_store(self.store_dir, 1 - self.heatmap, slide_id='Tumor_001')
+        self.assertEqual(os.listdir(self.tmp_dir), ['Tumor_001_prob.heatmap'])
+        store = HeatmapStore(self.store_dir)
+        self.assertEqual(store.meta['slide_id'], 'Tumor_001')
+        np.testing.assert_allclose(store.read(), 1 - self.heatmap, atol=1e-3)
+
+if __name__ == '__main__':
+    unittest.main()
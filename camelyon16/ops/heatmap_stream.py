@@ -0,0 +1,337 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+import camelyon16.utils as utils
+from camelyon16.ops.region_planner import iter_coalesced_patches
+
+# rows, cols: heatmap pixels (level_used coordinates) of the patches, images: (n, h, w, 3) uint8 RGB
+HeatmapBatch = namedtuple('HeatmapBatch', ['rows', 'cols', 'images'])
+
+# tissue pixels of an adaptive heatmap: evaluated on the lattice, evaluated around uncertain lattice points and
+# interpolated, see HeatmapStream.run_adaptive()
+AdaptiveCounts = namedtuple('AdaptiveCounts', ['tissue', 'lattice', 'refined', 'interpolated'])
+
+# put() / get() wake up this often to notice that the other side of the pipeline stopped
+QUEUE_POLL_SECONDS = 0.1
+
+
+class StageTimer(object):
+    """
+        Thread safe wall clock seconds and item counts per pipeline stage. Stages running in different threads
+        overlap, so their seconds add up to more than the elapsed time: the largest one is the bottleneck.
+    """
+
+    def __init__(self, stages=()):
+        self._lock = threading.Lock()
+        self.seconds = OrderedDict((stage, 0.0) for stage in stages)
+        self.counts = OrderedDict((stage, 0) for stage in stages)
+
+    def add(self, stage, seconds, count=0):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + count
+
+    @contextmanager
+    def time(self, stage, count=0):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start_time, count)
+
+    def reset(self):
+        with self._lock:
+            for stage in self.seconds:
+                self.seconds[stage] = 0.0
+                self.counts[stage] = 0
+
+    def summary(self):
+        with self._lock:
+            return ', '.join('%s %.1fs' % (stage, seconds) for stage, seconds in self.seconds.items())
+
+
+def get_tissue_pixels(image_open, bounding_boxes):
+    """
+        Heatmap pixels to evaluate: tissue pixels of image_open inside at least one bounding box, in row major
+        order (one patch per pixel, like extract_patches_heatmap.extract_patch_from_bb()).
+
+        :return: rows, cols (int64 arrays)
+    """
+    roi = np.zeros(image_open.shape[:2], dtype=bool)
+    for bounding_box in bounding_boxes:
+        x, y, w, h = [int(v) for v in bounding_box]
+        roi[y: y + h, x: x + w] = True
+    rows, cols = np.nonzero(roi & (image_open != utils.PIXEL_BLACK))
+    return rows.astype(np.int64), cols.astype(np.int64)
+
+
+def iter_patch_batches(wsi_image, rows, cols, mag_factor, batch_size, patch_size=None, read_level=0):
+    """
+        Reads the patches of the heatmap pixels (rows, cols) through coalesced super-reads and groups them
+        into batches.
+
+        :param wsi_image: OpenSlide or CachedSlide
+        :param rows: heatmap rows (level_used coordinates)
+        :param cols: heatmap columns (level_used coordinates)
+        :param mag_factor: downsample of the heatmap level, see WSIOps.get_mag_factor()
+        :param batch_size: patches per batch, the last batch may be smaller
+        :param patch_size: patch width and height in pixels of read_level, defaults to utils.PATCH_SIZE
+        :param read_level: pyramid level the patches are read at
+        :return: generator of HeatmapBatch, the images are owned by the batch
+    """
+    patch_size = utils.PATCH_SIZE if patch_size is None else patch_size
+    xs = np.round(cols * mag_factor).astype(np.int64)
+    ys = np.round(rows * mag_factor).astype(np.int64)
+
+    indices = np.empty(batch_size, dtype=np.int64)
+    images = np.empty((batch_size, patch_size, patch_size, 3), dtype=np.uint8)
+    n = 0
+    for i, patch in iter_coalesced_patches(wsi_image, xs, ys, read_level, (patch_size, patch_size),
+                                           max_bytes=utils.COALESCED_READ_BYTES,
+                                           min_fill=utils.COALESCED_READ_MIN_FILL):
+        indices[n] = i
+        images[n] = patch[:, :, :3]
+        n += 1
+        if n == batch_size:
+            yield HeatmapBatch(rows[indices], cols[indices], images)
+            images = np.empty_like(images)
+            n = 0
+    if n:
+        yield HeatmapBatch(rows[indices[:n]], cols[indices[:n]], images[:n])
+
+
+class HeatmapStream(object):
+    """
+        # ==========================================================================================
+        # Streaming heatmap inference: reader threads cut the tissue pixels of a slide into patches,
+        # a bounded queue hands the batches to the model and the probabilities go straight into the
+        # heatmap array. No patch ever touches the disk.
+        # ==========================================================================================
+
+        Memory is capped by the queue: at most queue_batches batches wait for the model, plus one batch
+        being filled per reader. predict_fn(images) runs in the calling thread, which is where TF sessions
+        (or any other model) expect to be driven from. Time spent per stage accumulates in self.timer.
+    """
+
+    def __init__(self, predict_fn, batch_size=None, queue_batches=None, num_readers=None, patch_size=None,
+                 channels=None):
+        """
+
+        :param predict_fn: predict_fn(images) -> tumor probabilities, images is a (n, h, w, 3) uint8 array
+        :param batch_size: defaults to utils.HEATMAP_BATCH_SIZE
+        :param queue_batches: capacity of the reader -> model queue, defaults to utils.HEATMAP_QUEUE_BATCHES
+        :param num_readers: reader threads, defaults to utils.HEATMAP_NUM_READERS
+        :param patch_size: level 0 patch size, defaults to utils.PATCH_SIZE
+        :param channels: probabilities per patch returned by predict_fn (n, channels), e.g. one per model of an
+                         ensemble, the heatmaps get a trailing channel axis. None for a single (n,) probability
+        """
+        self.predict_fn = predict_fn
+        self.channels = channels
+        self.batch_size = batch_size or utils.HEATMAP_BATCH_SIZE
+        self.queue_batches = queue_batches or utils.HEATMAP_QUEUE_BATCHES
+        self.num_readers = num_readers or utils.HEATMAP_NUM_READERS
+        self.patch_size = patch_size or utils.PATCH_SIZE
+        self.timer = StageTimer(('read', 'forward', 'scatter'))
+
+    def _put(self, batches, item, stop_event):
+        while not stop_event.is_set():
+            try:
+                batches.put(item, timeout=QUEUE_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def iter_batches(self, wsi_image, rows, cols, mag_factor):
+        """
+            Model inputs of the heatmap pixels (rows, cols), run in the reader threads.
+        """
+        return iter_patch_batches(wsi_image, rows, cols, mag_factor, self.batch_size, self.patch_size)
+
+    def predict(self, batch):
+        """
+            Tumor probabilities of batch.rows, batch.cols, run in the calling thread.
+        """
+        probabilities = np.asarray(self.predict_fn(batch.images))
+        return probabilities.reshape(-1) if self.channels is None else probabilities.reshape(-1, self.channels)
+
+    def allocate(self, image_open):
+        """
+            Zeroed heatmap of image_open's shape, with a trailing channel axis for multi channel predictions.
+        """
+        channels = () if self.channels is None else (self.channels,)
+        return np.zeros(image_open.shape[:2] + channels, dtype=np.float32)
+
+    def _read(self, wsi_image, rows, cols, mag_factor, batches, stop_event):
+        try:
+            patch_batches = self.iter_batches(wsi_image, rows, cols, mag_factor)
+            while True:
+                with self.timer.time('read'):
+                    batch = next(patch_batches, None)
+                if batch is None:
+                    break
+                if not self._put(batches, batch, stop_event):
+                    return
+            self._put(batches, None, stop_event)
+        except Exception as e:  # pylint: disable=broad-except
+            # handed over to the model thread, which raises it
+            self._put(batches, e, stop_event)
+
+    def split_pixels(self, rows, cols):
+        """
+            Row bands of the tissue pixels, one per reader, so that every reader coalesces its own neighbourhood.
+        """
+        bounds = np.linspace(0, len(rows), self.num_readers + 1).astype(np.int64)
+        return [(rows[start:end], cols[start:end]) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    def run(self, wsi_image, image_open, bounding_boxes, mag_factor, heatmap=None, checkpoint=None):
+        """
+            Evaluates every tissue pixel of image_open inside bounding_boxes.
+
+            :param wsi_image: OpenSlide or CachedSlide
+            :param image_open: tissue mask at the heatmap resolution (level_used)
+            :param bounding_boxes: ROIs in image_open coordinates
+            :param mag_factor: downsample of the heatmap level, see WSIOps.get_mag_factor()
+            :param heatmap: float32 array of image_open's shape (plus channels) to fill, allocated if None
+            :param checkpoint: HeatmapCheckpoint of image_open's shape, its heatmap is filled instead and the
+                               pixels it already holds are skipped
+            :return: heatmap, heatmap[row, col] is the tumor probability of the patch at (col, row) * mag_factor
+        """
+        if checkpoint is not None:
+            heatmap = checkpoint.heatmap
+        elif heatmap is None:
+            heatmap = self.allocate(image_open)
+        rows, cols = get_tissue_pixels(image_open, bounding_boxes)
+        self.evaluate(wsi_image, rows, cols, mag_factor, heatmap, checkpoint)
+        return heatmap
+
+    def run_adaptive(self, wsi_image, image_open, bounding_boxes, mag_factor, heatmap=None, stride=None, low=None,
+                     high=None, checkpoint=None):
+        """
+            Coarse to fine version of run(): the tissue pixels on a lattice of every stride-th row and column are
+            evaluated first. A tissue pixel is then evaluated as well unless all the lattice probabilities around
+            it (the lattice points of its own and the 8 neighbouring lattice cells) are below low or all above
+            high, in which case it gets the bilinear interpolation of its lattice cell corners.
+
+            :param stride: lattice spacing in heatmap pixels, defaults to utils.HEATMAP_LATTICE_STRIDE
+            :param low: confidently normal below, defaults to utils.HEATMAP_REFINE_LOW
+            :param high: confidently tumor above, defaults to utils.HEATMAP_REFINE_HIGH
+            :param checkpoint: see run(), the interpolated pixels are recomputed on resume
+            :return: heatmap, AdaptiveCounts
+        """
+        assert self.channels is None, 'The adaptive mode refines single channel heatmaps only'
+        stride = stride or utils.HEATMAP_LATTICE_STRIDE
+        low = utils.HEATMAP_REFINE_LOW if low is None else low
+        high = utils.HEATMAP_REFINE_HIGH if high is None else high
+        if checkpoint is not None:
+            heatmap = checkpoint.heatmap
+        elif heatmap is None:
+            heatmap = np.zeros(image_open.shape[:2], dtype=np.float32)
+        rows, cols = get_tissue_pixels(image_open, bounding_boxes)
+
+        on_lattice = (rows % stride == 0) & (cols % stride == 0)
+        self.evaluate(wsi_image, rows[on_lattice], cols[on_lattice], mag_factor, heatmap, checkpoint)
+
+        # lattice probabilities, one extra row and column so that the corners of the last cells exist, -1 where
+        # nothing was evaluated
+        lattice = np.full((image_open.shape[0] // stride + 2, image_open.shape[1] // stride + 2), -1,
+                          dtype=np.float32)
+        lattice[rows[on_lattice] // stride, cols[on_lattice] // stride] = heatmap[rows[on_lattice], cols[on_lattice]]
+        evaluated = lattice >= 0
+        kernel = np.ones((3, 3), dtype=np.uint8)
+        lattice_max = cv2.dilate(lattice, kernel)
+        lattice_min = cv2.erode(np.where(evaluated, lattice, 2).astype(np.float32), kernel)
+
+        rows, cols = rows[~on_lattice], cols[~on_lattice]
+        cell_rows, cell_cols = rows // stride, cols // stride
+        fy = (rows - cell_rows * stride).astype(np.float32) / stride
+        fx = (cols - cell_cols * stride).astype(np.float32) / stride
+        neighbourhood_max = np.full(len(rows), -1, dtype=np.float32)
+        neighbourhood_min = np.full(len(rows), 2, dtype=np.float32)
+        value_sum = np.zeros(len(rows), dtype=np.float32)
+        weight_sum = np.zeros(len(rows), dtype=np.float32)
+        for dy, dx, weight in ((0, 0, (1 - fy) * (1 - fx)), (0, 1, (1 - fy) * fx), (1, 0, fy * (1 - fx)),
+                               (1, 1, fy * fx)):
+            corner_rows, corner_cols = cell_rows + dy, cell_cols + dx
+            neighbourhood_max = np.maximum(neighbourhood_max, lattice_max[corner_rows, corner_cols])
+            neighbourhood_min = np.minimum(neighbourhood_min, lattice_min[corner_rows, corner_cols])
+            weight = weight * evaluated[corner_rows, corner_cols]
+            value_sum += weight * lattice[corner_rows, corner_cols]
+            weight_sum += weight
+
+        normal = (neighbourhood_max >= 0) & (neighbourhood_max < low)
+        tumor = (neighbourhood_min <= 1) & (neighbourhood_min > high)
+        interpolated = normal | tumor
+        # cells without an evaluated corner take the bound that made them confident
+        fallback = np.where(normal, neighbourhood_max, neighbourhood_min)
+        heatmap[rows[interpolated], cols[interpolated]] = np.where(
+            weight_sum > 0, value_sum / np.maximum(weight_sum, 1e-6), fallback)[interpolated]
+
+        self.evaluate(wsi_image, rows[~interpolated], cols[~interpolated], mag_factor, heatmap, checkpoint)
+
+        counts = AdaptiveCounts(int(on_lattice.sum()) + len(rows), int(on_lattice.sum()),
+                                int((~interpolated).sum()), int(interpolated.sum()))
+        print('Adaptive heatmap: %d of %d tissue patches evaluated (lattice %d, refined %d, interpolated %d)' %
+              (counts.lattice + counts.refined, counts.tissue, counts.lattice, counts.refined, counts.interpolated))
+        return heatmap, counts
+
+    def evaluate(self, wsi_image, rows, cols, mag_factor, heatmap, checkpoint=None):
+        """
+            Evaluates the patches of the heatmap pixels (rows, cols) and writes their probabilities into heatmap.
+            With a checkpoint, the pixels it holds already are skipped and every batch is marked done in it.
+
+            :return: number of patches evaluated
+        """
+        if checkpoint is not None:
+            rows, cols = checkpoint.get_pending(rows, cols)
+        print('Heatmap patches to evaluate: %d' % len(rows))
+
+        batches = queue.Queue(maxsize=self.queue_batches)
+        stop_event = threading.Event()
+        readers = []
+        for reader_rows, reader_cols in self.split_pixels(rows, cols):
+            reader = threading.Thread(target=self._read, args=(wsi_image, reader_rows, reader_cols, mag_factor,
+                                                               batches, stop_event))
+            reader.daemon = True
+            reader.start()
+            readers.append(reader)
+
+        start_time = time.time()
+        done = 0
+        running = len(readers)
+        try:
+            while running:
+                try:
+                    batch = batches.get(timeout=QUEUE_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if batch is None:
+                    running -= 1
+                    continue
+                if isinstance(batch, Exception):
+                    raise batch
+
+                with self.timer.time('forward', len(batch.rows)):
+                    probabilities = self.predict(batch)
+                with self.timer.time('scatter', len(batch.rows)):
+                    heatmap[batch.rows, batch.cols] = probabilities
+                    if checkpoint is not None:
+                        checkpoint.mark_done(batch.rows, batch.cols)
+                done += len(batch.rows)
+        finally:
+            stop_event.set()
+            for reader in readers:
+                reader.join()
+            if checkpoint is not None:
+                checkpoint.flush()
+
+        duration = time.time() - start_time
+        print('Heatmap patches evaluated: %d in %.1f secs (%.1f patches/sec), %s' %
+              (done, duration, done / duration if duration > 0 else 0.0, self.timer.summary()))
+        return done
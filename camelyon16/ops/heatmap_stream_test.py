@@ -0,0 +1,111 @@
+"""Tests for heatmap_stream."""
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from camelyon16.ops.heatmap_checkpoint import HeatmapCheckpoint
+from camelyon16.ops.heatmap_stream import HeatmapStream, get_tissue_pixels
+from camelyon16.ops.array_slide import ArraySlide
+
+
+def mean_red(images):
+    return images[:, :, :, 0].mean(axis=(1, 2)) / 255.0
+
+
+class HeatmapStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.slide = ArraySlide(rng.randint(0, 255, size=(160, 200, 4)).astype(np.uint8))
+        self.image_open = np.zeros((20, 25), dtype=np.uint8)
+        self.image_open[2:15, 3:20] = 255
+        self.bounding_boxes = [(3, 2, 10, 13), (15, 5, 5, 5)]
+
+    def testTissuePixelsInsideBoundingBoxes(self):
+        rows, cols = get_tissue_pixels(self.image_open, self.bounding_boxes)
+        self.assertEqual(len(rows), 10 * 13 + 5 * 5)
+        self.assertTrue(np.all(self.image_open[rows, cols] != 0))
+
+    def testHeatmapMatchesPerPatchPredictions(self):
+        stream = HeatmapStream(mean_red, batch_size=7, queue_batches=2, num_readers=3, patch_size=16)
+        heatmap = stream.run(self.slide, self.image_open, self.bounding_boxes, mag_factor=8)
+
+        rows, cols = get_tissue_pixels(self.image_open, self.bounding_boxes)
+        expected = np.zeros_like(heatmap)
+        for row, col in zip(rows, cols):
+            patch = self.slide.read_region_array((col * 8, row * 8), 0, (16, 16))[:, :, :3]
+            expected[row, col] = mean_red(patch[None])[0]
+        np.testing.assert_allclose(heatmap, expected, rtol=1e-6)
+
+    def testMultiChannelHeatmapHasOneChannelPerModel(self):
+        def ensemble(images):
+            return np.stack([mean_red(images), 1 - mean_red(images)], axis=1)
+        stream = HeatmapStream(ensemble, batch_size=7, num_readers=2, patch_size=16, channels=2)
+        heatmap = stream.run(self.slide, self.image_open, self.bounding_boxes, mag_factor=8)
+
+        expected = HeatmapStream(mean_red, patch_size=16).run(self.slide, self.image_open, self.bounding_boxes,
+                                                              mag_factor=8)
+        self.assertEqual(heatmap.shape, self.image_open.shape + (2,))
+        np.testing.assert_allclose(heatmap[:, :, 0], expected, rtol=1e-6)
+        rows, cols = get_tissue_pixels(self.image_open, self.bounding_boxes)
+        np.testing.assert_allclose(heatmap[rows, cols, 1], 1 - expected[rows, cols], rtol=1e-6)
+
+    def testAdaptiveRefinesAroundTumorOnly(self):
+        pixels = np.zeros((160, 200, 4), dtype=np.uint8)
+        pixels[40:96, 48:120, 0] = 255
+        slide = ArraySlide(pixels)
+        image_open = np.full((20, 25), 255, dtype=np.uint8)
+        bounding_boxes = [(0, 0, 25, 20)]
+        stream = HeatmapStream(mean_red, batch_size=8, num_readers=2, patch_size=8)
+
+        full = stream.run(slide, image_open, bounding_boxes, mag_factor=8)
+        adaptive, counts = stream.run_adaptive(slide, image_open, bounding_boxes, mag_factor=8, stride=4)
+
+        self.assertEqual(counts.tissue, 20 * 25)
+        self.assertEqual(counts.lattice, 5 * 7)
+        self.assertEqual(counts.lattice + counts.refined + counts.interpolated, counts.tissue)
+        self.assertLess(counts.lattice + counts.refined, counts.tissue)
+        np.testing.assert_array_equal(adaptive > 0.5, full > 0.5)
+        np.testing.assert_allclose(adaptive, full, atol=0.1)
+
+    def testInterruptedRunResumesFromCheckpoint(self):
+        checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_dir, True)
+        calls = []
+
+        def crashing_mean_red(images):
+            calls.append(len(images))
+            if len(calls) == 4:
+                raise RuntimeError('killed')
+            return mean_red(images)
+
+        stream = HeatmapStream(crashing_mean_red, batch_size=10, num_readers=1, patch_size=16)
+        checkpoint = HeatmapCheckpoint(checkpoint_dir, self.image_open.shape, meta={'slide': 'Tumor_001'},
+                                       flush_batches=2)
+        with self.assertRaises(RuntimeError):
+            stream.run(self.slide, self.image_open, self.bounding_boxes, mag_factor=8, checkpoint=checkpoint)
+        del checkpoint
+
+        resumed = HeatmapCheckpoint(checkpoint_dir, self.image_open.shape, meta={'slide': 'Tumor_001'})
+        self.assertEqual(resumed.done_count, 30)
+        heatmap = stream.run(self.slide, self.image_open, self.bounding_boxes, mag_factor=8, checkpoint=resumed)
+        self.assertEqual(sum(calls[4:]), 10 * 13 + 5 * 5 - 30)
+
+        expected = HeatmapStream(mean_red, patch_size=16).run(self.slide, self.image_open, self.bounding_boxes,
+                                                              mag_factor=8)
+        np.testing.assert_allclose(heatmap, expected, rtol=1e-6)
+        self.assertEqual(resumed.done_count, 10 * 13 + 5 * 5)
+
+    def testReaderErrorsReachTheCaller(self):
+        def failing_read(location, level, size):
+            raise IOError('broken tile')
+        self.slide.read_region_array = failing_read
+        stream = HeatmapStream(mean_red, batch_size=4, queue_batches=1, num_readers=2, patch_size=16)
+        with self.assertRaises(IOError):
+            stream.run(self.slide, self.image_open, self.bounding_boxes, mag_factor=8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""Tests for PatchExtractor.get_heatmap_false_region_candidates() of wsi_ops."""
+import unittest
+
+import numpy as np
+
+import camelyon16.utils as utils
+from camelyon16.ops.wsi_ops import PatchExtractor
+
+# 256 pixel patches at a downsample of 64 cover 4 x 4 low resolution pixels
+MAG_FACTOR = 64
+PATCH_DIM = 4
+
+
+def reference_candidates(image_open, heatmap_prob, bounding_boxes, tumor_gt_mask):
+    """The per pixel loop the vectorized mining replaced."""
+    false_positives, false_negatives = [], []
+    for x0, y0, w, h in bounding_boxes:
+        for row in range(y0, y0 + h):
+            for col in range(x0, x0 + w):
+                if image_open[row, col] == 0:
+                    continue
+                footprint = tumor_gt_mask[row: row + PATCH_DIM, col: col + PATCH_DIM] != 0
+                if heatmap_prob[row, col] >= utils.TUMOR_PROB_THRESHOLD:
+                    if tumor_gt_mask[row, col] == 0 and not footprint.any():
+                        false_positives.append((row, col))
+                elif tumor_gt_mask[row, col] != 0 and footprint.mean() >= utils.FALSE_NEGATIVE_MIN_TUMOR_FRACTION:
+                    false_negatives.append((row, col))
+    return sorted(false_positives), sorted(false_negatives)
+
+
+class HeatmapFalseRegionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.image_open = np.full((30, 30), 255, dtype=np.uint8)
+        # background on the right
+        self.image_open[:, 25:] = 0
+        self.tumor_gt_mask = np.zeros((30, 30), dtype=np.uint8)
+        self.tumor_gt_mask[10:20, 10:20] = 255
+        self.heatmap_prob = np.full((30, 30), 0.1, dtype=np.float32)
+        # far from the tumor: false positives
+        self.heatmap_prob[0:6, 0:6] = 0.95
+        # next to the tumor, the patch footprint touches it: not a false positive
+        self.heatmap_prob[7:10, 12] = 0.95
+        # on background
+        self.heatmap_prob[2, 27] = 0.95
+        # detected tumor
+        self.heatmap_prob[14, 14] = 0.95
+        self.bounding_boxes = [(0, 0, 30, 30)]
+
+    def get_candidates(self, tumor_gt_mask, **kwargs):
+        (fp_rows, fp_cols), (fn_rows, fn_cols) = PatchExtractor.get_heatmap_false_region_candidates(
+            self.image_open, self.heatmap_prob, None, self.bounding_boxes, tumor_gt_mask=tumor_gt_mask,
+            mag_factor=MAG_FACTOR, **kwargs)
+        return sorted(zip(fp_rows.tolist(), fp_cols.tolist())), sorted(zip(fn_rows.tolist(), fn_cols.tolist()))
+
+    def testMatchesPerPixelLoop(self):
+        false_positives, false_negatives = self.get_candidates(self.tumor_gt_mask)
+        expected_positives, expected_negatives = reference_candidates(
+            self.image_open, self.heatmap_prob, self.bounding_boxes, self.tumor_gt_mask)
+        self.assertEqual(false_positives, expected_positives)
+        self.assertEqual(false_negatives, expected_negatives)
+        self.assertEqual(len(false_positives), 36)
+        # footprints fully inside the 10 x 10 tumor, less the detected pixel
+        self.assertEqual(len(false_negatives), 7 * 7 - 1)
+
+        # Normal WSIs: every hot tissue pixel, no false negatives
+        false_positives, false_negatives = self.get_candidates(None)
+        self.assertEqual(len(false_positives), 36 + 3 + 1)
+        self.assertEqual(false_negatives, [])
+
+    def testSpacingAndBudget(self):
+        all_positives, _ = self.get_candidates(self.tumor_gt_mask)
+        false_positives, false_negatives = self.get_candidates(self.tumor_gt_mask, min_spacing=3)
+        self.assertEqual(len(false_positives), 4)
+        self.assertEqual(len({(row // 3, col // 3) for row, col in false_positives}), 4)
+        self.assertEqual(len({(row // 3, col // 3) for row, col in false_negatives}), len(false_negatives))
+        self.assertTrue(set(false_positives) <= set(all_positives))
+
+        np.random.seed(0)
+        false_positives, false_negatives = self.get_candidates(self.tumor_gt_mask, max_patches=10)
+        self.assertEqual((len(false_positives), len(false_negatives)), (10, 10))
+        self.assertTrue(set(false_positives) <= set(all_positives))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,331 @@
+import glob
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+import camelyon16.utils as utils
+
+SHARD_EXTENSION = '.tar'
+INDEX_EXTENSION = '.index.jsonl'
+MANIFEST_EXTENSION = '.manifest.npy'
+DEFAULT_SHARD_BYTES = 1024 * 1024 * 1024
+
+# one row per patch of a coordinate manifest, x and y are level 0 coordinates of the top left corner, width and
+# height the size of the patch in pixels of its level
+MANIFEST_DTYPE = np.dtype([('slide', 'U32'), ('level', np.int8), ('x', np.int64), ('y', np.int64),
+                           ('width', np.int32), ('height', np.int32), ('label', np.int8),
+                           ('tumor_fraction', np.float32)])
+
+ShardRecord = namedtuple('ShardRecord', ['shard_path', 'name', 'offset', 'size', 'key', 'slide', 'x', 'y', 'level',
+                                         'label', 'tumor_fraction', 'kind'])
+
+
+def encode_image(image, image_format='JPEG'):
+    """
+        Encodes a PIL image (or an array) into bytes, RGBA images are converted to RGB first for JPEG.
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, image_format)
+    return buffer.getvalue()
+
+
+class DirectoryPatchWriter(object):
+    """
+        # ==========================================================================================
+        # Writes every patch as a separate image file, the layout the extraction methods always used.
+        # ==========================================================================================
+    """
+    needs_pixels = True
+
+    def __init__(self, patch_save_dir, image_format='JPEG', extension='.jpg', mask_suffix='_mask'):
+        self.patch_save_dir = patch_save_dir
+        self.image_format = image_format
+        self.extension = extension
+        self.mask_suffix = mask_suffix
+
+    def write(self, key, patch, slide=None, x=None, y=None, level=None, label=None, mask=None, tumor_fraction=None,
+              width=None, height=None):
+        """
+
+        :param key: name of the sample, without extension
+        :param patch: PIL image (or array) of the patch
+        :param slide: name of the WSI the patch comes from
+        :param x: level 0 x coordinate of the top left corner of the patch
+        :param y: level 0 y coordinate of the top left corner of the patch
+        :param level: pyramid level the patch was read at
+        :param label: 1 for tumor, 0 for normal
+        :param mask: optional PIL image (or array) of the tumor mask of the patch
+        :param tumor_fraction: fraction of the patch covered by tumor, as estimated by the sampler
+        :param width: width of the patch in pixels of level
+        :param height: height of the patch in pixels of level
+        """
+        with open(self.patch_save_dir + key + self.extension, 'wb') as f:
+            f.write(encode_image(patch, self.image_format))
+        if mask is not None:
+            with open(self.patch_save_dir + key + self.mask_suffix + self.extension, 'wb') as f:
+                f.write(encode_image(mask, self.image_format))
+
+    def close(self):
+        pass
+
+
+class ShardPatchWriter(object):
+    """
+        # ==========================================================================================
+        # Streams patches into size bounded tar shards (WebDataset layout) instead of one file each.
+        # ==========================================================================================
+
+        Samples are stored as '<key>.jpg' and '<key>.mask.jpg' members. Every shard '<prefix>-00000.tar'
+        comes with '<prefix>-00000.index.jsonl', one line per member with the byte offset and size of the
+        member data inside the tar, the slide name, the level 0 coordinates, the level and the label, so a
+        reader can seek straight to a patch. A shard is written under a temporary name and renamed together
+        with its index when it is closed, half written shards of a crashed run never look complete.
+        The prefix must be unique per writer (e.g. the slide name) when several processes write to the same
+        directory.
+    """
+    needs_pixels = True
+
+    def __init__(self, shard_dir, shard_prefix, max_shard_bytes=DEFAULT_SHARD_BYTES, image_format='JPEG',
+                 extension='.jpg'):
+        """
+
+        :param shard_dir: directory to save the shards into
+        :param shard_prefix: prefix of the shard file names
+        :param max_shard_bytes: a new shard is started once the current one exceeds this size
+        :param image_format: PIL format used to encode the patches
+        :param extension: extension of the member names
+        """
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.shard_prefix = shard_prefix
+        self.max_shard_bytes = max_shard_bytes
+        self.image_format = image_format
+        self.extension = extension
+        self.shard_index = 0
+        self.shard_paths = []
+        self._tar = None
+        self._records = []
+
+    def _get_shard_path(self):
+        return os.path.join(self.shard_dir, '%s-%.5d%s' % (self.shard_prefix, self.shard_index, SHARD_EXTENSION))
+
+    def _open_shard(self):
+        self._tmp_path = self._get_shard_path() + '.tmp'
+        self._tar = tarfile.open(self._tmp_path, 'w', format=tarfile.USTAR_FORMAT)
+        self._records = []
+
+    def _close_shard(self):
+        if self._tar is None:
+            return
+        self._tar.close()
+        shard_path = self._get_shard_path()
+        index_path = shard_path[:-len(SHARD_EXTENSION)] + INDEX_EXTENSION
+        with open(index_path + '.tmp', 'w') as f:
+            for record in self._records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        os.rename(self._tmp_path, shard_path)
+        os.rename(index_path + '.tmp', index_path)
+        self.shard_paths.append(shard_path)
+        self.shard_index += 1
+        self._tar = None
+
+    def _add_member(self, name, data, record):
+        tar_info = tarfile.TarInfo(name)
+        tar_info.size = len(data)
+        tar_info.mtime = time.time()
+        header_size = len(tar_info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors))
+        offset = self._tar.offset + header_size
+        self._tar.addfile(tar_info, io.BytesIO(data))
+        record = dict(record, name=name, offset=offset, size=len(data))
+        self._records.append(record)
+
+    def write(self, key, patch, slide=None, x=None, y=None, level=None, label=None, mask=None, tumor_fraction=None,
+              width=None, height=None):
+        """
+            Same arguments as DirectoryPatchWriter.write(), the patch and its mask always end up in the
+            same shard.
+        """
+        if self._tar is not None and self._tar.offset >= self.max_shard_bytes:
+            self._close_shard()
+        if self._tar is None:
+            self._open_shard()
+
+        record = {'key': key, 'slide': slide, 'x': x, 'y': y, 'level': level, 'label': label,
+                  'tumor_fraction': tumor_fraction, 'width': width, 'height': height}
+        self._add_member(key + self.extension, encode_image(patch, self.image_format), dict(record, kind='patch'))
+        if mask is not None:
+            self._add_member(key + '.mask' + self.extension, encode_image(mask, self.image_format),
+                             dict(record, kind='mask'))
+
+    def close(self):
+        self._close_shard()
+
+
+class ManifestPatchWriter(object):
+    """
+        # ==========================================================================================
+        # Coordinate manifest: records where the patches are instead of their pixels.
+        # ==========================================================================================
+
+        Extraction methods check needs_pixels and skip reading the WSI altogether, close() saves the rows as
+        a MANIFEST_DTYPE structured array (.npy). Patches are read lazily from the slides at training time,
+        see inception/manifest_inputs.py.
+    """
+    needs_pixels = False
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self._rows = []
+
+    def write(self, key, patch, slide=None, x=None, y=None, level=None, label=None, mask=None, tumor_fraction=None,
+              width=None, height=None):
+        assert width and height, 'Manifest rows need the size of the patch: %s' % key
+        self._rows.append((slide, level, x, y, width, height, label,
+                           0.0 if tumor_fraction is None else tumor_fraction))
+
+    def close(self):
+        manifest_dir = os.path.dirname(self.manifest_path)
+        if manifest_dir and not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir, exist_ok=True)
+        # np.save appends .npy to names without it, write through a file object to keep the name
+        with open(self.manifest_path + '.tmp', 'wb') as f:
+            np.save(f, np.array(self._rows, dtype=MANIFEST_DTYPE))
+        os.rename(self.manifest_path + '.tmp', self.manifest_path)
+
+
+def read_manifests(manifest_paths):
+    """
+        Concatenates manifests into a single MANIFEST_DTYPE structured array.
+
+        :param manifest_paths: path of a manifest, a directory of manifests or a list of both
+        :return:
+    """
+    if isinstance(manifest_paths, str):
+        manifest_paths = [manifest_paths]
+    paths = []
+    for manifest_path in manifest_paths:
+        if os.path.isdir(manifest_path):
+            paths.extend(sorted(glob.glob(os.path.join(manifest_path, '*' + MANIFEST_EXTENSION))))
+        else:
+            paths.append(manifest_path)
+    manifests = []
+    for path in paths:
+        rows = np.load(path)
+        manifest = np.zeros(len(rows), dtype=MANIFEST_DTYPE)
+        for name in MANIFEST_DTYPE.names:
+            if name in rows.dtype.names:
+                manifest[name] = rows[name]
+        if 'width' not in rows.dtype.names:
+            # manifests written before the patch size was recorded only hold grid patches
+            manifest['width'], manifest['height'] = utils.PATCH_SIZE_W, utils.PATCH_SIZE_H
+        manifests.append(manifest)
+    if not manifests:
+        return np.zeros(0, dtype=MANIFEST_DTYPE)
+    return np.concatenate(manifests)
+
+
+def get_patch_writer(patch_save_dir, shard_prefix=None, output_format=None, max_shard_bytes=None):
+    """
+        Writer for the configured output format (utils.PATCH_OUTPUT_FORMAT, 'directory', 'shards' or 'manifest').
+
+        :param patch_save_dir: directory to save the patches (or the shards, or the manifest) into
+        :param shard_prefix: prefix of the shards or name of the manifest, e.g. the slide name
+        :param output_format: defaults to utils.PATCH_OUTPUT_FORMAT
+        :param max_shard_bytes: defaults to utils.PATCH_SHARD_BYTES
+        :return:
+    """
+    output_format = utils.PATCH_OUTPUT_FORMAT if output_format is None else output_format
+    if output_format == 'directory':
+        return DirectoryPatchWriter(patch_save_dir)
+    assert output_format in ('shards', 'manifest'), 'Unknown patch output format %s' % output_format
+    assert shard_prefix is not None, 'Shards and manifests need a prefix unique to the writer'
+    if output_format == 'manifest':
+        return ManifestPatchWriter(os.path.join(patch_save_dir, shard_prefix + MANIFEST_EXTENSION))
+    max_shard_bytes = utils.PATCH_SHARD_BYTES if max_shard_bytes is None else max_shard_bytes
+    return ShardPatchWriter(patch_save_dir, shard_prefix, max_shard_bytes=max_shard_bytes)
+
+
+def read_shard_index(shard_path):
+    """
+        :param shard_path: path of a '.tar' shard
+        :return: list of ShardRecord, in the order of the members in the shard
+    """
+    index_path = shard_path[:-len(SHARD_EXTENSION)] + INDEX_EXTENSION
+    records = []
+    with open(index_path) as f:
+        for line in f:
+            entry = json.loads(line)
+            records.append(ShardRecord(shard_path, entry['name'], entry['offset'], entry['size'], entry['key'],
+                                       entry['slide'], entry['x'], entry['y'], entry['level'], entry['label'],
+                                       entry.get('tumor_fraction'), entry['kind']))
+    return records
+
+
+def find_shards(shard_dir):
+    """
+        Complete shards of a directory (shards of a crashed writer are still '.tmp' and are ignored).
+    """
+    shard_paths = glob.glob(os.path.join(shard_dir, '*' + SHARD_EXTENSION))
+    shard_paths.sort()
+    return shard_paths
+
+
+class ShardPatchReader(object):
+    """
+        Random and sequential access to the patches of one or more directories of shards through their indices.
+    """
+
+    def __init__(self, shard_dirs, kind='patch'):
+        """
+
+        :param shard_dirs: directory or list of directories holding the shards
+        :param kind: 'patch' or 'mask' to only keep those members, None keeps all of them
+        """
+        if isinstance(shard_dirs, str):
+            shard_dirs = [shard_dirs]
+        self.records = []
+        for shard_dir in shard_dirs:
+            for shard_path in find_shards(shard_dir):
+                self.records.extend(record for record in read_shard_index(shard_path)
+                                    if kind is None or record.kind == kind)
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def read_bytes(self, record):
+        # positional reads, several threads can share the reader
+        with self._lock:
+            fd = self._files.get(record.shard_path)
+            if fd is None:
+                fd = self._files[record.shard_path] = os.open(record.shard_path, os.O_RDONLY)
+        return os.pread(fd, record.size, record.offset)
+
+    def read_image(self, record):
+        return Image.open(io.BytesIO(self.read_bytes(record)))
+
+    def iter_samples(self):
+        """
+            Yields (record, bytes) shard by shard, each shard is read sequentially.
+        """
+        for record in sorted(self.records, key=lambda r: (r.shard_path, r.offset)):
+            yield record, self.read_bytes(record)
+
+    def close(self):
+        with self._lock:
+            for fd in self._files.values():
+                os.close(fd)
+            self._files = {}
@@ -0,0 +1,69 @@
+"""Tests for patch_writer."""
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from camelyon16.ops.patch_writer import ShardPatchReader, ShardPatchWriter, find_shards
+
+
+class ShardPatchWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shard_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.patches = [rng.randint(0, 255, size=(32, 48, 3)).astype(np.uint8) for _ in range(6)]
+
+    def tearDown(self):
+        shutil.rmtree(self.shard_dir)
+
+    def _write(self, max_shard_bytes):
+        writer = ShardPatchWriter(self.shard_dir, 'Tumor_001', max_shard_bytes=max_shard_bytes, image_format='PNG',
+                                  extension='.png')
+        for i, patch in enumerate(self.patches):
+            writer.write('Tumor_001_%d_0' % (i * 100), patch, slide='Tumor_001', x=i * 100, y=0, level=1, label=1,
+                         mask=np.full((32, 48), 255, dtype=np.uint8))
+        writer.close()
+
+    def testRoundTrip(self):
+        self._write(max_shard_bytes=1 << 30)
+        self.assertEqual(len(find_shards(self.shard_dir)), 1)
+
+        reader = ShardPatchReader(self.shard_dir)
+        self.assertEqual(len(reader), len(self.patches))
+        for record, patch in zip(reader.records, self.patches):
+            self.assertEqual(record.slide, 'Tumor_001')
+            self.assertEqual(record.label, 1)
+            np.testing.assert_array_equal(np.array(reader.read_image(record)), patch)
+        reader.close()
+
+    def testOffsetsMatchTarMembers(self):
+        self._write(max_shard_bytes=1 << 30)
+        reader = ShardPatchReader(self.shard_dir, kind=None)
+        with tarfile.open(find_shards(self.shard_dir)[0]) as tar:
+            for record in reader.records:
+                self.assertEqual(tar.extractfile(record.name).read(), reader.read_bytes(record))
+        self.assertEqual(len(reader.records), 2 * len(self.patches))
+        reader.close()
+
+    def testShardsAreSizeBounded(self):
+        self._write(max_shard_bytes=8 * 1024)
+        shard_paths = find_shards(self.shard_dir)
+        self.assertGreater(len(shard_paths), 1)
+        self.assertFalse([f for f in os.listdir(self.shard_dir) if f.endswith('.tmp')])
+
+        reader = ShardPatchReader(self.shard_dir)
+        keys = [record.key for record in reader.records]
+        self.assertEqual(keys, ['Tumor_001_%d_0' % (i * 100) for i in range(len(self.patches))])
+        for record, _ in reader.iter_samples():
+            Image.open(io.BytesIO(reader.read_bytes(record))).verify()
+        reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
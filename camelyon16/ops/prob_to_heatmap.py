@@ -6,12 +6,15 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from camelyon16 import utils as utils
+from camelyon16.ops.ensemble_merge import merge_threshold
+from camelyon16.ops.heatmap_store import read_heatmap_prob
 
 
 def prob_to_heatmap(prob, heatmap_path):
-    prob = np.array(prob[:, :, :1], np.float32)
-    prob_2d = np.reshape(prob, (prob.shape[0], prob.shape[1]))
-    prob_2d /= 255
+    """
+        :param prob: (rows, cols) probabilities, e.g. read_heatmap_prob()
+    """
+    prob_2d = np.array(prob, np.float32)
     h_flip_prob = cv2.flip(prob_2d, 0)
     plt.imshow(h_flip_prob, cmap='jet', interpolation='nearest')
     plt.colorbar()
@@ -23,7 +26,7 @@ def prob_to_heatmap(prob, heatmap_path):
 
 if __name__ == '__main__':
     heatmap_prob_paths_first_model = glob.glob(
-        os.path.join(utils.HEAT_MAP_DIR, '*%s*' % '*umor*prob.png'))
+        os.path.join(utils.HEAT_MAP_DIR, '*umor*%s' % utils.HEATMAP_PROB_POSTFIX))
     heatmap_prob_paths_first_model.sort()
 
     for heatmap_prob_path_first_model in heatmap_prob_paths_first_model:
@@ -31,18 +34,16 @@ if __name__ == '__main__':
         wsi_name_tokens = wsi_name.split('_')
         wsi_name = wsi_name_tokens[0] + '_' + wsi_name_tokens[1]
         print('processing: %s' % wsi_name)
+        heatmap_prob_postfix_second_model = '_prob_%s%s' % (utils.SECOND_HEATMAP_MODEL, utils.HEATMAP_STORE_EXT)
         heatmap_prob_path_second_model = glob.glob(
-            os.path.join(utils.HEAT_MAP_DIR, '*%s*%s' % (wsi_name, '_prob_%s.png' % utils.SECOND_HEATMAP_MODEL)))
-        heatmap_prob_second_model = cv2.imread(heatmap_prob_path_second_model[0])
-        heatmap_prob_first_model = cv2.imread(heatmap_prob_path_first_model)
+            os.path.join(utils.HEAT_MAP_DIR, '*%s*%s' % (wsi_name, heatmap_prob_postfix_second_model)))
+        heatmap_prob_second_model = read_heatmap_prob(heatmap_prob_path_second_model[0])
+        heatmap_prob_first_model = read_heatmap_prob(heatmap_prob_path_first_model)
 
-        for row in range(heatmap_prob_first_model.shape[0]):
-            for col in range(heatmap_prob_first_model.shape[1]):
-                if heatmap_prob_first_model[row, col, 0] >= 0.70 * 255 and \
-                                heatmap_prob_second_model[row, col, 0] < 0.25 * 255:
-                    heatmap_prob_first_model[row, col, :] = heatmap_prob_second_model[row, col, :]
+        heatmap_prob_first_model = merge_threshold(heatmap_prob_first_model, heatmap_prob_second_model,
+                                                   first_min=0.70, second_max=0.25)
 
-        heatmap_path = heatmap_prob_path_first_model.replace('prob', 'heatmap_ensemble')
+        heatmap_path = heatmap_prob_path_first_model.replace(utils.HEATMAP_PROB_POSTFIX, '_heatmap_ensemble.png')
         # print(heatmap_prob_path_first_model)
         # print(heatmap_prob_path_second_model)
         # print(heatmap_path)
@@ -0,0 +1,119 @@
+from math import sqrt
+
+import numpy as np
+from scipy import ndimage
+from skimage.morphology import convex_hull_image
+
+PROPERTIES = ('area', 'perimeter', 'eccentricity', 'extent', 'solidity', 'mean_intensity', 'major_axis_length',
+              'minor_axis_length')
+
+# 8-connectivity, like skimage.measure.label() on 2D images
+CONNECTIVITY = np.ones((3, 3), dtype=bool)
+# skimage.measure.perimeter(neighborhood=4): border pixels are scored by the configuration of their 3 x 3
+# neighbourhood
+PERIMETER_STREL = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]], dtype=bool)
+PERIMETER_KERNEL = np.array([[10, 2, 10], [2, 1, 2], [10, 2, 10]])
+PERIMETER_WEIGHTS = np.zeros(50, dtype=np.float64)
+PERIMETER_WEIGHTS[[5, 7, 15, 17, 25, 27]] = 1
+PERIMETER_WEIGHTS[[21, 33]] = sqrt(2)
+PERIMETER_WEIGHTS[[13, 23]] = (1 + sqrt(2)) / 2
+
+
+def get_crop(heatmap_prob, lowest_threshold):
+    """
+        Bounding box of the pixels >= lowest_threshold. The masks of the higher thresholds are nested inside the
+        one of the lowest, so every labeling runs on this crop instead of the mostly empty heatmap.
+    """
+    rows, cols = np.nonzero(heatmap_prob >= lowest_threshold)
+    if len(rows) == 0:
+        return None
+    return slice(rows.min(), rows.max() + 1), slice(cols.min(), cols.max() + 1)
+
+
+def get_perimeters(mask, labels, count):
+    eroded = ndimage.binary_erosion(mask, PERIMETER_STREL, border_value=0)
+    border = mask & ~eroded
+    # regions are 8-connected components, so the 3 x 3 neighbourhood of a border pixel holds its own region only
+    codes = ndimage.convolve(border.astype(np.uint8), PERIMETER_KERNEL, mode='constant', cval=0)
+    return np.bincount(labels[border], weights=PERIMETER_WEIGHTS[codes[border]], minlength=count + 1)[1:]
+
+
+def get_convex_areas(labels, count):
+    # the convex hulls are the only per region work left, as in regionprops()
+    return np.array([convex_hull_image(labels[region_slice] == index + 1).sum()
+                     for index, region_slice in enumerate(ndimage.find_objects(labels, count))], dtype=np.float64)
+
+
+def get_inertia_eigvals(labels, count):
+    """
+        Eigenvalues l1 >= l2 of the coordinate covariance of every region, as skimage's inertia_tensor_eigvals.
+    """
+    rows, cols = np.nonzero(labels)
+    region = labels[rows, cols]
+    n = np.bincount(region, minlength=count + 1)[1:].astype(np.float64)
+
+    def region_mean(values):
+        return np.bincount(region, weights=values, minlength=count + 1)[1:] / n
+
+    # centered on the region means before squaring, keeps the variances exact on large heatmaps
+    d_row = rows - region_mean(rows)[region - 1]
+    d_col = cols - region_mean(cols)[region - 1]
+    var_row, var_col, cov = region_mean(d_row * d_row), region_mean(d_col * d_col), region_mean(d_row * d_col)
+    half_trace = (var_row + var_col) / 2
+    root = np.sqrt(((var_row - var_col) / 2) ** 2 + cov ** 2)
+    return half_trace + root, np.maximum(half_trace - root, 0)
+
+
+def get_region_properties(mask, intensity, properties):
+    """
+        :param mask: bool mask of one threshold
+        :param intensity: intensity image of mask's shape
+        :param properties: names of PROPERTIES to compute
+        :return: dict property -> float64 array with one value per region, in the order of
+                 skimage.measure.label() / regionprops()
+    """
+    labels, count = ndimage.label(mask, structure=CONNECTIVITY)
+    if count == 0:
+        return {name: np.zeros(0) for name in properties}
+    area = np.bincount(labels.ravel(), minlength=count + 1)[1:].astype(np.float64)
+    region_props = {'area': area}
+
+    if 'perimeter' in properties:
+        region_props['perimeter'] = get_perimeters(mask, labels, count)
+    if 'extent' in properties:
+        bbox_area = np.array([(rows.stop - rows.start) * (cols.stop - cols.start)
+                              for rows, cols in ndimage.find_objects(labels, count)], dtype=np.float64)
+        region_props['extent'] = area / bbox_area
+    if 'solidity' in properties:
+        region_props['solidity'] = area / get_convex_areas(labels, count)
+    if 'mean_intensity' in properties:
+        region_props['mean_intensity'] = np.bincount(labels.ravel(), weights=intensity.ravel(),
+                                                     minlength=count + 1)[1:] / area
+    if {'eccentricity', 'major_axis_length', 'minor_axis_length'} & set(properties):
+        l1, l2 = get_inertia_eigvals(labels, count)
+        region_props['eccentricity'] = np.sqrt(1 - l2 / np.where(l1 == 0, 1, l1)) * (l1 != 0)
+        region_props['major_axis_length'] = 4 * np.sqrt(l1)
+        region_props['minor_axis_length'] = 4 * np.sqrt(l2)
+    return {name: region_props[name] for name in properties}
+
+
+def get_region_features(heatmap_prob, thresholds, properties=PROPERTIES):
+    """
+        Regions of heatmap_prob >= threshold for several thresholds, with the requested properties only. Same
+        values as skimage.measure.label() + regionprops() on every thresholded heatmap, without the per region
+        python objects and lazy properties.
+
+        :param heatmap_prob: (rows, cols) or (rows, cols, 1) heatmap, also the intensity image of mean_intensity
+        :param thresholds: list of thresholds in heatmap_prob's units, pixels >= threshold are tumor
+        :param properties: names of PROPERTIES to compute
+        :return: list with one dict per threshold, property -> float64 array with one value per region
+    """
+    for name in properties:
+        assert name in PROPERTIES, 'Unknown region property %s' % name
+    heatmap_prob = heatmap_prob.reshape(heatmap_prob.shape[:2])
+    crop = get_crop(heatmap_prob, min(thresholds))
+    if crop is None:
+        return [{name: np.zeros(0) for name in properties} for _ in thresholds]
+
+    heatmap_crop = heatmap_prob[crop]
+    return [get_region_properties(heatmap_crop >= threshold, heatmap_crop, properties) for threshold in thresholds]
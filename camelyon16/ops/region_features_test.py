@@ -0,0 +1,45 @@
+"""Tests for region_features."""
+import unittest
+
+import cv2
+import numpy as np
+from skimage.measure import label, regionprops
+
+from camelyon16.ops.region_features import PROPERTIES, get_region_features
+
+# skimage names of the PROPERTIES renamed since 0.19
+SKIMAGE_NAMES = {'mean_intensity': 'intensity_mean', 'major_axis_length': 'axis_major_length',
+                 'minor_axis_length': 'axis_minor_length'}
+
+
+class RegionFeaturesTest(unittest.TestCase):
+
+    def testMatchesRegionprops(self):
+        rng = np.random.RandomState(0)
+        heatmap = cv2.GaussianBlur(rng.uniform(0, 1, size=(300, 200)).astype(np.float32), (0, 0), 3) * 255
+        heatmap_prob = np.clip((heatmap - 110) * 6, 0, 255).astype(np.uint8)
+        thresholds = [229, 128, 10]
+
+        region_features = get_region_features(heatmap_prob[:, :, None], thresholds)
+        for threshold, features in zip(thresholds, region_features):
+            region_props = regionprops(label(heatmap_prob >= threshold), intensity_image=heatmap_prob)
+            self.assertGreater(len(region_props), 0)
+            for name in PROPERTIES:
+                expected = [region[SKIMAGE_NAMES.get(name, name)] for region in region_props]
+                np.testing.assert_allclose(features[name], expected, rtol=1e-9, atol=1e-9, err_msg=name)
+
+    def testRequestedPropertiesOnly(self):
+        heatmap_prob = np.zeros((20, 20), dtype=np.uint8)
+        heatmap_prob[2:5, 3:9] = 240
+        heatmap_prob[10:12, 10:12] = 200
+        features_t90, features_t50, features_empty = get_region_features(heatmap_prob, [229, 128, 250],
+                                                                         properties=('area', 'extent'))
+        self.assertEqual(sorted(features_t90), ['area', 'extent'])
+        np.testing.assert_array_equal(features_t90['area'], [18])
+        np.testing.assert_array_equal(features_t50['area'], [18, 4])
+        np.testing.assert_array_equal(features_t50['extent'], [1, 1])
+        self.assertEqual(len(features_empty['area']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+from collections import namedtuple
+
+import numpy as np
+
+DEFAULT_MAX_READ_BYTES = 64 * 1024 * 1024
+DEFAULT_MIN_FILL = 0.5
+
+# location is in the level 0 reference frame, size in pixels of the read level (like OpenSlide.read_region)
+SuperRead = namedtuple('SuperRead', ['location', 'level', 'size', 'patch_indices', 'offsets'])
+
+
+def plan_super_reads(xs, ys, level, patch_size, downsample=1.0, max_bytes=DEFAULT_MAX_READ_BYTES,
+                     min_fill=DEFAULT_MIN_FILL, bytes_per_pixel=4):
+    """
+        Groups patches into rectangular super-reads. The read level is cut into blocks sized so that a block
+        plus one patch fits in max_bytes, the patches whose origin falls in the same block are read together
+        through the bounding rectangle of their union. A block whose patches cover less than min_fill of that
+        rectangle (sparse tissue) keeps one read per patch, so coalescing never reads much more than the
+        per-patch path.
+
+        :param xs: level 0 x coordinates of the patch origins
+        :param ys: level 0 y coordinates of the patch origins
+        :param level: level the patches are read at
+        :param patch_size: (width, height) of a patch, in pixels of the read level
+        :param downsample: downsample factor of the read level
+        :param max_bytes: memory budget of a single super-read (RGBA pixels)
+        :param min_fill: minimum fraction of a super-read covered by patches
+        :param bytes_per_pixel:
+        :return: list of SuperRead, offsets are the (x, y) of every patch inside the super-read
+    """
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    patch_w, patch_h = int(patch_size[0]), int(patch_size[1])
+    if not len(xs):
+        return []
+
+    # patch origins in the read level, floored like CachedSlide.read_region_array()
+    cols = np.floor(xs / downsample).astype(np.int64)
+    rows = np.floor(ys / downsample).astype(np.int64)
+
+    # square blocks such that (block + patch) x (block + patch) pixels fit in the budget
+    side = int(np.sqrt(max_bytes / float(bytes_per_pixel)))
+    block_w = max(1, side - patch_w)
+    block_h = max(1, side - patch_h)
+
+    block_ids = (rows // block_h) * (int(cols.max() // block_w) + 1) + cols // block_w
+    order = np.argsort(block_ids, kind='stable')
+    boundaries = np.flatnonzero(np.diff(block_ids[order])) + 1
+
+    super_reads = []
+    for indices in np.split(order, boundaries):
+        c0, r0 = cols[indices].min(), rows[indices].min()
+        c1, r1 = cols[indices].max() + patch_w, rows[indices].max() + patch_h
+        fill = len(indices) * patch_w * patch_h / float((c1 - c0) * (r1 - r0))
+        if len(indices) > 1 and fill >= min_fill:
+            offsets = np.stack([cols[indices] - c0, rows[indices] - r0], axis=1)
+            location = (int(round(c0 * downsample)), int(round(r0 * downsample)))
+            super_reads.append(SuperRead(location, level, (int(c1 - c0), int(r1 - r0)), indices, offsets))
+        else:
+            for i in indices:
+                super_reads.append(SuperRead((int(xs[i]), int(ys[i])), level, (patch_w, patch_h), np.array([i]),
+                                             np.zeros((1, 2), dtype=np.int64)))
+    return super_reads
+
+
+def read_region(wsi_image, location, level, size):
+    """
+        RGBA array of a region of an OpenSlide, or of a CachedSlide without the PIL round-trip.
+    """
+    if hasattr(wsi_image, 'read_region_array'):
+        return wsi_image.read_region_array(location, level, size)
+    return np.array(wsi_image.read_region(location, level, size))
+
+
+def read_super_region(wsi_image, super_read):
+    return read_region(wsi_image, super_read.location, super_read.level, super_read.size)
+
+
+def iter_coalesced_patches(wsi_image, xs, ys, level, patch_size, max_bytes=None, min_fill=None):
+    """
+        Reads the patches at (xs[i], ys[i]) through coalesced super-reads.
+
+        :param wsi_image: OpenSlide or CachedSlide
+        :param xs: level 0 x coordinates of the patch origins
+        :param ys: level 0 y coordinates of the patch origins
+        :param level: level to read the patches at
+        :param patch_size: (width, height) of a patch, in pixels of the read level
+        :param max_bytes: memory budget of a single super-read, defaults to DEFAULT_MAX_READ_BYTES
+        :param min_fill: see plan_super_reads(), defaults to DEFAULT_MIN_FILL
+        :return: generator of (i, patch), patch is a (height, width, 4) RGBA view into the super-read, only valid
+                 until the next patch of another super-read is produced unless copied
+    """
+    downsample = wsi_image.level_downsamples[level]
+    super_reads = plan_super_reads(xs, ys, level, patch_size, downsample=downsample,
+                                   max_bytes=DEFAULT_MAX_READ_BYTES if max_bytes is None else max_bytes,
+                                   min_fill=DEFAULT_MIN_FILL if min_fill is None else min_fill)
+    patch_w, patch_h = int(patch_size[0]), int(patch_size[1])
+    for super_read in super_reads:
+        region = read_super_region(wsi_image, super_read)
+        for i, (offset_x, offset_y) in zip(super_read.patch_indices, super_read.offsets):
+            yield int(i), region[offset_y: offset_y + patch_h, offset_x: offset_x + patch_w]
@@ -0,0 +1,40 @@
+"""Tests for region_planner."""
+import unittest
+
+import numpy as np
+
+from camelyon16.ops.array_slide import ArraySlide
+from camelyon16.ops.region_planner import iter_coalesced_patches, plan_super_reads
+
+
+class RegionPlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.slide = ArraySlide(rng.randint(0, 255, size=(400, 500, 4)).astype(np.uint8))
+        grid_x, grid_y = np.meshgrid(np.arange(0, 480, 32), np.arange(0, 380, 32))
+        self.xs, self.ys = grid_x.ravel(), grid_y.ravel()
+
+    def testEveryPatchPlannedOnce(self):
+        super_reads = plan_super_reads(self.xs, self.ys, 0, (32, 32), max_bytes=100 * 100 * 4)
+        indices = np.concatenate([super_read.patch_indices for super_read in super_reads])
+        self.assertEqual(sorted(indices.tolist()), list(range(len(self.xs))))
+        for super_read in super_reads:
+            self.assertLessEqual(super_read.size[0] * super_read.size[1] * 4, 100 * 100 * 4)
+        self.assertLess(len(super_reads), len(self.xs))
+
+    def testCoalescedPatchesMatchPerPatchReads(self):
+        for i, patch in iter_coalesced_patches(self.slide, self.xs, self.ys, 0, (48, 40), max_bytes=200 * 200 * 4):
+            x, y = self.xs[i], self.ys[i]
+            expected = self.slide.read_region_array((x, y), 0, (48, 40))
+            np.testing.assert_array_equal(patch, expected)
+
+    def testSparsePatchesAreReadOneByOne(self):
+        xs, ys = np.array([0, 450]), np.array([0, 350])
+        super_reads = plan_super_reads(xs, ys, 0, (32, 32), max_bytes=1000 * 1000 * 4)
+        self.assertEqual(len(super_reads), 2)
+        self.assertEqual([super_read.size for super_read in super_reads], [(32, 32), (32, 32)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+from PIL import Image
+from openslide import OpenSlide
+
+DEFAULT_TILE_SIZE = 256
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'currsize', 'maxsize'])
+
+
+class CachedSlide(object):
+    """
+        # ==========================================================================
+        # OpenSlide wrapper with a byte-bounded LRU cache of decoded native tiles
+        # ==========================================================================
+
+        read_region() has the same signature and return type as OpenSlide.read_region(). Requests are split
+        along the tile grid of the slide (openslide.level[N].tile-width/-height), every tile is decoded at most
+        once while it stays in the cache and the requested window is assembled from the cached tiles. Any other
+        attribute (level_dimensions, properties, _filename, ...) is forwarded to the wrapped OpenSlide object.
+    """
+
+    def __init__(self, slide, cache_bytes=DEFAULT_CACHE_BYTES):
+        """
+
+        :param slide: path of a WSI or an already opened OpenSlide object
+        :param cache_bytes: upper bound on the memory held by decoded tiles
+        """
+        self._slide = OpenSlide(slide) if isinstance(slide, str) else slide
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._max_cache_bytes = cache_bytes
+        self._lock = threading.Lock()
+        self._tile_sizes = [self._get_tile_size(level) for level in range(self._slide.level_count)]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        if name == '_slide':
+            raise AttributeError(name)
+        return getattr(self._slide, name)
+
+    def _get_tile_size(self, level):
+        properties = self._slide.properties
+        tile_w = properties.get('openslide.level[%d].tile-width' % level, DEFAULT_TILE_SIZE)
+        tile_h = properties.get('openslide.level[%d].tile-height' % level, DEFAULT_TILE_SIZE)
+        return int(tile_w), int(tile_h)
+
+    def _get_tile(self, level, tile_col, tile_row):
+        key = (level, tile_col, tile_row)
+        with self._lock:
+            tile = self._cache.get(key)
+            if tile is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+
+        tile_w, tile_h = self._tile_sizes[level]
+        downsample = self._slide.level_downsamples[level]
+        location = (int(round(tile_col * tile_w * downsample)), int(round(tile_row * tile_h * downsample)))
+        tile = np.array(self._slide.read_region(location, level, (tile_w, tile_h)))
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = tile
+                self._cache_bytes += tile.nbytes
+            while self._cache_bytes > self._max_cache_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= evicted.nbytes
+                self.evictions += 1
+        return tile
+
+    def read_region_array(self, location, level, size):
+        """
+            Same as read_region() but returns the RGBA pixels as a (height, width, 4) uint8 array.
+
+            :param location: (x, y) tuple giving the top left pixel in the level 0 reference frame
+            :param level: the level number
+            :param size: (width, height) tuple giving the region size
+            :return:
+        """
+        width, height = int(size[0]), int(size[1])
+        downsample = self._slide.level_downsamples[level]
+        tile_w, tile_h = self._tile_sizes[level]
+        x = int(location[0] / downsample)
+        y = int(location[1] / downsample)
+
+        region = np.zeros((height, width, 4), dtype=np.uint8)
+        if width <= 0 or height <= 0:
+            return region
+
+        for tile_row in range(y // tile_h, (y + height - 1) // tile_h + 1):
+            for tile_col in range(x // tile_w, (x + width - 1) // tile_w + 1):
+                # intersection of the tile with the requested window, in level coordinates
+                t_x, t_y = tile_col * tile_w, tile_row * tile_h
+                x_start, x_end = max(x, t_x), min(x + width, t_x + tile_w)
+                y_start, y_end = max(y, t_y), min(y + height, t_y + tile_h)
+                tile = self._get_tile(level, tile_col, tile_row)
+                region[y_start - y: y_end - y, x_start - x: x_end - x] = \
+                    tile[y_start - t_y: y_end - t_y, x_start - t_x: x_end - t_x]
+
+        return region
+
+    def read_region(self, location, level, size):
+        return Image.fromarray(self.read_region_array(location, level, size))
+
+    def cache_info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self._cache_bytes, self._max_cache_bytes)
+
+    def print_cache_info(self):
+        info = self.cache_info()
+        total = info.hits + info.misses
+        print('tile cache: %d hits, %d misses (%.1f%% hit rate), %d evictions, %.1f / %.1f MB' %
+              (info.hits, info.misses, 100.0 * info.hits / total if total else 0.0, info.evictions,
+               info.currsize / 1048576.0, info.maxsize / 1048576.0))
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+
+    def close(self):
+        self.clear_cache()
+        self._slide.close()
@@ -0,0 +1,57 @@
+"""Tests for slide_reader."""
+import unittest
+
+import numpy as np
+
+from camelyon16.ops.array_slide import ArraySlide
+from camelyon16.ops.slide_reader import CachedSlide
+
+
+class CachedSlideTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.fake = ArraySlide(rng.randint(0, 255, size=(100, 120, 4)).astype(np.uint8), level_downsamples=(1.0, 2.0),
+                               tile_size=16)
+
+    def testWindowsAcrossTileBoundaries(self):
+        slide = CachedSlide(self.fake, cache_bytes=1024 * 1024)
+        for location, level, size in [((5, 7), 0, (40, 30)), ((0, 0), 0, (16, 16)), ((110, 90), 0, (20, 20)),
+                                      ((10, 6), 1, (25, 19))]:
+            np.testing.assert_array_equal(slide.read_region_array(location, level, size),
+                                          np.array(self.fake.read_region(location, level, size)))
+        self.assertEqual(slide.level_downsamples, (1.0, 2.0))
+
+    def testHitsAndMisses(self):
+        slide = CachedSlide(self.fake, cache_bytes=1024 * 1024)
+        # (5, 7) to (45, 37) touches tile columns 0 - 2 and rows 0 - 2
+        slide.read_region_array((5, 7), 0, (40, 30))
+        self.assertEqual(slide.cache_info()[:3], (0, 9, 0))
+        self.assertEqual(len(self.fake.reads), 9)
+        slide.read_region_array((20, 20), 0, (10, 10))
+        self.assertEqual(slide.cache_info()[:3], (1, 9, 0))
+        self.assertEqual(len(self.fake.reads), 9)
+        self.assertEqual(slide.cache_info().currsize, 9 * 16 * 16 * 4)
+        slide.close()
+        self.assertEqual(slide.cache_info().currsize, 0)
+        self.assertTrue(self.fake.closed)
+
+    def testEvictionIsBoundedByBytes(self):
+        tile_bytes = 16 * 16 * 4
+        slide = CachedSlide(self.fake, cache_bytes=3 * tile_bytes)
+        for col in range(4):
+            slide.read_region_array((col * 16, 0), 0, (16, 16))
+        info = slide.cache_info()
+        self.assertEqual((info.misses, info.evictions, info.currsize), (4, 1, 3 * tile_bytes))
+
+        # the least recently used tile went first: tile 1 is still cached, tile 0 is read again
+        slide.read_region_array((16, 0), 0, (16, 16))
+        self.assertEqual(slide.cache_info().hits, 1)
+        slide.read_region_array((0, 0), 0, (16, 16))
+        info = slide.cache_info()
+        self.assertEqual((info.misses, info.evictions), (5, 2))
+        self.assertLessEqual(info.currsize, info.maxsize)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import os
+from collections import namedtuple
+from xml.etree import ElementTree
+
+import cv2
+import numpy as np
+import tifffile
+
+SyntheticSlide = namedtuple('SyntheticSlide', ['wsi_path', 'mask_path', 'xml_path', 'tissue_polygons',
+                                               'lesion_polygons', 'dimensions'])
+
+BACKGROUND_COLOR = (238, 236, 240)
+# H&E like colors (RGB), the largest channel stays <= 200 so both tissue thresholds of WSIOps pick them up
+TISSUE_COLOR = (196, 120, 176)
+TUMOR_COLOR = (150, 70, 160)
+MASK_VALUE = 1
+
+
+def blob_polygon(rng, center, radius, num_vertices=64, roughness=0.15):
+    """
+        Closed irregular blob around center: a circle whose radius is modulated by a few random harmonics.
+
+        :return: (num_vertices, 2) float array of level 0 (x, y) vertices
+    """
+    angles = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+    radii = np.ones(num_vertices)
+    for harmonic in range(2, 5):
+        radii += roughness / (harmonic - 1) * np.sin(harmonic * angles + rng.uniform(0, 2 * np.pi))
+    radii *= radius
+    return np.stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)], axis=1)
+
+
+def generate_polygons(width, height, num_tissue_blobs=3, num_lesions=2, seed=0):
+    """
+        Random tissue blobs inside the slide and lesions inside the tissue blobs.
+
+        :return: tissue_polygons, lesion_polygons (lists of (n, 2) level 0 vertex arrays)
+    """
+    rng = np.random.RandomState(seed)
+    side = min(width, height)
+    tissue_polygons = []
+    for _ in range(num_tissue_blobs):
+        radius = rng.uniform(0.12, 0.22) * side
+        center = (rng.uniform(radius * 1.2, width - radius * 1.2), rng.uniform(radius * 1.2, height - radius * 1.2))
+        tissue_polygons.append((center, radius, blob_polygon(rng, center, radius)))
+
+    lesion_polygons = []
+    for i in range(num_lesions):
+        center, radius, _ = tissue_polygons[i % num_tissue_blobs]
+        offset = rng.uniform(0, 0.4 * radius, size=2) * rng.choice([-1, 1], size=2)
+        lesion_radius = rng.uniform(0.1, 0.3) * radius
+        lesion_polygons.append(blob_polygon(rng, (center[0] + offset[0], center[1] + offset[1]), lesion_radius,
+                                            roughness=0.1))
+    return [polygon for _, _, polygon in tissue_polygons], lesion_polygons
+
+
+def fill_polygons(shape, polygons, origin, downsample, value=1):
+    """
+        Rasterizes the level 0 polygons into an array of the given shape whose top left pixel is origin
+        (level coordinates) at the given downsample.
+    """
+    mask = np.zeros(shape, dtype=np.uint8)
+    height, width = shape
+    for polygon in polygons:
+        points = polygon / downsample - np.array(origin, dtype=np.float64)
+        if points[:, 0].max() < 0 or points[:, 1].max() < 0 or points[:, 0].min() >= width or \
+                points[:, 1].min() >= height:
+            continue
+        # 4 fractional bits keep the outline consistent across levels
+        cv2.fillPoly(mask, [np.round(points * 16).astype(np.int32)], value, lineType=cv2.LINE_8, shift=4)
+    return mask
+
+
+def get_level_dimensions(width, height, levels):
+    return [(int(np.ceil(width / 2.0 ** level)), int(np.ceil(height / 2.0 ** level))) for level in range(levels)]
+
+
+def write_pyramidal_tiff(path, width, height, tile_fn, tile_size=256, levels=None, channels=3,
+                         compression='zlib'):
+    """
+        Writes a tiled TIFF pyramid (downsample 2 between levels) that OpenSlide opens as a generic tiled TIFF.
+        Tiles are produced one at a time, the full resolution image never lives in memory.
+
+        :param path:
+        :param width: level 0 width
+        :param height: level 0 height
+        :param tile_fn: tile_fn(level, x, y, tile_width, tile_height) -> uint8 array (tile_height, tile_width[, 3]),
+                        x, y are level coordinates of the top left pixel of the tile
+        :param tile_size:
+        :param levels: number of levels, defaults to halving until the level fits in 1024 pixels
+        :param channels: 3 for RGB, 1 for a single channel mask
+        :param compression: tifffile compression, zlib is used at its fastest level
+    """
+    if levels is None:
+        levels = 1
+        while max(width, height) / 2.0 ** (levels - 1) > 1024:
+            levels += 1
+
+    with tifffile.TiffWriter(path, bigtiff=True) as tiff:
+        for level, (level_width, level_height) in enumerate(get_level_dimensions(width, height, levels)):
+            shape = (level_height, level_width, 3) if channels == 3 else (level_height, level_width)
+
+            def tiles(level=level, level_width=level_width, level_height=level_height):
+                for y in range(0, level_height, tile_size):
+                    for x in range(0, level_width, tile_size):
+                        yield tile_fn(level, x, y, tile_size, tile_size)
+
+            tiff.write(tiles(), shape=shape, dtype=np.uint8, tile=(tile_size, tile_size),
+                       photometric='rgb' if channels == 3 else 'minisblack', compression=compression,
+                       compressionargs={'level': 1} if compression == 'zlib' else None,
+                       subfiletype=0 if level == 0 else 1)
+
+
+def write_annotation_xml(path, polygons, group_name='_0'):
+    """
+        Lesion annotations in the ASAP XML format of the CAMELYON16 ground truth.
+    """
+    root = ElementTree.Element('ASAP_Annotations')
+    annotations = ElementTree.SubElement(root, 'Annotations')
+    for i, polygon in enumerate(polygons):
+        annotation = ElementTree.SubElement(annotations, 'Annotation', Name='_%d' % i, Type='Polygon',
+                                            PartOfGroup=group_name, Color='#F4FA58')
+        coordinates = ElementTree.SubElement(annotation, 'Coordinates')
+        for order, (x, y) in enumerate(polygon):
+            ElementTree.SubElement(coordinates, 'Coordinate', Order=str(order), X='%.4f' % x, Y='%.4f' % y)
+    groups = ElementTree.SubElement(root, 'AnnotationGroups')
+    group = ElementTree.SubElement(groups, 'Group', Name=group_name, PartOfGroup='None', Color='#FF0000')
+    ElementTree.SubElement(group, 'Attributes')
+    ElementTree.ElementTree(root).write(path, xml_declaration=True, encoding='utf-8')
+
+
+def read_annotation_xml(path):
+    """
+        :return: list of (n, 2) level 0 vertex arrays, one per annotation
+    """
+    polygons = []
+    for annotation in ElementTree.parse(path).getroot().iter('Annotation'):
+        coordinates = sorted(annotation.iter('Coordinate'), key=lambda c: int(c.get('Order')))
+        polygons.append(np.array([[float(c.get('X')), float(c.get('Y'))] for c in coordinates]))
+    return polygons
+
+
+def generate_synthetic_slide(save_dir, name='Tumor_001', width=16384, height=16384, tile_size=256, levels=None,
+                             num_tissue_blobs=3, num_lesions=2, seed=0, with_mask=True, compression='zlib'):
+    """
+        Writes '<name>.tif' (RGB pyramid), and for slides with lesions '<name>_Mask.tif' (single channel pyramid,
+        MASK_VALUE inside lesions) and '<name>.xml' (ASAP annotations of the same lesions) into save_dir.
+
+        :param save_dir:
+        :param name: slide name, e.g. 'Tumor_001' or 'Normal_001'
+        :param width: level 0 width
+        :param height: level 0 height
+        :param tile_size: TIFF tile size
+        :param levels: number of pyramid levels, see write_pyramidal_tiff()
+        :param num_tissue_blobs:
+        :param num_lesions: 0 for a Normal slide
+        :param seed: makes the slide reproducible
+        :param with_mask: write the tumor mask
+        :param compression: tifffile compression of the slide and the mask
+        :return: SyntheticSlide
+    """
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+    tissue_polygons, lesion_polygons = generate_polygons(width, height, num_tissue_blobs, num_lesions, seed)
+
+    def slide_tile(level, x, y, tile_width, tile_height):
+        downsample = 2.0 ** level
+        tissue = fill_polygons((tile_height, tile_width), tissue_polygons, (x, y), downsample)
+        tumor = fill_polygons((tile_height, tile_width), lesion_polygons, (x, y), downsample) & tissue
+        tile_rng = np.random.RandomState((seed * 1000003 + level * 7919 + y * 31 + x) % (2 ** 32))
+        noise = tile_rng.randint(-24, 8, size=(tile_height, tile_width, 1))
+        tile = np.empty((tile_height, tile_width, 3), dtype=np.int16)
+        tile[:] = BACKGROUND_COLOR
+        tile[tissue != 0] = TISSUE_COLOR
+        tile[tumor != 0] = TUMOR_COLOR
+        tile += np.where(tissue[:, :, None] != 0, noise, noise // 8)
+        return np.clip(tile, 0, 255).astype(np.uint8)
+
+    def mask_tile(level, x, y, tile_width, tile_height):
+        downsample = 2.0 ** level
+        tissue = fill_polygons((tile_height, tile_width), tissue_polygons, (x, y), downsample)
+        return fill_polygons((tile_height, tile_width), lesion_polygons, (x, y), downsample, MASK_VALUE) & \
+            (tissue * MASK_VALUE)
+
+    wsi_path = os.path.join(save_dir, name + '.tif')
+    write_pyramidal_tiff(wsi_path, width, height, slide_tile, tile_size, levels, compression=compression)
+
+    mask_path, xml_path = None, None
+    if lesion_polygons:
+        xml_path = os.path.join(save_dir, name + '.xml')
+        write_annotation_xml(xml_path, lesion_polygons)
+        if with_mask:
+            mask_path = os.path.join(save_dir, name + '_Mask.tif')
+            write_pyramidal_tiff(mask_path, width, height, mask_tile, tile_size, levels, channels=1,
+                                 compression=compression)
+
+    return SyntheticSlide(wsi_path, mask_path, xml_path, tissue_polygons, lesion_polygons, (width, height))
@@ -0,0 +1,52 @@
+"""Tests for synthetic_wsi."""
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from openslide import OpenSlide
+
+from camelyon16.ops.synthetic_wsi import MASK_VALUE, TUMOR_COLOR, fill_polygons, generate_synthetic_slide, \
+    get_level_dimensions, read_annotation_xml
+
+
+class SyntheticWSITest(unittest.TestCase):
+
+    def setUp(self):
+        self.save_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.save_dir)
+        self.slide = generate_synthetic_slide(self.save_dir, width=1000, height=700, tile_size=128, levels=3,
+                                              num_lesions=2, seed=3)
+
+    def testPyramidOpensWithExpectedLevels(self):
+        expected_dimensions = get_level_dimensions(1000, 700, 3)
+        self.assertEqual(expected_dimensions, [(1000, 700), (500, 350), (250, 175)])
+        for path in (self.slide.wsi_path, self.slide.mask_path):
+            wsi = OpenSlide(path)
+            self.assertEqual(list(wsi.level_dimensions), expected_dimensions)
+            np.testing.assert_allclose(wsi.level_downsamples, [1, 2, 4])
+            wsi.close()
+
+    def testMaskMatchesLesions(self):
+        wsi_mask = OpenSlide(self.slide.mask_path)
+        mask = np.array(wsi_mask.read_region((0, 0), 2, wsi_mask.level_dimensions[2]))[:, :, 0]
+        wsi_mask.close()
+        tissue = fill_polygons(mask.shape, self.slide.tissue_polygons, (0, 0), 4)
+        lesions = fill_polygons(mask.shape, self.slide.lesion_polygons, (0, 0), 4) & tissue
+        np.testing.assert_array_equal(mask, lesions * MASK_VALUE)
+        self.assertGreater(lesions.sum(), 0)
+
+        # lesion pixels of the slide have the tumor color, up to the noise
+        wsi_image = OpenSlide(self.slide.wsi_path)
+        image = np.array(wsi_image.read_region((0, 0), 2, wsi_image.level_dimensions[2]))[:, :, :3]
+        wsi_image.close()
+        mean_color = image[lesions != 0].mean(axis=0)
+        self.assertTrue(np.all(np.abs(mean_color - np.array(TUMOR_COLOR)) < 12))
+
+        annotations = read_annotation_xml(self.slide.xml_path)
+        self.assertEqual(len(annotations), 2)
+        np.testing.assert_allclose(annotations[0], self.slide.lesion_polygons[0], atol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import shutil
+from collections import namedtuple
+
+import cv2
+import numpy as np
+from openslide import OpenSlide, OpenSlideUnsupportedFormatError
+
+import camelyon16.utils as utils
+
+CACHE_VERSION = 1
+
+TissueMask = namedtuple('TissueMask', ['image_open', 'bounding_boxes', 'level_used', 'level_dimensions',
+                                       'level_downsamples'])
+
+
+def threshold_tissue(rgb_image, lower_hsv=(20, 20, 20), upper_hsv=(200, 200, 200), close_size=20, open_size=5):
+    """
+        HSV threshold followed by a morphological close and open, returns a 0/255 single channel mask.
+    """
+    # hsv -> 3 channel
+    hsv = cv2.cvtColor(rgb_image, cv2.COLOR_BGR2HSV)
+    # mask -> 1 channel
+    mask = cv2.inRange(hsv, np.array(lower_hsv), np.array(upper_hsv))
+
+    close_kernel = np.ones((close_size, close_size), dtype=np.uint8)
+    image_close = cv2.morphologyEx(np.array(mask), cv2.MORPH_CLOSE, close_kernel)
+    open_kernel = np.ones((open_size, open_size), dtype=np.uint8)
+    image_open = cv2.morphologyEx(np.array(image_close), cv2.MORPH_OPEN, open_kernel)
+    return image_open
+
+
+def get_bounding_boxes(image_open):
+    contours, _ = cv2.findContours(image_open, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return [cv2.boundingRect(c) for c in contours]
+
+
+class TissueMaskCache(object):
+    """
+        # ==========================================================================================
+        # Content addressed on-disk cache of tissue masks (image_open), ROI bounding boxes and the
+        # pyramid metadata of the slide they were computed from.
+        # ==========================================================================================
+
+        Entries are keyed by the slide path, its mtime and size and the threshold parameters, so
+        editing or replacing a slide, or changing a threshold, transparently produces a new entry.
+        Each entry is a directory holding the bit-packed mask (image_open.npy) and meta.json.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def get_key(wsi_path, params):
+        stat = os.stat(wsi_path)
+        key_source = json.dumps({'version': CACHE_VERSION,
+                                 'path': os.path.realpath(wsi_path),
+                                 'mtime_ns': stat.st_mtime_ns,
+                                 'size': stat.st_size,
+                                 'params': params}, sort_keys=True)
+        return hashlib.sha1(key_source.encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry_dir, 'meta.json')) as f:
+                meta = json.load(f)
+            packed = np.load(os.path.join(entry_dir, 'image_open.npy'))
+        except (IOError, OSError, ValueError):
+            return None
+
+        height, width = meta['shape']
+        image_open = np.unpackbits(packed, count=height * width).reshape((height, width)) * np.uint8(255)
+        return TissueMask(image_open, [tuple(bbox) for bbox in meta['bounding_boxes']], meta['level_used'],
+                          [tuple(dim) for dim in meta['level_dimensions']], meta['level_downsamples'])
+
+    def save(self, key, tissue_mask, wsi_path, params):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # write into a private directory first and rename it, so readers never see half written entries
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = '%s.tmp-%d' % (entry_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, 'image_open.npy'), np.packbits(tissue_mask.image_open > 0))
+        meta = {'wsi_path': wsi_path,
+                'params': params,
+                'shape': list(tissue_mask.image_open.shape),
+                'bounding_boxes': [list(map(int, bbox)) for bbox in tissue_mask.bounding_boxes],
+                'level_used': tissue_mask.level_used,
+                'level_dimensions': [list(dim) for dim in tissue_mask.level_dimensions],
+                'level_downsamples': list(tissue_mask.level_downsamples)}
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get(self, wsi_path, params, compute_fn):
+        key = self.get_key(wsi_path, params)
+        tissue_mask = self.load(key)
+        if tissue_mask is None:
+            tissue_mask = compute_fn()
+            self.save(key, tissue_mask, wsi_path, params)
+        return tissue_mask
+
+
+def compute_tissue_mask(wsi_path, level=None, lower_hsv=(20, 20, 20), upper_hsv=(200, 200, 200),
+                        close_size=20, open_size=5, rgb_image=None):
+    try:
+        wsi_image = OpenSlide(wsi_path)
+    except OpenSlideUnsupportedFormatError:
+        raise ValueError('Exception: OpenSlideUnsupportedFormatError for %s' % wsi_path)
+
+    level_used = wsi_image.level_count - 1 if level is None else level
+    if rgb_image is None:
+        rgb_image = np.array(wsi_image.read_region((0, 0), level_used, wsi_image.level_dimensions[level_used]))
+    level_dimensions = wsi_image.level_dimensions
+    level_downsamples = wsi_image.level_downsamples
+    wsi_image.close()
+
+    image_open = threshold_tissue(rgb_image, lower_hsv, upper_hsv, close_size, open_size)
+    return TissueMask(image_open, get_bounding_boxes(image_open), level_used, level_dimensions, level_downsamples)
+
+
+def load_tissue_mask(wsi_path, level=None, lower_hsv=(20, 20, 20), upper_hsv=(200, 200, 200), close_size=20,
+                     open_size=5, rgb_image=None, cache_dir=None):
+    """
+        Tissue mask of a WSI, read from the cache when available and computed (and stored) otherwise.
+
+        :param wsi_path:
+        :param level: pyramid level to threshold, None means the lowest resolution level
+        :param lower_hsv: lower bound of the HSV threshold
+        :param upper_hsv: upper bound of the HSV threshold
+        :param close_size: size of the morphological close kernel
+        :param open_size: size of the morphological open kernel
+        :param rgb_image: already decoded image of the requested level, avoids decoding it again on a miss
+        :param cache_dir: defaults to utils.TISSUE_MASK_CACHE_DIR, caching is disabled if both are None
+        :return: TissueMask
+    """
+    params = {'level': 'lowest' if level is None else int(level),
+              'lower_hsv': list(map(int, lower_hsv)),
+              'upper_hsv': list(map(int, upper_hsv)),
+              'close_size': close_size,
+              'open_size': open_size}
+
+    def compute_fn():
+        return compute_tissue_mask(wsi_path, level, lower_hsv, upper_hsv, close_size, open_size, rgb_image)
+
+    cache_dir = utils.TISSUE_MASK_CACHE_DIR if cache_dir is None else cache_dir
+    if cache_dir is None:
+        return compute_fn()
+    return TissueMaskCache(cache_dir).get(wsi_path, params, compute_fn)
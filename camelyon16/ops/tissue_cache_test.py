@@ -0,0 +1,77 @@
+"""Tests for tissue_cache."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from camelyon16.ops.tissue_cache import TissueMask, TissueMaskCache, get_bounding_boxes
+
+PARAMS = {'level': 'lowest', 'lower_hsv': [20, 20, 20], 'upper_hsv': [200, 200, 200], 'close_size': 20,
+          'open_size': 5}
+
+
+class TissueMaskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.wsi_path = os.path.join(self.work_dir, 'Normal_001.tif')
+        with open(self.wsi_path, 'wb') as f:
+            f.write(b'slide')
+        self.cache = TissueMaskCache(os.path.join(self.work_dir, 'cache'))
+
+        # odd sized mask, the packed bits do not end on a byte boundary
+        image_open = np.zeros((37, 53), dtype=np.uint8)
+        image_open[3:20, 5:31] = 255
+        image_open[25:36, 40:52] = 255
+        self.tissue_mask = TissueMask(image_open, get_bounding_boxes(image_open), 7,
+                                      [(53 * 128, 37 * 128), (53, 37)], [1.0, 128.0])
+        self.computed = 0
+
+    def compute_fn(self):
+        self.computed += 1
+        return self.tissue_mask
+
+    def testPackedRoundTrip(self):
+        key = self.cache.get_key(self.wsi_path, PARAMS)
+        self.assertIsNone(self.cache.load(key))
+        self.cache.save(key, self.tissue_mask, self.wsi_path, PARAMS)
+
+        loaded = self.cache.load(key)
+        np.testing.assert_array_equal(loaded.image_open, self.tissue_mask.image_open)
+        self.assertEqual(loaded.image_open.dtype, np.uint8)
+        self.assertEqual(sorted(loaded.bounding_boxes), sorted(self.tissue_mask.bounding_boxes))
+        self.assertEqual((loaded.level_used, loaded.level_dimensions, loaded.level_downsamples),
+                         (7, [(53 * 128, 37 * 128), (53, 37)], [1.0, 128.0]))
+        self.assertFalse([name for name in os.listdir(self.cache.cache_dir) if '.tmp' in name])
+
+    def testKeyInvalidation(self):
+        self.cache.get(self.wsi_path, PARAMS, self.compute_fn)
+        self.cache.get(self.wsi_path, PARAMS, self.compute_fn)
+        self.assertEqual(self.computed, 1)
+
+        # other threshold parameters
+        self.cache.get(self.wsi_path, dict(PARAMS, open_size=7), self.compute_fn)
+        self.assertEqual(self.computed, 2)
+
+        # the slide is touched: new mtime, same size
+        stat = os.stat(self.wsi_path)
+        os.utime(self.wsi_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.cache.get(self.wsi_path, PARAMS, self.compute_fn)
+        self.assertEqual(self.computed, 3)
+
+        # the slide is replaced: new size, the mtime is restored
+        mtime_ns = os.stat(self.wsi_path).st_mtime_ns
+        with open(self.wsi_path, 'ab') as f:
+            f.write(b'more')
+        os.utime(self.wsi_path, ns=(mtime_ns, mtime_ns))
+        self.cache.get(self.wsi_path, PARAMS, self.compute_fn)
+        self.assertEqual(self.computed, 4)
+        self.cache.get(self.wsi_path, PARAMS, self.compute_fn)
+        self.assertEqual(self.computed, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
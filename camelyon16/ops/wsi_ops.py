@@ -2,20 +2,24 @@ import sys
 from random import sample
 from PIL import Image
 
-from openslide import OpenSlide, OpenSlideUnsupportedFormatError
+from openslide import OpenSlide, OpenSlideUnsupportedFormatError, PROPERTY_NAME_MPP_X, PROPERTY_NAME_MPP_Y
 import matplotlib.pyplot as plt
-from einops import rearrange
 import numpy as np
 import cv2
 
 import camelyon16.utils as utils
+from camelyon16.ops.grid_sampler import GridSampler, summed_area_table, window_fractions
+from camelyon16.ops.patch_writer import DirectoryPatchWriter
+from camelyon16.ops.region_planner import iter_coalesced_patches
+from camelyon16.ops.slide_reader import CachedSlide
+from camelyon16.ops.tissue_cache import threshold_tissue, load_tissue_mask
 
 
 class PatchExtractor(object):
     @staticmethod
     def extract_positive_patches_from_tumor_region(wsi_image, tumor_gt_mask, level_used,
                                                    bounding_boxes, patch_save_dir, patch_prefix,
-                                                   patch_index, wsi_mask):
+                                                   patch_index, wsi_mask, writer=None):
         """
 
             Extract positive patches targeting annotated tumor region
@@ -29,70 +33,63 @@ class PatchExtractor(object):
             :param patch_save_dir: directory to save patches into
             :param patch_prefix: prefix for patch name
             :param patch_index:
+            :param wsi_mask:
+            :param writer: patch writer (see ops/patch_writer.py), defaults to one file per patch in patch_save_dir
             :return:
         """
 
-        mag_factor = pow(2, level_used)
+        mag_factor = WSIOps.get_mag_factor(wsi_image, level_used)
         tumor_gt_mask = cv2.cvtColor(tumor_gt_mask, cv2.COLOR_BGR2GRAY)
-        plt.imshow(tumor_gt_mask)
-        plt.show()
+        grid_sampler = GridSampler(mag_factor, tumor_gt_mask=tumor_gt_mask)
+        if writer is None:
+            writer = DirectoryPatchWriter(patch_save_dir)
         print('No. of ROIs to extract patches from: %d' % len(bounding_boxes))
         slide_filename = wsi_image._filename.split('/')[-1].split('.')[0]
 
         for bounding_box in bounding_boxes:
-            try:
-                b_x_start = int(bounding_box[0])
-                b_y_start = int(bounding_box[1])
-                b_x_end = int(bounding_box[0]) + int(bounding_box[2])
-                b_y_end = int(bounding_box[1]) + int(bounding_box[3])
-
-                width = int(bounding_box[2]) * mag_factor
-                height = int(bounding_box[3]) * mag_factor
-                print('Dimension of the bounding box: {} x {}'.format(height, width))
-                xs = np.arange(start=int(b_x_start * mag_factor), stop=int(b_x_end * mag_factor),
-                               step=utils.PATCH_SIZE_W)
-                ys = np.arange(start=int(b_y_start * mag_factor), stop=int(b_y_end * mag_factor),
-                               step=utils.PATCH_SIZE_H)
-                xv, yv = np.meshgrid(xs, ys)
-                xv_yv = np.stack([xv, yv])
-                xv_yv = list(map(lambda x: tuple(x), list(rearrange(xv_yv, 'd h w -> (h w) d'))))
-                patch_dim_h = int(utils.PATCH_SIZE_H / mag_factor)
-                patch_dim_w = int(utils.PATCH_SIZE_W / mag_factor)
-
-                # Filer the non-tumor patches
-                corners = [(int(x / mag_factor), int(y / mag_factor)) for x, y in xv_yv]
-                xv_yv = [(x, y) for (x, y), (x_c, y_c) in zip(xv_yv, corners)
-                         if np.mean(tumor_gt_mask[y_c: y_c + patch_dim_h, x_c: x_c + patch_dim_w]) > utils.PIXEL_BLACK]
-                print('Kept {} patches out of {}.'.format(len(xv_yv), len(corners)))
-
-                for x, y in xv_yv:
-                    # Read the image
-                    patch = wsi_image.read_region((x, y), utils.LEVEL, (utils.PATCH_SIZE_W, utils.PATCH_SIZE_H))
-                    patch = patch.convert('RGB')
+            width = int(int(bounding_box[2]) * mag_factor)
+            height = int(int(bounding_box[3]) * mag_factor)
+            print('Dimension of the bounding box: {} x {}'.format(height, width))
+            candidates = grid_sampler.get_candidates(bounding_box, utils.PATCH_SIZE_W, utils.PATCH_SIZE_H,
+                                                     overlap=utils.PATCH_OVERLAP)
 
-                    # Save the patch
-                    patch_name = '_'.join([slide_filename, str(x), str(y)]) + '.jpg'
-                    patch.save(patch_save_dir + patch_name, 'JPEG')
+            # Filer the non-tumor patches
+            keep = grid_sampler.select(candidates, min_tumor_fraction=float(utils.PIXEL_BLACK))
+            xv_yv = list(zip(candidates.xs[keep].tolist(), candidates.ys[keep].tolist(),
+                             candidates.tumor_fraction[keep].tolist()))
+            print('Kept {} patches out of {}.'.format(len(xv_yv), len(candidates.xs)))
+
+            for x, y, tumor_fraction in xv_yv:
+                patch_name = '_'.join([slide_filename, str(x), str(y)])
+                if not writer.needs_pixels:
+                    # manifest mode, only the coordinates are recorded
+                    writer.write(patch_name, None, slide=slide_filename, x=x, y=y, level=utils.LEVEL, label=1,
+                                 tumor_fraction=tumor_fraction, width=utils.PATCH_SIZE_W, height=utils.PATCH_SIZE_H)
                     patch_index += 1
-                    patch.close()
+                    continue
 
-                    # Read the corresponding mask
-                    patch_mask = wsi_mask.read_region((x, y), utils.LEVEL, (utils.PATCH_SIZE_W, utils.PATCH_SIZE_H))
-                    patch_mask = patch_mask.convert('RGB')
-                    patch_mask = Image.fromarray(255 * np.array(patch_mask))
+                # Read the image
+                patch = wsi_image.read_region((x, y), utils.LEVEL, (utils.PATCH_SIZE_W, utils.PATCH_SIZE_H))
+                patch = patch.convert('RGB')
 
-                    # Save the patch
-                    patch_mask_name = '_'.join([slide_filename, str(x), str(y)]) + '_mask.jpg'
-                    patch_mask.save(patch_save_dir + patch_mask_name, 'JPEG')
-                    patch_mask.close()
-            except IndexError:
-                continue
+                # Read the corresponding mask
+                patch_mask = wsi_mask.read_region((x, y), utils.LEVEL, (utils.PATCH_SIZE_W, utils.PATCH_SIZE_H))
+                patch_mask = patch_mask.convert('RGB')
+                patch_mask = Image.fromarray(255 * np.array(patch_mask))
+
+                # Save the patch and its mask
+                writer.write(patch_name, patch, slide=slide_filename, x=x, y=y, level=utils.LEVEL, label=1,
+                             mask=patch_mask, tumor_fraction=tumor_fraction, width=utils.PATCH_SIZE_W,
+                             height=utils.PATCH_SIZE_H)
+                patch_index += 1
+                patch.close()
+                patch_mask.close()
         return patch_index
 
     @staticmethod
     def extract_negative_patches_from_normal_wsi(wsi_image, image_open, level_used,
                                                  bounding_boxes, patch_save_dir, patch_prefix,
-                                                 patch_index):
+                                                 patch_index, writer=None):
         """
             Extract negative patches from Normal WSIs
 
@@ -105,55 +102,61 @@ class PatchExtractor(object):
             :param patch_save_dir: directory to save patches into
             :param patch_prefix: prefix for patch name
             :param patch_index:
+            :param writer: patch writer (see ops/patch_writer.py), defaults to one file per patch in patch_save_dir
             :return:
 
         """
 
-        mag_factor = pow(2, level_used)
+        mag_factor = WSIOps.get_mag_factor(wsi_image, level_used)
+        grid_sampler = GridSampler(mag_factor, image_open=image_open)
+        if writer is None:
+            writer = DirectoryPatchWriter(patch_save_dir)
 
         print('No. of ROIs to extract patches from: %d' % len(bounding_boxes))
         slide_filename = wsi_image._filename.split('/')[-1].split('.')[0]
 
         for bounding_box in bounding_boxes:
-            b_x_start = int(bounding_box[0])
-            b_y_start = int(bounding_box[1])
-            b_x_end = int(bounding_box[0]) + int(bounding_box[2])
-            b_y_end = int(bounding_box[1]) + int(bounding_box[3])
-
-            width = int(bounding_box[2]) * mag_factor
-            height = int(bounding_box[3]) * mag_factor
+            width = int(int(bounding_box[2]) * mag_factor)
+            height = int(int(bounding_box[3]) * mag_factor)
             print('Dimension of the bounding box: {} x {}'.format(height, width))
-            xs = np.arange(start=int(b_x_start * mag_factor), stop=int(b_x_end * mag_factor), step=utils.PATCH_SIZE_W)
-            ys = np.arange(start=int(b_y_start * mag_factor), stop=int(b_y_end * mag_factor), step=utils.PATCH_SIZE_H)
-            xv, yv = np.meshgrid(xs, ys)
-            xv_yv = np.stack([xv, yv])
-            xv_yv = list(map(lambda x: tuple(x), list(rearrange(xv_yv, 'd h w -> (h w) d'))))
+            candidates = grid_sampler.get_candidates(bounding_box, utils.PATCH_SIZE_W, utils.PATCH_SIZE_H,
+                                                     overlap=utils.PATCH_OVERLAP)
 
-            # Filer the non-tumor patches
-            centers = [(int((x + utils.PATCH_SIZE_W / 2) / mag_factor), int((y + utils.PATCH_SIZE_H / 2) / mag_factor))
-                       for x, y in xv_yv]
-            xv_yv = [(x, y) for (x, y), (x_c, y_c) in zip(xv_yv, centers)
-                     if int(image_open[y_c, x_c]) is not utils.PIXEL_BLACK]
+            # Filter background patches
+            keep = grid_sampler.select(candidates, min_tissue_fraction=utils.MIN_TISSUE_FRACTION)
+            xv_yv = list(zip(candidates.xs[keep].tolist(), candidates.ys[keep].tolist()))
             if len(xv_yv) > utils.NUM_NEGATIVE_PATCHES_FROM_EACH_BBOX:
                 xv_yv = sample(xv_yv, utils.NUM_NEGATIVE_PATCHES_FROM_EACH_BBOX)
-            print('Kept {} patches out of {}.'.format(len(xv_yv), len(centers)))
+            print('Kept {} patches out of {}.'.format(len(xv_yv), len(candidates.xs)))
 
-            for x, y in xv_yv:
-                patch = wsi_image.read_region((x, y), utils.LEVEL, (utils.PATCH_SIZE_W, utils.PATCH_SIZE_H))
+            if not writer.needs_pixels:
+                # manifest mode, only the coordinates are recorded
+                for x, y in xv_yv:
+                    patch_name = '_'.join([slide_filename, str(x), str(y)])
+                    writer.write(patch_name, None, slide=slide_filename, x=x, y=y, level=utils.LEVEL, label=0,
+                                 tumor_fraction=0.0, width=utils.PATCH_SIZE_W, height=utils.PATCH_SIZE_H)
+                    patch_index += 1
+                continue
+
+            # neighbouring patches are read together through coalesced super-reads
+            for i, patch in iter_coalesced_patches(wsi_image, [x for x, _ in xv_yv], [y for _, y in xv_yv],
+                                                   utils.LEVEL, (utils.PATCH_SIZE_W, utils.PATCH_SIZE_H),
+                                                   max_bytes=utils.COALESCED_READ_BYTES,
+                                                   min_fill=utils.COALESCED_READ_MIN_FILL):
+                x, y = xv_yv[i]
 
                 # Save the patch
-                patch_name = '_'.join([slide_filename, str(x), str(y)]) + '.jpg'
-                patch = patch.convert('RGB')
-                patch.save(patch_save_dir + patch_name, 'JPEG')
+                patch_name = '_'.join([slide_filename, str(x), str(y)])
+                writer.write(patch_name, patch[:, :, :3], slide=slide_filename, x=x, y=y, level=utils.LEVEL,
+                             label=0, tumor_fraction=0.0, width=utils.PATCH_SIZE_W, height=utils.PATCH_SIZE_H)
                 patch_index += 1
-                patch.close()
 
         return patch_index
 
     @staticmethod
     def extract_negative_patches_from_tumor_wsi(wsi_image, tumor_gt_mask, image_open, level_used,
                                                 bounding_boxes, patch_save_dir, patch_prefix,
-                                                patch_index):
+                                                patch_index, writer=None):
         """
             From Tumor WSIs extract negative patches from Normal area (reject tumor area)
             Save extracted patches to desk as .png image files
@@ -166,68 +169,131 @@ class PatchExtractor(object):
             :param patch_save_dir: directory to save patches into
             :param patch_prefix: prefix for patch name
             :param patch_index:
+            :param writer: patch writer (see ops/patch_writer.py), defaults to one file per patch in patch_save_dir
             :return:
 
         """
-        mag_factor = pow(2, level_used)
+        mag_factor = WSIOps.get_mag_factor(wsi_image, level_used)
         tumor_gt_mask = cv2.cvtColor(tumor_gt_mask, cv2.COLOR_BGR2GRAY)
+        grid_sampler = GridSampler(mag_factor, image_open=image_open, tumor_gt_mask=tumor_gt_mask)
+        if writer is None:
+            writer = DirectoryPatchWriter(patch_save_dir)
         print('No. of ROIs to extract patches from: %d' % len(bounding_boxes))
         slide_filename = wsi_image._filename.split('/')[-1].split('.')[0]
 
         for bounding_box in bounding_boxes:
-            try:
-                b_x_start = int(bounding_box[0])
-                b_y_start = int(bounding_box[1])
-                b_x_end = int(bounding_box[0]) + int(bounding_box[2])
-                b_y_end = int(bounding_box[1]) + int(bounding_box[3])
-
-                width = int(bounding_box[2]) * mag_factor
-                height = int(bounding_box[3]) * mag_factor
-                print('Dimension of the bounding box: {} x {}'.format(height, width))
-                xs = np.arange(start=int(b_x_start * mag_factor), stop=int(b_x_end * mag_factor), step=utils.PATCH_SIZE_W)
-                ys = np.arange(start=int(b_y_start * mag_factor), stop=int(b_y_end * mag_factor), step=utils.PATCH_SIZE_W)
-                xv, yv = np.meshgrid(xs, ys)
-                xv_yv = np.stack([xv, yv])
-                xv_yv = list(map(lambda x: tuple(x), list(rearrange(xv_yv, 'd h w -> (h w) d'))))
-
-                # Filer the non-tumor patches
-                centers = [(int((x + utils.PATCH_SIZE_W / 2) / mag_factor), int((y + utils.PATCH_SIZE_H / 2) / mag_factor))
-                           for x, y in xv_yv]
-                corners = [(int(x / mag_factor), int(y / mag_factor)) for x, y in xv_yv]
-                patch_dim_h = int(utils.PATCH_SIZE_H / mag_factor)
-                patch_dim_w = int(utils.PATCH_SIZE_W / mag_factor)
-
-                # Filter background patches
-                xv_yv = [(x, y) for (x, y), (x_c, y_c) in zip(xv_yv, centers) if
-                         int(image_open[y_c, x_c]) is not utils.PIXEL_BLACK]
-
-                xv_yv = [(x, y) for (x, y), (x_c, y_c) in zip(xv_yv, corners) if
-                         np.mean(tumor_gt_mask[y_c: y_c + patch_dim_h, x_c: x_c + patch_dim_w]) == float(utils.PIXEL_BLACK)]
-                if len(xv_yv) > utils.NUM_NEGATIVE_PATCHES_FROM_EACH_BBOX:
-                    xv_yv = sample(xv_yv, utils.NUM_NEGATIVE_PATCHES_FROM_EACH_BBOX)
-                print('Kept {} patches out of {}.'.format(len(xv_yv), len(centers)))
+            width = int(int(bounding_box[2]) * mag_factor)
+            height = int(int(bounding_box[3]) * mag_factor)
+            print('Dimension of the bounding box: {} x {}'.format(height, width))
+            candidates = grid_sampler.get_candidates(bounding_box, utils.PATCH_SIZE_W, utils.PATCH_SIZE_H,
+                                                     overlap=utils.PATCH_OVERLAP)
 
-                for x, y in xv_yv:
-                    patch = wsi_image.read_region((x, y), utils.LEVEL, (utils.PATCH_SIZE_W, utils.PATCH_SIZE_H))
-                    patch = patch.convert('RGB')
+            # Filter background and tumor patches
+            keep = grid_sampler.select(candidates, min_tissue_fraction=utils.MIN_TISSUE_FRACTION,
+                                       max_tumor_fraction=float(utils.PIXEL_BLACK))
+            xv_yv = list(zip(candidates.xs[keep].tolist(), candidates.ys[keep].tolist()))
+            if len(xv_yv) > utils.NUM_NEGATIVE_PATCHES_FROM_EACH_BBOX:
+                xv_yv = sample(xv_yv, utils.NUM_NEGATIVE_PATCHES_FROM_EACH_BBOX)
+            print('Kept {} patches out of {}.'.format(len(xv_yv), len(candidates.xs)))
 
-                    # Save the patch
-                    patch_name = '_'.join([slide_filename, str(x), str(y)]) + '.jpg'
-                    patch.save(patch_save_dir + patch_name, 'JPEG')
+            for x, y in xv_yv:
+                patch_name = '_'.join([slide_filename, str(x), str(y)])
+                if not writer.needs_pixels:
+                    # manifest mode, only the coordinates are recorded
+                    writer.write(patch_name, None, slide=slide_filename, x=x, y=y, level=utils.LEVEL, label=0,
+                                 tumor_fraction=0.0, width=utils.PATCH_SIZE_W, height=utils.PATCH_SIZE_H)
                     patch_index += 1
-                    patch.close()
-            except IndexError:
-                continue
+                    continue
+
+                patch = wsi_image.read_region((x, y), utils.LEVEL, (utils.PATCH_SIZE_W, utils.PATCH_SIZE_H))
+                patch = patch.convert('RGB')
+
+                # Save the patch
+                writer.write(patch_name, patch, slide=slide_filename, x=x, y=y, level=utils.LEVEL, label=0,
+                             tumor_fraction=0.0, width=utils.PATCH_SIZE_W, height=utils.PATCH_SIZE_H)
+                patch_index += 1
+                patch.close()
 
         return patch_index
 
+    @staticmethod
+    def get_heatmap_false_region_candidates(image_open, heatmap_prob, level_used, bounding_boxes,
+                                            tumor_gt_mask=None, max_patches=None, min_spacing=1, mag_factor=None):
+        """
+
+            Low resolution pixels worth a look for hard negative / hard positive mining, computed with boolean
+            algebra over the whole slide instead of a per-pixel loop.
+
+            false positives: tissue pixels inside a bounding box with heatmap_prob >= utils.TUMOR_PROB_THRESHOLD
+                             and whose patch footprint does not touch the low resolution tumor mask
+            false negatives: tissue pixels inside a bounding box with heatmap_prob < utils.TUMOR_PROB_THRESHOLD
+                             and whose patch footprint is at least utils.FALSE_NEGATIVE_MIN_TUMOR_FRACTION tumor
+                             in the low resolution tumor mask
+
+            The low resolution screening only discards pixels, survivors are verified against the full
+            resolution mask by the caller.
+
+            :param image_open: morphological open image of wsi_image
+            :param heatmap_prob: heatmap probabilities in [0, 1]
+            :param level_used:
+            :param bounding_boxes: list of bounding boxes corresponds to ROIs
+            :param tumor_gt_mask: single channel low resolution tumor mask, None for Normal WSIs
+            :param max_patches: budget per category, candidates are sampled at random when exceeded
+            :param min_spacing: keep at most one candidate per min_spacing x min_spacing block of pixels
+            :param mag_factor: downsample of level_used (WSIOps.get_mag_factor()), defaults to pow(2, level_used)
+            :return: (false_positive_rows, false_positive_cols), (false_negative_rows, false_negative_cols)
+        """
+        if mag_factor is None:
+            mag_factor = pow(2, level_used)
+        height = min(image_open.shape[0], heatmap_prob.shape[0])
+        width = min(image_open.shape[1], heatmap_prob.shape[1])
+        if tumor_gt_mask is not None:
+            height = min(height, tumor_gt_mask.shape[0])
+            width = min(width, tumor_gt_mask.shape[1])
+
+        roi = np.zeros((height, width), dtype=bool)
+        for bounding_box in bounding_boxes:
+            x, y, w, h = [int(v) for v in bounding_box]
+            roi[y: y + h, x: x + w] = True
+        roi &= image_open[:height, :width] != utils.PIXEL_BLACK
+        hot = heatmap_prob[:height, :width] >= utils.TUMOR_PROB_THRESHOLD
+
+        patch_dim = max(1, int(np.ceil(utils.PATCH_SIZE / float(mag_factor))))
+        if tumor_gt_mask is not None:
+            tumor = tumor_gt_mask[:height, :width] != utils.PIXEL_BLACK
+            tumor_sat = summed_area_table(tumor)
+            rows, cols = np.nonzero(roi & hot & ~tumor)
+            keep = window_fractions(tumor_sat, rows, cols, patch_dim, patch_dim) == 0.0
+            false_positives = (rows[keep], cols[keep])
+
+            rows, cols = np.nonzero(roi & ~hot & tumor)
+            keep = window_fractions(tumor_sat, rows, cols, patch_dim, patch_dim) >= \
+                utils.FALSE_NEGATIVE_MIN_TUMOR_FRACTION
+            false_negatives = (rows[keep], cols[keep])
+        else:
+            false_positives = np.nonzero(roi & hot)
+            false_negatives = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+        def thin(rows, cols):
+            if min_spacing > 1 and len(rows):
+                cells = (rows // min_spacing) * (width // min_spacing + 1) + cols // min_spacing
+                _, first = np.unique(cells, return_index=True)
+                rows, cols = rows[first], cols[first]
+            if max_patches is not None and len(rows) > max_patches:
+                chosen = np.sort(np.random.choice(len(rows), max_patches, replace=False))
+                rows, cols = rows[chosen], cols[chosen]
+            return rows, cols
+
+        return thin(*false_positives), thin(*false_negatives)
+
     @staticmethod
     def extract_patches_from_heatmap_false_region_tumor(wsi_image, wsi_mask, tumor_gt_mask, image_open,
                                                         heatmap_prob,
                                                         level_used, bounding_boxes,
                                                         patch_save_dir_pos, patch_save_dir_neg,
                                                         patch_prefix_pos, patch_prefix_neg,
-                                                        patch_index):
+                                                        patch_index, max_patches=None, writer_pos=None,
+                                                        writer_neg=None):
         """
 
             From Tumor WSIs extract negative patches from Normal area (reject tumor area)
@@ -245,56 +311,65 @@ class PatchExtractor(object):
             :param patch_prefix_pos: prefix for positive patch name
             :param patch_prefix_neg: prefix for negative patch name
             :param patch_index:
+            :param max_patches: budget of false positive / false negative candidates read from the WSI,
+                                defaults to utils.NUM_HEATMAP_FALSE_PATCHES_PER_WSI
+            :param writer_pos: patch writer for positive patches, defaults to PNG files in patch_save_dir_pos
+            :param writer_neg: patch writer for negative patches, defaults to PNG files in patch_save_dir_neg
             :return:
         """
 
-        mag_factor = pow(2, level_used)
+        mag_factor = WSIOps.get_mag_factor(wsi_image, level_used)
         tumor_gt_mask = cv2.cvtColor(tumor_gt_mask, cv2.COLOR_BGR2GRAY)
+        slide_filename = wsi_image._filename.split('/')[-1].split('.')[0]
+        if writer_pos is None:
+            writer_pos = DirectoryPatchWriter(patch_save_dir_pos, image_format='PNG', extension='')
+        if writer_neg is None:
+            writer_neg = DirectoryPatchWriter(patch_save_dir_neg, image_format='PNG', extension='')
+        if max_patches is None:
+            max_patches = utils.NUM_HEATMAP_FALSE_PATCHES_PER_WSI
         print('No. of ROIs to extract patches from: %d' % len(bounding_boxes))
 
-        for bounding_box in bounding_boxes:
-            b_x_start = int(bounding_box[0])
-            b_y_start = int(bounding_box[1])
-            b_x_end = int(bounding_box[0]) + int(bounding_box[2])
-            b_y_end = int(bounding_box[1]) + int(bounding_box[3])
-            col_cords = np.arange(b_x_start, b_x_end)
-            row_cords = np.arange(b_y_start, b_y_end)
-
-            for row in row_cords:
-                for col in col_cords:
-                    if int(image_open[row, col]) is not utils.PIXEL_BLACK:  # consider pixels from ROI only
-                        # extract patch corresponds to false positives
-                        if heatmap_prob[row, col] >= utils.TUMOR_PROB_THRESHOLD:
-                            if int(tumor_gt_mask[row, col]) == utils.PIXEL_BLACK:
-                                # mask_gt does not contain tumor area
-                                mask = wsi_mask.read_region((col * mag_factor, row * mag_factor), 0,
-                                                            (utils.PATCH_SIZE, utils.PATCH_SIZE))
-                                mask_gt = cv2.cvtColor(np.array(mask), cv2.COLOR_BGR2GRAY)
-                                white_pixel_cnt_gt = cv2.countNonZero(mask_gt)
-                                if white_pixel_cnt_gt == 0:
-                                    patch = wsi_image.read_region((col * mag_factor, row * mag_factor), 0,
-                                                                  (utils.PATCH_SIZE, utils.PATCH_SIZE))
-                                    patch.save(patch_save_dir_neg + patch_prefix_neg + str(patch_index), 'PNG')
-                                    patch_index += 1
-                                    patch.close()
-
-                                mask.close()
-                        # extract patch corresponds to false negatives
-                        elif int(tumor_gt_mask[row, col]) is not utils.PIXEL_BLACK \
-                                and heatmap_prob[row, col] < utils.TUMOR_PROB_THRESHOLD:
-                            # mask_gt does not contain tumor area
-                            mask = wsi_mask.read_region((col * mag_factor, row * mag_factor), 0,
-                                                        (utils.PATCH_SIZE, utils.PATCH_SIZE))
-                            mask_gt = cv2.cvtColor(np.array(mask), cv2.COLOR_BGR2GRAY)
-                            white_pixel_cnt_gt = cv2.countNonZero(mask_gt)
-                            if white_pixel_cnt_gt >= ((utils.PATCH_SIZE * utils.PATCH_SIZE) * 0.85):
-                                patch = wsi_image.read_region((col * mag_factor, row * mag_factor), 0,
-                                                              (utils.PATCH_SIZE, utils.PATCH_SIZE))
-                                patch.save(patch_save_dir_pos + patch_prefix_pos + str(patch_index), 'PNG')
-                                patch_index += 1
-                                patch.close()
-
-                            mask.close()
+        false_positives, false_negatives = PatchExtractor.get_heatmap_false_region_candidates(
+            image_open, heatmap_prob, level_used, bounding_boxes, tumor_gt_mask=tumor_gt_mask,
+            max_patches=max_patches, min_spacing=utils.HEATMAP_FALSE_REGION_MIN_SPACING, mag_factor=mag_factor)
+        print('False positive candidates: %d, false negative candidates: %d' %
+              (len(false_positives[0]), len(false_negatives[0])))
+
+        # extract patch corresponds to false positives
+        for row, col in zip(*false_positives):
+            location = (int(round(col * mag_factor)), int(round(row * mag_factor)))
+            mask = wsi_mask.read_region(location, 0, (utils.PATCH_SIZE, utils.PATCH_SIZE))
+            mask_gt = cv2.cvtColor(np.array(mask), cv2.COLOR_BGR2GRAY)
+            white_pixel_cnt_gt = cv2.countNonZero(mask_gt)
+            if white_pixel_cnt_gt == 0:
+                # mask_gt does not contain tumor area
+                patch = wsi_image.read_region(location, 0, (utils.PATCH_SIZE, utils.PATCH_SIZE)) \
+                    if writer_neg.needs_pixels else None
+                writer_neg.write(patch_prefix_neg + str(patch_index), patch, slide=slide_filename, x=location[0],
+                                 y=location[1], level=0, label=0, tumor_fraction=0.0, width=utils.PATCH_SIZE,
+                                 height=utils.PATCH_SIZE)
+                patch_index += 1
+                if patch is not None:
+                    patch.close()
+            mask.close()
+
+        # extract patch corresponds to false negatives
+        for row, col in zip(*false_negatives):
+            location = (int(round(col * mag_factor)), int(round(row * mag_factor)))
+            mask = wsi_mask.read_region(location, 0, (utils.PATCH_SIZE, utils.PATCH_SIZE))
+            mask_gt = cv2.cvtColor(np.array(mask), cv2.COLOR_BGR2GRAY)
+            white_pixel_cnt_gt = cv2.countNonZero(mask_gt)
+            if white_pixel_cnt_gt >= ((utils.PATCH_SIZE * utils.PATCH_SIZE) * utils.FALSE_NEGATIVE_MIN_TUMOR_FRACTION):
+                patch = wsi_image.read_region(location, 0, (utils.PATCH_SIZE, utils.PATCH_SIZE)) \
+                    if writer_pos.needs_pixels else None
+                writer_pos.write(patch_prefix_pos + str(patch_index), patch, slide=slide_filename, x=location[0],
+                                 y=location[1], level=0, label=1,
+                                 tumor_fraction=white_pixel_cnt_gt / float(utils.PATCH_SIZE * utils.PATCH_SIZE),
+                                 width=utils.PATCH_SIZE, height=utils.PATCH_SIZE)
+                patch_index += 1
+                if patch is not None:
+                    patch.close()
+            mask.close()
 
         return patch_index
 
@@ -304,7 +379,7 @@ class PatchExtractor(object):
                                                          level_used, bounding_boxes,
                                                          patch_save_dir_neg,
                                                          patch_prefix_neg,
-                                                         patch_index):
+                                                         patch_index, max_patches=None, writer=None):
         """
 
             From Tumor WSIs extract negative patches from Normal area (reject tumor area)
@@ -318,31 +393,36 @@ class PatchExtractor(object):
             :param patch_save_dir_neg: directory to save negative patches into
             :param patch_prefix_neg: prefix for negative patch name
             :param patch_index:
+            :param max_patches: budget of false positive candidates read from the WSI,
+                                defaults to utils.NUM_HEATMAP_FALSE_PATCHES_PER_WSI
+            :param writer: patch writer, defaults to PNG files in patch_save_dir_neg
             :return:
         """
 
-        mag_factor = pow(2, level_used)
+        mag_factor = WSIOps.get_mag_factor(wsi_image, level_used)
+        slide_filename = wsi_image._filename.split('/')[-1].split('.')[0]
+        if writer is None:
+            writer = DirectoryPatchWriter(patch_save_dir_neg, image_format='PNG', extension='')
+        if max_patches is None:
+            max_patches = utils.NUM_HEATMAP_FALSE_PATCHES_PER_WSI
         print('No. of ROIs to extract patches from: %d' % len(bounding_boxes))
 
-        for bounding_box in bounding_boxes:
-            b_x_start = int(bounding_box[0])
-            b_y_start = int(bounding_box[1])
-            b_x_end = int(bounding_box[0]) + int(bounding_box[2])
-            b_y_end = int(bounding_box[1]) + int(bounding_box[3])
-            col_cords = np.arange(b_x_start, b_x_end)
-            row_cords = np.arange(b_y_start, b_y_end)
-
-            for row in row_cords:
-                for col in col_cords:
-                    if int(image_open[row, col]) is not utils.PIXEL_BLACK:  # consider pixels from ROI only
-                        # extract patch corresponds to false positives
-                        if heatmap_prob[row, col] >= utils.TUMOR_PROB_THRESHOLD:
-                            # mask_gt does not contain tumor area
-                            patch = wsi_image.read_region((col * mag_factor, row * mag_factor), 0,
-                                                          (utils.PATCH_SIZE, utils.PATCH_SIZE))
-                            patch.save(patch_save_dir_neg + patch_prefix_neg + str(patch_index), 'PNG')
-                            patch_index += 1
-                            patch.close()
+        false_positives, _ = PatchExtractor.get_heatmap_false_region_candidates(
+            image_open, heatmap_prob, level_used, bounding_boxes, max_patches=max_patches,
+            min_spacing=utils.HEATMAP_FALSE_REGION_MIN_SPACING, mag_factor=mag_factor)
+        print('False positive candidates: %d' % len(false_positives[0]))
+
+        # extract patch corresponds to false positives
+        for row, col in zip(*false_positives):
+            location = (int(round(col * mag_factor)), int(round(row * mag_factor)))
+            patch = wsi_image.read_region(location, 0, (utils.PATCH_SIZE, utils.PATCH_SIZE)) \
+                if writer.needs_pixels else None
+            writer.write(patch_prefix_neg + str(patch_index), patch, slide=slide_filename, x=location[0],
+                         y=location[1], level=0, label=0, tumor_fraction=0.0, width=utils.PATCH_SIZE,
+                         height=utils.PATCH_SIZE)
+            patch_index += 1
+            if patch is not None:
+                patch.close()
 
         return patch_index
 
@@ -372,33 +452,48 @@ class WSIOps(object):
         return wsi_mask, mask_image
 
     @staticmethod
-    def read_wsi_normal(wsi_path):
+    def read_wsi_normal(wsi_path, cache_bytes=None, read_rgb=True):
         """
             # =====================================================================================
             # read WSI image and resize
             # Due to memory constraint, we use down sampled (4th level, 1/32 resolution) image
+            # If cache_bytes is given, wsi_image is returned as a CachedSlide (tile-level LRU cache)
+            # With read_rgb=False the down sampled image is not decoded and rgb_image is None
             # ======================================================================================
         """
+        wsi_image = None
         try:
             wsi_image = OpenSlide(wsi_path)
             level_used = wsi_image.level_count - 1
-            rgb_image = np.array(wsi_image.read_region((0, 0), level_used,
-                                                       wsi_image.level_dimensions[level_used]))
+            rgb_image = None
+            if read_rgb:
+                rgb_image = np.array(wsi_image.read_region((0, 0), level_used,
+                                                           wsi_image.level_dimensions[level_used]))
+            if cache_bytes:
+                wsi_image = CachedSlide(wsi_image, cache_bytes)
 
         except OpenSlideUnsupportedFormatError:
             print('Exception: OpenSlideUnsupportedFormatError')
+            WSIOps.close_slides(wsi_image)
             return None, None, None
+        except Exception:
+            WSIOps.close_slides(wsi_image)
+            raise
 
         return wsi_image, rgb_image, level_used
 
     @staticmethod
-    def read_wsi_tumor(wsi_path, mask_path):
+    def read_wsi_tumor(wsi_path, mask_path, cache_bytes=None, read_rgb=True):
         """
             # =====================================================================================
             # read WSI image and resize
             # Due to memory constraint, we use down sampled (4th level, 1/32 resolution) image
+            # If cache_bytes is given, wsi_image and wsi_mask are returned as CachedSlide objects
+            # sharing that budget, utils.TILE_CACHE_MASK_FRACTION of it goes to the mask
+            # With read_rgb=False the down sampled image is not decoded and rgb_image is None
             # ======================================================================================
         """
+        wsi_image, wsi_mask = None, None
         try:
             wsi_image = OpenSlide(wsi_path)
             wsi_mask = OpenSlide(mask_path)
@@ -409,68 +504,151 @@ class WSIOps(object):
             # print(test.shape)
             # plt.imshow(test[:, :, 0])
             # plt.show()
-            rgb_image = np.array(wsi_image.read_region((0, 0), level_used,
-                                                       wsi_image.level_dimensions[level_used]))
-
-            mask_level = min(wsi_mask.level_count - 1, 5)
-            tumor_gt_mask = wsi_mask.read_region((0, 0), mask_level,
-                                                 wsi_image.level_dimensions[mask_level])
-            resize_factor = float(1.0 / pow(2, level_used - mask_level))
-            # print('resize_factor: %f' % resize_factor)
-            tumor_gt_mask = cv2.resize(np.array(tumor_gt_mask), (0, 0), fx=resize_factor, fy=resize_factor)
-
+            rgb_image = None
+            if read_rgb:
+                rgb_image = np.array(wsi_image.read_region((0, 0), level_used,
+                                                           wsi_image.level_dimensions[level_used]))
+
+            # the mask at the resolution of rgb_image, read from the closest level of the mask pyramid
+            level_dimensions = wsi_image.level_dimensions[level_used]
+            tumor_gt_mask = WSIOps.read_region_at(wsi_mask, (0, 0), level_dimensions,
+                                                  downsample=WSIOps.get_mag_factor(wsi_image, level_used),
+                                                  interpolation=cv2.INTER_NEAREST)
+
+            if cache_bytes:
+                mask_cache_bytes = int(cache_bytes * utils.TILE_CACHE_MASK_FRACTION)
+                wsi_image = CachedSlide(wsi_image, cache_bytes - mask_cache_bytes)
+                wsi_mask = CachedSlide(wsi_mask, mask_cache_bytes)
 
             # wsi_mask.close()
         except OpenSlideUnsupportedFormatError:
             print('Exception: OpenSlideUnsupportedFormatError')
-            return None, None, None, None
+            WSIOps.close_slides(wsi_image, wsi_mask)
+            return None, None, None, None, None
+        except Exception:
+            WSIOps.close_slides(wsi_image, wsi_mask)
+            raise
 
         return wsi_image, rgb_image, wsi_mask, tumor_gt_mask, level_used
 
+    @staticmethod
+    def close_slides(*slides):
+        """
+            Closes the OpenSlide / CachedSlide handles that were opened, None entries are skipped.
+        """
+        for slide in slides:
+            if slide is not None:
+                slide.close()
+
+    @staticmethod
+    def get_mag_factor(wsi_image, level):
+        """
+            Factor mapping level coordinates to level 0 coordinates. This is the real downsample of the level, which
+            is not an exact power of two for slides with odd dimensions.
+        """
+        return float(wsi_image.level_downsamples[level])
+
+    @staticmethod
+    def get_mpp(wsi_image):
+        """
+            :return: level 0 microns per pixel (mpp_x, mpp_y), None if the slide does not record them
+        """
+        properties = wsi_image.properties
+        if PROPERTY_NAME_MPP_X not in properties or PROPERTY_NAME_MPP_Y not in properties:
+            return None
+        return float(properties[PROPERTY_NAME_MPP_X]), float(properties[PROPERTY_NAME_MPP_Y])
+
+    @staticmethod
+    def get_best_level_for_downsample(wsi_image, downsample, tolerance=None):
+        """
+            Coarsest level whose downsample does not exceed the requested one, so that only a reduction is left
+            to resize. Levels within tolerance of the request count as exact.
+
+            :param wsi_image: OpenSlide or CachedSlide
+            :param downsample: requested downsample factor (relative to level 0)
+            :param tolerance: relative tolerance, defaults to utils.LEVEL_DOWNSAMPLE_TOLERANCE
+        """
+        tolerance = utils.LEVEL_DOWNSAMPLE_TOLERANCE if tolerance is None else tolerance
+        level_downsamples = np.asarray(wsi_image.level_downsamples, dtype=np.float64)
+        levels = np.flatnonzero(level_downsamples <= downsample * (1.0 + tolerance))
+        return int(levels[-1]) if len(levels) else 0
+
+    @staticmethod
+    def read_region_scaled(wsi_image, location, region_size, size, interpolation=cv2.INTER_AREA):
+        """
+            Reads the level 0 region (location, region_size) and returns it as size pixels. The region is read
+            from the coarsest pyramid level that still has at least the requested resolution and only the
+            remaining factor is resized.
+
+            :param wsi_image: OpenSlide or CachedSlide
+            :param location: (x, y) top left pixel in the level 0 reference frame
+            :param region_size: (width, height) of the region in level 0 pixels
+            :param size: (width, height) of the returned array
+            :param interpolation: cv2 interpolation of the remaining resize, INTER_NEAREST for masks
+            :return: (height, width, 4) uint8 RGBA array
+        """
+        width, height = int(size[0]), int(size[1])
+        downsample = min(region_size[0] / float(width), region_size[1] / float(height))
+        level = WSIOps.get_best_level_for_downsample(wsi_image, downsample)
+        level_downsample = float(wsi_image.level_downsamples[level])
+        read_size = (int(round(region_size[0] / level_downsample)), int(round(region_size[1] / level_downsample)))
+        if abs(read_size[0] - width) <= width * utils.LEVEL_DOWNSAMPLE_TOLERANCE and \
+                abs(read_size[1] - height) <= height * utils.LEVEL_DOWNSAMPLE_TOLERANCE:
+            read_size = (width, height)
+
+        location = (int(location[0]), int(location[1]))
+        if hasattr(wsi_image, 'read_region_array'):
+            region = wsi_image.read_region_array(location, level, read_size)
+        else:
+            region = np.array(wsi_image.read_region(location, level, read_size))
+        if read_size != (width, height):
+            region = cv2.resize(region, (width, height), interpolation=interpolation)
+        return region
+
+    @staticmethod
+    def read_region_at(wsi_image, location, size, downsample=None, mpp=None, interpolation=cv2.INTER_AREA):
+        """
+            Reads size pixels at a target resolution, given either as a downsample factor or in microns per pixel.
+
+            :param wsi_image: OpenSlide or CachedSlide
+            :param location: (x, y) top left pixel in the level 0 reference frame
+            :param size: (width, height) in pixels of the target resolution
+            :param downsample: target downsample factor relative to level 0
+            :param mpp: target microns per pixel, needs the openslide.mpp-x / mpp-y properties of the slide
+            :param interpolation: see read_region_scaled()
+            :return: (height, width, 4) uint8 RGBA array
+        """
+        assert (downsample is None) != (mpp is None), 'Exactly one of downsample and mpp is needed'
+        if mpp is not None:
+            slide_mpp = WSIOps.get_mpp(wsi_image)
+            assert slide_mpp is not None, 'No microns per pixel in the properties of %s' % wsi_image._filename
+            downsample = float(mpp) / slide_mpp[0]
+        region_size = (int(round(size[0] * downsample)), int(round(size[1] * downsample)))
+        return WSIOps.read_region_scaled(wsi_image, location, region_size, size, interpolation=interpolation)
+
     def find_roi_bbox_tumor_gt_mask(self, mask_image):
         mask = cv2.cvtColor(mask_image, cv2.COLOR_BGR2GRAY)
         bounding_boxes, _ = self.get_bbox(np.array(mask))
         return bounding_boxes
 
     def find_roi_bbox(self, rgb_image):
-        # hsv -> 3 channel
-        hsv = cv2.cvtColor(rgb_image, cv2.COLOR_BGR2HSV)
-        lower_red = np.array([40, 40, 40])
-        upper_red = np.array([200, 200, 200])
-        # mask -> 1 channel
-        mask = cv2.inRange(hsv, lower_red, upper_red)
-
-        close_kernel = np.ones((20, 20), dtype=np.uint8)
-        image_close = cv2.morphologyEx(np.array(mask), cv2.MORPH_CLOSE, close_kernel)
-        open_kernel = np.ones((5, 5), dtype=np.uint8)
-        image_open = cv2.morphologyEx(np.array(image_close), cv2.MORPH_OPEN, open_kernel)
+        image_open = threshold_tissue(rgb_image, lower_hsv=(40, 40, 40), upper_hsv=(200, 200, 200))
         bounding_boxes, rgb_contour = self.get_bbox(image_open, rgb_image=rgb_image)
         return bounding_boxes, rgb_contour, image_open
 
     @staticmethod
-    def get_image_open(wsi_path):
-        try:
-            wsi_image = OpenSlide(wsi_path)
-            level_used = wsi_image.level_count - 1
-            rgb_image = np.array(wsi_image.read_region((0, 0), level_used,
-                                                       wsi_image.level_dimensions[level_used]))
-            wsi_image.close()
-        except OpenSlideUnsupportedFormatError:
-            raise ValueError('Exception: OpenSlideUnsupportedFormatError for %s' % wsi_path)
-
-        # hsv -> 3 channel
-        hsv = cv2.cvtColor(rgb_image, cv2.COLOR_BGR2HSV)
-        lower_red = np.array([20, 20, 20])
-        upper_red = np.array([200, 200, 200])
-        # mask -> 1 channel
-        mask = cv2.inRange(hsv, lower_red, upper_red)
-
-        close_kernel = np.ones((20, 20), dtype=np.uint8)
-        image_close = cv2.morphologyEx(np.array(mask), cv2.MORPH_CLOSE, close_kernel)
-        open_kernel = np.ones((5, 5), dtype=np.uint8)
-        image_open = cv2.morphologyEx(np.array(image_close), cv2.MORPH_OPEN, open_kernel)
+    def find_roi_bbox_cached(wsi_path, level_used, rgb_image=None):
+        """
+            Same thresholds as find_roi_bbox(), but the mask and bounding boxes come from the tissue mask
+            cache (utils.TISSUE_MASK_CACHE_DIR). rgb_image, if given, is only used when the entry is missing.
+        """
+        tissue_mask = load_tissue_mask(wsi_path, level=level_used, lower_hsv=(40, 40, 40),
+                                       upper_hsv=(200, 200, 200), rgb_image=rgb_image)
+        return tissue_mask.bounding_boxes, tissue_mask.image_open
 
-        return image_open
+    @staticmethod
+    def get_image_open(wsi_path):
+        return load_tissue_mask(wsi_path, lower_hsv=(20, 20, 20), upper_hsv=(200, 200, 200)).image_open
 
     @staticmethod
     def get_bbox(cont_img, rgb_image=None):
@@ -0,0 +1,64 @@
+"""Tests for the level-aware reads of WSIOps (wsi_ops)."""
+import unittest
+
+import cv2
+import numpy as np
+
+from camelyon16.ops.array_slide import ArraySlide
+from camelyon16.ops.wsi_ops import WSIOps
+
+
+class WSIOpsLevelsTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.slide = self.get_slide(rng.randint(0, 255, size=(256, 256, 4)).astype(np.uint8))
+
+    @staticmethod
+    def get_slide(pixels, mpp=0.25):
+        # three levels of an odd sized scan: the second downsample is not exactly 4
+        levels = [cv2.resize(pixels, (64, 64), interpolation=cv2.INTER_AREA),
+                  cv2.resize(pixels, (16, 16), interpolation=cv2.INTER_AREA)]
+        return ArraySlide(pixels, level_downsamples=(1.0, 3.9998, 16.0), levels=levels, mpp=mpp)
+
+    def testBestLevelForDownsample(self):
+        best_levels = [WSIOps.get_best_level_for_downsample(self.slide, downsample)
+                       for downsample in (0.5, 1, 2, 3.99, 4, 8, 15.5, 16, 100)]
+        # 3.99 is within the tolerance of 3.9998, 15.5 is not within it of 16
+        self.assertEqual(best_levels, [0, 0, 0, 1, 1, 1, 1, 2, 2])
+        self.assertEqual(WSIOps.get_best_level_for_downsample(self.slide, 3.99, tolerance=0), 0)
+        self.assertEqual(WSIOps.get_mag_factor(self.slide, 1), 3.9998)
+
+    def testReadRegionScaled(self):
+        # a native level is read as is
+        region = WSIOps.read_region_scaled(self.slide, (0, 0), (256, 256), (64, 64))
+        np.testing.assert_array_equal(region, self.slide.levels[1])
+        self.assertEqual([read[1:] for read in self.slide.reads], [(1, (64, 64))])
+
+        # in between levels, the finer one is read and reduced
+        region = WSIOps.read_region_scaled(self.slide, (0, 0), (256, 256), (32, 32))
+        np.testing.assert_array_equal(region, cv2.resize(self.slide.levels[1], (32, 32),
+                                                         interpolation=cv2.INTER_AREA))
+        self.assertEqual(self.slide.reads[-1][1:], (1, (64, 64)))
+
+        region = WSIOps.read_region_scaled(self.slide, (64, 32), (96, 48), (48, 24), interpolation=cv2.INTER_NEAREST)
+        self.assertEqual(region.shape, (24, 48, 4))
+        self.assertEqual(self.slide.reads[-1][1:], (0, (96, 48)))
+        np.testing.assert_array_equal(region, self.slide.levels[0][32:80:2, 64:160:2])
+
+    def testReadRegionAt(self):
+        by_downsample = WSIOps.read_region_at(self.slide, (0, 0), (64, 64), downsample=4)
+        # 1 micron per pixel on a 0.25 micron per pixel scan
+        by_mpp = WSIOps.read_region_at(self.slide, (0, 0), (64, 64), mpp=1.0)
+        np.testing.assert_array_equal(by_downsample, self.slide.levels[1])
+        np.testing.assert_array_equal(by_mpp, self.slide.levels[1])
+        self.assertEqual(WSIOps.get_mpp(self.slide), (0.25, 0.25))
+
+        with self.assertRaises(AssertionError):
+            WSIOps.read_region_at(self.slide, (0, 0), (64, 64), downsample=4, mpp=1.0)
+        with self.assertRaises(AssertionError):
+            WSIOps.read_region_at(self.get_slide(self.slide.levels[0], mpp=None), (0, 0), (64, 64), mpp=1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,6 +34,7 @@ import cv2
 import tensorflow as tf
 from camelyon16.inception.dataset import Dataset
 from camelyon16 import utils as utils
+from camelyon16.ops.heatmap_store import write_heatmap_prob
 import matplotlib.pyplot as plt
 
 DATA_SET_NAME = 'TF-Records'
@@ -65,17 +66,14 @@ BATCH_SIZE = 100
 
 
 def assign_prob(heatmap, probabilities, coordinates):
-    global heat_map_prob
+    global heat_map_prob, heat_map_level
+    # coordinates are (row, col, level) in the wsi coordinate system, rows of the heatmap increase from
+    # [bottom -> top] while rows of the wsi increase from [top -> bottom]: row_heatmap = image_height - row_wsi
     height = heatmap.shape[0] - 1
-    for prob, cord in zip(probabilities[:, 1:], coordinates):
-        cord = cord.decode('UTF-8')
-        pixel_pos = cord.split('_')
-        # each cord is in form - 'row_col_level' based on wsi coordinate system
-        # need to transform wsi row coordinate in to heatmap row coordinate because, in heatmap row increases
-        # from [bottom -> top] while in wsi row increases from [top -> bottom]
-        # e.g row_heatmap = image_height - row_wsi
-        heatmap[height - int(pixel_pos[0]), int(pixel_pos[1])] = prob
-        heat_map_prob[int(pixel_pos[0]), int(pixel_pos[1])] = prob
+    rows, cols = coordinates[:, 0], coordinates[:, 1]
+    heatmap[height - rows, cols] = probabilities[:, 1]
+    heat_map_prob[rows, cols] = probabilities[:, 1]
+    heat_map_level = int(coordinates[0, 2])
     return heatmap
 
 
@@ -181,7 +179,7 @@ def generate_all_heatmap(model_name, heatmap_name_postfix, heatmap_prob_name_pos
 
     Failded case: Tumor_20, Tumor_25,
     """
-    global heat_map_prob
+    global heat_map_prob, heat_map_level
     assert model_name in utils.heatmap_models, utils.heatmap_models
     # tf_records_file_names = sorted(os.listdir(utils.HEAT_MAP_TF_RECORDS_DIR))
     # tf_records_file_names = tf_records_file_names[1:]
@@ -209,6 +207,7 @@ def generate_all_heatmap(model_name, heatmap_name_postfix, heatmap_prob_name_pos
         heatmap_rgb = heatmap_rgb[:, :, :3]
         heat_map = np.zeros((heatmap_rgb.shape[0], heatmap_rgb.shape[1]), dtype=np.float32)
         heat_map_prob = np.zeros((heatmap_rgb.shape[0], heatmap_rgb.shape[1]), dtype=np.float32)
+        heat_map_level = None
         # assert os.path.exists(raw_patches_dir), 'raw patches directory %s does not exist' % raw_patches_dir
         # num_patches = len(os.listdir(raw_patches_dir))
         num_patches = utils.n_patches_dic[wsi_filename]
@@ -223,21 +222,27 @@ def generate_all_heatmap(model_name, heatmap_name_postfix, heatmap_prob_name_pos
             plt.savefig(heatmap_filename)
             plt.clf()
 
-        cv2.imwrite(os.path.join(utils.HEAT_MAP_DIR, wsi_filename) + heatmap_prob_name_postfix, heat_map_prob * 255)
+        # heatmap pixel (row, col) is the patch at level 0 (col, row) * pow(2, level) of the heatmap tf-records
+        grid_stride = None if heat_map_level is None else pow(2, heat_map_level)
+        write_heatmap_prob(os.path.join(utils.HEAT_MAP_DIR, wsi_filename) + heatmap_prob_name_postfix, heat_map_prob,
+                           slide_id=wsi_filename, level=heat_map_level, model=model_name, grid_stride=grid_stride,
+                           patch_size=utils.PATCH_SIZE)
 
 
 def build_first_heatmap():
     generate_all_heatmap(utils.FIRST_HEATMAP_MODEL, heatmap_name_postfix='_heatmap.png',
-                         heatmap_prob_name_postfix='_prob.png')
+                         heatmap_prob_name_postfix=utils.HEATMAP_PROB_POSTFIX)
 
 
 def build_second_heatmap():
     generate_all_heatmap(utils.SECOND_HEATMAP_MODEL,
                          heatmap_name_postfix='_heatmap_%s.png' % utils.SECOND_HEATMAP_MODEL,
-                         heatmap_prob_name_postfix='_prob_%s.png' % utils.SECOND_HEATMAP_MODEL)
+                         heatmap_prob_name_postfix='_prob_%s%s' % (utils.SECOND_HEATMAP_MODEL,
+                                                                   utils.HEATMAP_STORE_EXT))
 
 
 if __name__ == '__main__':
     heat_map_prob = None
+    heat_map_level = None
     build_first_heatmap()
     # build_second_heatmap()
@@ -21,6 +21,7 @@ from __future__ import print_function
 import sys
 sys.path.insert(0, '/home/arjun/MS/Thesis/CAMELYON-16/source')
 
+import queue
 import threading
 import os.path
 import time
@@ -36,6 +37,7 @@ import tensorflow as tf
 from camelyon16.inception.dataset import Dataset
 from camelyon16 import utils as utils
 from camelyon16.inception.slim import slim
+from camelyon16.ops.heatmap_stream import StageTimer
 
 CKPT_PATH = utils.EVAL_MODEL_CKPT_PATH
 
@@ -48,7 +50,9 @@ tf.app.flags.DEFINE_string('checkpoint_dir', utils.TRAIN_DIR,
 
 # Flags governing the frequency of the eval.
 tf.app.flags.DEFINE_integer('num_threads', 5,
-                            """Number of threads.""")
+                            """Number of inference workers (one tower each).""")
+tf.app.flags.DEFINE_integer('num_heatmap_queue_batches', 10,
+                            """Capacity of the queues between the reader, the workers and the writer.""")
 tf.app.flags.DEFINE_boolean('run_once', True,
                             """Whether to run eval only once.""")
 
@@ -65,28 +69,96 @@ tf.app.flags.DEFINE_string('subset', 'heatmap',
 FLAGS = tf.app.flags.FLAGS
 
 BATCH_SIZE = 100
+# seconds between two checks of the coordinator while waiting on the queue of batch splits
+QUEUE_POLL_SECS = 1.0
 
 
-def assign_prob(probabilities, coordinates):
-    global heat_map
-    height = heat_map.shape[0] - 1
-    for prob, cord in zip(probabilities[:, 1:], coordinates):
-        cord = cord.decode('UTF-8')  # each cord is in form - col_row_level
-        pixel_pos = cord.split('_')
-        heat_map[height-int(pixel_pos[1]), int(pixel_pos[0])] = prob
-    return heat_map
+class HeatmapWriter(object):
+    """Single thread owning the heatmap array, applies the results of the inference workers.
+
+    A failure of the thread is reported to coord, a stop request of coord ends it.
+    """
+
+    def __init__(self, heat_map, timer, capacity, coord):
+        self.heat_map = heat_map
+        self.timer = timer
+        self.coord = coord
+        self.results = queue.Queue(maxsize=capacity)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        # rows increase from [bottom -> top] in the heatmap and from [top -> bottom] in the wsi
+        height = self.heat_map.shape[0] - 1
+        try:
+            while not self.coord.should_stop():
+                try:
+                    result = self.results.get(timeout=QUEUE_POLL_SECS)
+                except queue.Empty:
+                    continue
+                if result is None:
+                    return
+                probabilities, rows, cols = result
+                with self.timer.time('scatter', len(rows)):
+                    self.heat_map[height - rows, cols] = probabilities[:, 1]
+        except Exception as e:  # pylint: disable=broad-except
+            print('HeatmapWriter._run(): failed')
+            self.coord.request_stop(e)
 
+    def put(self, probabilities, rows, cols):
+        """Returns False if the result was dropped because coord was asked to stop."""
+        return put_unless_stopped(self.coord, self.results, (probabilities, rows, cols))
 
-def evaluate_split(thread_index, sess, prob_ops, cords):
-    print('evaluate_split(): thread-%d' % thread_index)
-    probabilities, coordinates = sess.run([prob_ops, cords])
-    print(probabilities)
-    print(coordinates)
-    assign_prob(probabilities, coordinates)
+    def close(self):
+        put_unless_stopped(self.coord, self.results, None)
+        self._thread.join()
+        return self.heat_map
 
 
-def generate_heatmap(saver, dataset, summary_writer, prob_ops, cords_ops, summary_op):
-    # def _eval_once(saver, summary_writer, accuracy, summary_op, confusion_matrix_op, logits, labels, dense_labels):
+def put_unless_stopped(coord, items, item):
+    """Put item into the bounded queue items, giving up once coord is asked to stop.
+
+    Returns:
+      True if the item was queued.
+    """
+    while not coord.should_stop():
+        try:
+            items.put(item, timeout=QUEUE_POLL_SECS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def inference_worker(worker_index, sess, coord, batches, images_op, prob_op, writer, timer):
+    """Long lived worker: evaluates the batch splits of the queue on its own tower until it gets None."""
+    try:
+        while not coord.should_stop():
+            try:
+                split = batches.get(timeout=QUEUE_POLL_SECS)
+            except queue.Empty:
+                continue
+            if split is None:
+                return
+            images, rows, cols = split
+            with timer.time('forward', len(rows)):
+                probabilities = sess.run(prob_op, feed_dict={images_op: images})
+            writer.put(probabilities, rows, cols)
+    except Exception as e:  # pylint: disable=broad-except
+        print('inference_worker(): thread-%d failed' % worker_index)
+        coord.request_stop(e)
+
+
+def generate_heatmap(saver, dataset, summary_writer, images_ops, prob_ops, cords_ops, summary_op, heat_map):
+    """Evaluate the heatmap patches of a dataset.
+
+    The main thread dequeues batches from the input pipeline and splits them
+    into one part per tower. A pool of FLAGS.num_threads long lived inference
+    workers takes the parts from a bounded queue, and a single HeatmapWriter
+    scatters the probabilities into heat_map.
+    """
+    timer = StageTimer(('read', 'preprocess', 'forward', 'scatter'))
 
     with tf.Session() as sess:
         ckpt = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
@@ -113,46 +185,72 @@ def generate_heatmap(saver, dataset, summary_writer, prob_ops, cords_ops, summar
                   (ckpt.model_checkpoint_path, global_step))
         else:
             print('No checkpoint file found')
-            return
+            return heat_map
 
         # Start the queue runners.
         coord = tf.train.Coordinator()
+        writer = HeatmapWriter(heat_map, timer, capacity=FLAGS.num_heatmap_queue_batches, coord=coord)
+        batches = queue.Queue(maxsize=FLAGS.num_heatmap_queue_batches)
+        workers = []
+        threads = []
         try:
-            threads = []
             for qr in tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS):
                 threads.extend(qr.create_threads(sess, coord=coord, daemon=True,
                                                  start=True))
 
+            # the towers share their weights and shapes, any worker can evaluate any split by feeding it
+            # to the input of its own tower
+            for thread_index in range(FLAGS.num_threads):
+                args = (thread_index, sess, coord, batches, images_ops[thread_index], prob_ops[thread_index], writer,
+                        timer)
+                t = threading.Thread(target=inference_worker, args=args)
+                t.daemon = True
+                t.start()
+                workers.append(t)
+
             num_iter = int(math.ceil(dataset.num_examples_per_epoch() / BATCH_SIZE))
             step = 0
             print('%s: starting evaluation on (%s).' % (datetime.now(), FLAGS.subset))
             start_time = time.time()
             while step < num_iter and not coord.should_stop():
-
-                eval_threads = []
-                for thread_index in range(FLAGS.num_threads):
-                    args = (thread_index, sess, prob_ops[thread_index], cords_ops[thread_index])
-                    t = threading.Thread(target=evaluate_split, args=args)
-                    t.start()
-                    eval_threads.append(t)
-                coord.join(eval_threads)
+                with timer.time('read', BATCH_SIZE):
+                    images, coordinates = sess.run([images_ops, cords_ops])
+                with timer.time('preprocess', BATCH_SIZE):
+                    # coordinates are (row, col, level) int64 rows
+                    splits = [(split_images, split_cords[:, 0], split_cords[:, 1])
+                              for split_images, split_cords in zip(images, coordinates)]
+                # a failed worker stops the others, the queue then never drains
+                for split in splits:
+                    if not put_unless_stopped(coord, batches, split):
+                        break
                 step += 1
                 print('%s: patch processed: %d / %d' % (datetime.now(), step * BATCH_SIZE,
                                                         dataset.num_examples_per_epoch()))
                 if not ((step * BATCH_SIZE) % 1000):
                     duration = time.time() - start_time
-                    print('1000 patch process time: %d secs' % math.ceil(duration))
+                    print('1000 patch process time: %d secs (%s)' % (math.ceil(duration), timer.summary()))
+                    timer.reset()
                     start_time = time.time()
 
         except Exception as e:  # pylint: disable=broad-except
             coord.request_stop(e)
 
+        # after a stop request the workers and the writer leave on their own, otherwise the sentinels end them;
+        # the writer gets its sentinel once every worker has put its last result
+        for _ in workers:
+            put_unless_stopped(coord, batches, None)
+        for t in workers:
+            t.join()
+        heat_map = writer.close()
         coord.request_stop()
-        coord.join(threads, stop_grace_period_secs=10)
+        # re-raises the exception of a failed worker, writer or main loop
+        coord.join(workers + threads, stop_grace_period_secs=10)
+
+    return heat_map
 
 
-def build_heatmap(dataset):
-    """Evaluate model on Dataset for a number of steps."""
+def build_heatmap(dataset, heat_map):
+    """Evaluate model on Dataset for a number of steps, returns heat_map filled with the probabilities."""
     with tf.Graph().as_default():
         # Get images and labels from the dataset.
         images, cords = image_processing.inputs(dataset, BATCH_SIZE)
@@ -168,6 +266,7 @@ def build_heatmap(dataset):
         images_splits = tf.split(images, FLAGS.num_threads, axis=0)
         cords_splits = tf.split(cords, FLAGS.num_threads, axis=0)
 
+        images_ops = []
         prob_ops = []
         cords_ops = []
         for i in range(FLAGS.num_threads):
@@ -175,7 +274,8 @@ def build_heatmap(dataset):
                 with slim.arg_scope([slim.variables.variable], device='/cpu:%d' % i):
                     print('i=%d' % i)
                     _, _, prob_op = inception.inference(images_splits[i], num_classes, scope=scope)
-                    cords_op = tf.reshape(cords_splits[i], (int(BATCH_SIZE/FLAGS.num_threads), 1))
+                    cords_op = tf.reshape(cords_splits[i], (int(BATCH_SIZE/FLAGS.num_threads), 3))
+                    images_ops.append(images_splits[i])
                     prob_ops.append(prob_op)
                     cords_ops.append(cords_op)
 
@@ -191,15 +291,17 @@ def build_heatmap(dataset):
         graph_def = tf.get_default_graph().as_graph_def()
         summary_writer = tf.summary.FileWriter(FLAGS.eval_dir, graph_def=graph_def)
 
-        generate_heatmap(saver, dataset, summary_writer, prob_ops, cords_ops, summary_op)
+        return generate_heatmap(saver, dataset, summary_writer, images_ops, prob_ops, cords_ops, summary_op,
+                                heat_map)
 
 
 def main(unused_argv):
-    global heat_map
     tf_records_file_names = sorted(os.listdir(utils.HEAT_MAP_TF_RECORDS_DIR))
     print(tf_records_file_names)
-    tf_records_file_names = tf_records_file_names[2:3]
     for wsi_filename in tf_records_file_names:
+        if os.path.exists(str(os.path.join(utils.HEAT_MAP_DIR, wsi_filename)) + '_heatmap.png'):
+            print('heatmap already generated for: %s' % wsi_filename)
+            continue
         print('Generating heatmap for: %s' % wsi_filename)
         tf_records_dir = os.path.join(utils.HEAT_MAP_TF_RECORDS_DIR, wsi_filename)
         raw_patches_dir = os.path.join(utils.HEAT_MAP_RAW_PATCHES_DIR, wsi_filename)
@@ -214,15 +316,14 @@ def main(unused_argv):
         num_patches = len(os.listdir(raw_patches_dir))
         assert os.path.exists(tf_records_dir), 'tf-records directory %s does not exist' % tf_records_dir
         dataset = Dataset(DATA_SET_NAME, utils.data_subset[4], tf_records_dir=tf_records_dir, num_patches=num_patches)
-        build_heatmap(dataset)
+        heat_map = build_heatmap(dataset, heat_map)
         # Image.fromarray(heat_map).save(os.path.join(utils.HEAT_MAP_DIR, wsi_filename), 'PNG')
         plt.imshow(heat_map, cmap='hot', interpolation='nearest')
         plt.colorbar()
         plt.clim(0.00, 1.00)
         plt.axis([0, heatmap_rgb.shape[1], 0, heatmap_rgb.shape[0]])
         plt.savefig(str(os.path.join(utils.HEAT_MAP_DIR, wsi_filename))+'_heatmap.png')
-        plt.show()
+        plt.clf()
 
 if __name__ == '__main__':
-    heat_map = None
     tf.app.run()
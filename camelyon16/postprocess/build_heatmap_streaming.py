@@ -0,0 +1,433 @@
+"""Build heatmaps in a single streaming pass over the WSIs.
+
+ The patches of the tissue pixels are read from the slide, batched in memory
+ and evaluated by Inception as they come (see ops/heatmap_stream.py), the
+ probabilities are written straight into the heatmap. This replaces the
+ extract_patches_heatmap -> build_tf_records_heatmap_multi_thread ->
+ build_heatmap_multi_thread chain and its PNG and TFRecord round-trips.
+
+ -- Python side:
+ InceptionPredictor: restore a checkpoint once and evaluate batches of patches.
+ EnsemblePredictor: several checkpoints in one graph, every batch is
+   preprocessed once and evaluated by all the models in one run.
+ DenseInceptionPredictor: the same model evaluating large tiles in one fully
+   convolutional pass (see ops/dense_heatmap.py).
+ generate_heatmap: heatmap of a single WSI, optionally checkpointed so that
+   an interrupted run resumes where it stopped.
+ get_pending_slides: the WSIs main() still has to process, interrupted ones
+   first.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import os
+import shutil
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from camelyon16 import utils as utils
+from camelyon16.inception import image_processing  # defines the image_size flag
+from camelyon16.inception import inception_model as inception
+from camelyon16.inception.slim import inception_model as slim_inception
+from camelyon16.ops.dense_heatmap import DenseHeatmapStream
+from camelyon16.ops.ensemble_merge import merge_threshold
+from camelyon16.ops.heatmap_checkpoint import HeatmapCheckpoint
+from camelyon16.ops.heatmap_store import write_heatmap_prob
+from camelyon16.ops.heatmap_stream import HeatmapStream
+from camelyon16.ops.wsi_ops import WSIOps
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('heatmap_checkpoint_path', '',
+                           """Checkpoint of the model evaluating the patches, """
+                           """comma separated checkpoints evaluate an ensemble """
+                           """in one pass with one heatmap per model.""")
+tf.app.flags.DEFINE_string('heatmap_model_names', '',
+                           """Comma separated names of the ensemble models, the """
+                           """heatmaps of all but the first one are named """
+                           """<wsi>_prob_<name><ext>, defaults to model<i>.""")
+tf.app.flags.DEFINE_boolean('heatmap_fuse', False,
+                            """Also write the heatmap of a two model ensemble """
+                            """merged with ensemble_merge.merge_threshold(), """
+                            """named <wsi>_prob_ensemble<ext>.""")
+tf.app.flags.DEFINE_string('heatmap_wsi_dir', utils.TUMOR_WSI_PATH,
+                           """Directory of the WSIs to build heatmaps for.""")
+tf.app.flags.DEFINE_string('heatmap_dir', utils.HEAT_MAP_DIR or '',
+                           """Directory where to write the heatmaps.""")
+tf.app.flags.DEFINE_string('heatmap_prob_postfix', utils.HEATMAP_PROB_POSTFIX,
+                           """Postfix of the probability heatmaps, a heatmap store """
+                           """(ops/heatmap_store.py) for the store extension, """
+                           """an 8 bit image otherwise.""")
+tf.app.flags.DEFINE_boolean('heatmap_adaptive', False,
+                            """Evaluate a lattice first and only refine around """
+                            """uncertain probabilities, see HeatmapStream.run_adaptive().""")
+tf.app.flags.DEFINE_integer('heatmap_lattice_stride', utils.HEATMAP_LATTICE_STRIDE,
+                            """Lattice spacing (heatmap pixels) of the adaptive mode.""")
+tf.app.flags.DEFINE_boolean('heatmap_dense', False,
+                            """Evaluate tiles of heatmap_dense_tile_size level 0 """
+                            """pixels fully convolutionally instead of one patch """
+                            """per heatmap pixel.""")
+tf.app.flags.DEFINE_integer('heatmap_dense_tile_size', utils.DENSE_TILE_SIZE,
+                            """Level 0 side of the tiles of the dense mode.""")
+
+NUM_CLASSES = 2
+
+
+def preprocess_patches(images, patch_size, image_size):
+    """Same scaling and channel wise mean subtraction as image_processing.image_preprocessing().
+
+    Args:
+      images: uint8 Tensor [batch_size, patch_size, patch_size, 3].
+      patch_size: size of the patches.
+      image_size: input size of the network.
+    Returns:
+      float32 Tensor [batch_size, image_size, image_size, 3].
+    """
+    images = tf.image.convert_image_dtype(images, dtype=tf.float32)
+    if patch_size != image_size:
+        images = tf.image.resize_bilinear(images, [image_size, image_size], align_corners=False)
+    mean = tf.reduce_mean(images, axis=[1, 2], keep_dims=True)
+    return tf.subtract(images, mean)
+
+
+def pad_batch(images, batch_size):
+    """Pads a short last batch with zero patches up to the batch size of the graph."""
+    n = len(images)
+    if n < batch_size:
+        padding = np.zeros((batch_size - n,) + images.shape[1:], dtype=images.dtype)
+        images = np.concatenate([images, padding])
+    return images
+
+
+class InceptionPredictor(object):
+    """Tumor probabilities of batches of patches from a restored Inception model."""
+
+    def __init__(self, checkpoint_path, batch_size=None, patch_size=None, image_size=None):
+        """Builds the inference graph and restores its moving average variables.
+
+        Args:
+          checkpoint_path: path of the checkpoint to restore.
+          batch_size: batch size of the graph, smaller batches are padded,
+            defaults to utils.HEATMAP_BATCH_SIZE.
+          patch_size: size of the patches fed in, defaults to utils.PATCH_SIZE.
+          image_size: input size of the network, defaults to FLAGS.image_size.
+        """
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size or utils.HEATMAP_BATCH_SIZE
+        patch_size = patch_size or utils.PATCH_SIZE
+        image_size = image_size or FLAGS.image_size
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._images = tf.placeholder(tf.uint8, [self.batch_size, patch_size, patch_size, 3])
+            images = preprocess_patches(self._images, patch_size, image_size)
+
+            _, _, predictions = inception.inference(images, NUM_CLASSES)
+            self._tumor_prob = predictions[:, 1]
+
+            variable_averages = tf.train.ExponentialMovingAverage(inception.MOVING_AVERAGE_DECAY)
+            saver = tf.train.Saver(variable_averages.variables_to_restore())
+            self._sess = tf.Session(graph=self._graph)
+            saver.restore(self._sess, checkpoint_path)
+        print('Successfully loaded model from %s.' % checkpoint_path)
+
+    def __call__(self, images):
+        """Evaluates a batch.
+
+        Args:
+          images: uint8 array [n, patch_size, patch_size, 3], n <= batch_size.
+        Returns:
+          float array [n] of tumor probabilities.
+        """
+        return self._sess.run(self._tumor_prob, feed_dict={self._images: pad_batch(images, self.batch_size)})[
+            :len(images)]
+
+    def close(self):
+        self._sess.close()
+
+
+class EnsemblePredictor(object):
+    """Tumor probabilities of several restored Inception models, one column per model.
+
+    Every model is built under its own variable scope (model_<i>) on top of a
+    single preprocessed input, so a batch is decoded, scaled and mean
+    subtracted once and all the models run in the same session.run().
+    """
+
+    def __init__(self, checkpoint_paths, batch_size=None, patch_size=None, image_size=None, fuse=False):
+        """Builds the ensemble graph and restores the moving average variables of every model.
+
+        Args:
+          checkpoint_paths: paths of the checkpoints to restore, one per model.
+          batch_size: batch size of the graph, smaller batches are padded,
+            defaults to utils.HEATMAP_BATCH_SIZE.
+          patch_size: size of the patches fed in, defaults to utils.PATCH_SIZE.
+          image_size: input size of the network, defaults to FLAGS.image_size.
+          fuse: append the merge_threshold() of the first two models as a last
+            column, needs exactly two models.
+        """
+        assert not fuse or len(checkpoint_paths) == 2, 'Fusing needs exactly two models'
+        self.checkpoint_path = list(checkpoint_paths)
+        self.batch_size = batch_size or utils.HEATMAP_BATCH_SIZE
+        self.fuse = fuse
+        self.channels = len(checkpoint_paths) + (1 if fuse else 0)
+        patch_size = patch_size or utils.PATCH_SIZE
+        image_size = image_size or FLAGS.image_size
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._images = tf.placeholder(tf.uint8, [self.batch_size, patch_size, patch_size, 3])
+            images = preprocess_patches(self._images, patch_size, image_size)
+            tumor_probs = []
+            for i in range(len(checkpoint_paths)):
+                with tf.variable_scope('model_%d' % i):
+                    _, _, predictions = inception.inference(images, NUM_CLASSES)
+                tumor_probs.append(predictions[:, 1])
+            self._tumor_probs = tf.stack(tumor_probs, axis=1)
+
+            variable_averages = tf.train.ExponentialMovingAverage(inception.MOVING_AVERAGE_DECAY)
+            variables_to_restore = variable_averages.variables_to_restore()
+            self._sess = tf.Session(graph=self._graph)
+            for i, checkpoint_path in enumerate(checkpoint_paths):
+                # the checkpoints know the variables without the model_<i>/ prefix
+                prefix = 'model_%d/' % i
+                var_list = {name[len(prefix):]: var for name, var in variables_to_restore.items()
+                            if name.startswith(prefix)}
+                tf.train.Saver(var_list).restore(self._sess, checkpoint_path)
+                print('Successfully loaded model %d from %s.' % (i, checkpoint_path))
+
+    def __call__(self, images):
+        """Evaluates a batch with every model.
+
+        Args:
+          images: uint8 array [n, patch_size, patch_size, 3], n <= batch_size.
+        Returns:
+          float array [n, channels] of tumor probabilities.
+        """
+        probabilities = self._sess.run(self._tumor_probs,
+                                       feed_dict={self._images: pad_batch(images, self.batch_size)})[:len(images)]
+        if self.fuse:
+            fused = merge_threshold(probabilities[:, 0], probabilities[:, 1])
+            probabilities = np.concatenate([probabilities, fused[:, None]], axis=1)
+        return probabilities
+
+    def close(self):
+        self._sess.close()
+
+
+class DenseInceptionPredictor(object):
+    """Dense tumor probability maps of tiles from a restored Inception model.
+
+    The trunk runs once over the whole tile and the final pooling and logits
+    layers slide over its feature map, so neighbouring patches share their
+    convolutions. The per patch mean subtraction of InceptionPredictor becomes
+    the mean of the patch sized window around every pixel.
+    """
+
+    def __init__(self, checkpoint_path, patch_size=None, image_size=None):
+        """Builds the fully convolutional graph and restores its moving average variables.
+
+        Args:
+          checkpoint_path: path of the checkpoint to restore.
+          patch_size: level 0 size of the patches the model was trained on,
+            defaults to utils.PATCH_SIZE.
+          image_size: input size of the network, defaults to FLAGS.image_size.
+        """
+        self.checkpoint_path = checkpoint_path
+        self.patch_size = patch_size or utils.PATCH_SIZE
+        self.image_size = image_size or FLAGS.image_size
+        self.scale = self.image_size / self.patch_size
+        # level 0 pixels between two outputs
+        self.output_stride = int(round(slim_inception.OUTPUT_STRIDE / self.scale))
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._tiles = tf.placeholder(tf.float32, [1, None, None, 3])
+            _, _, predictions = inception.inference(self._tiles, NUM_CLASSES, dense_image_size=self.image_size)
+            self._tumor_prob = predictions[:, :, :, 1]
+
+            variable_averages = tf.train.ExponentialMovingAverage(inception.MOVING_AVERAGE_DECAY)
+            saver = tf.train.Saver(variable_averages.variables_to_restore())
+            self._sess = tf.Session(graph=self._graph)
+            saver.restore(self._sess, checkpoint_path)
+        print('Successfully loaded dense model from %s.' % checkpoint_path)
+
+    def __call__(self, tiles):
+        """Evaluates a tile.
+
+        Args:
+          tiles: uint8 array [1, height, width, 3].
+        Returns:
+          float array [1, rows, cols], the tumor probability of the patch at
+          (col, row) * output_stride of the tile.
+        """
+        tile = tiles[0].astype(np.float32) / 255.0
+        if self.scale != 1:
+            tile = cv2.resize(tile, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_LINEAR)
+        tile -= cv2.blur(tile, (self.image_size, self.image_size), borderType=cv2.BORDER_REFLECT)
+        return self._sess.run(self._tumor_prob, feed_dict={self._tiles: tile[None]})
+
+    def close(self):
+        self._sess.close()
+
+
+def generate_heatmap(wsi_path, predictor, wsi_mask_path=None, adaptive=False, lattice_stride=None, dense=False,
+                     dense_tile_size=None, checkpoint_dir=None):
+    """Heatmap of a single WSI.
+
+    Args:
+      wsi_path: path of the WSI.
+      predictor: callable mapping a batch of patches to tumor probabilities,
+        e.g. an InceptionPredictor, or to one column per model for an
+        EnsemblePredictor.
+      wsi_mask_path: tumor mask of Tumor WSIs, selects the same level as the
+        patch extraction did.
+      adaptive: coarse to fine evaluation, the confidently normal or tumor
+        pixels between the lattice points are interpolated.
+      lattice_stride: lattice spacing of the adaptive mode, defaults to
+        utils.HEATMAP_LATTICE_STRIDE.
+      dense: predictor is a DenseInceptionPredictor, tiles are evaluated
+        instead of patches.
+      dense_tile_size: level 0 tile side of the dense mode, defaults to
+        utils.DENSE_TILE_SIZE.
+      checkpoint_dir: directory of a HeatmapCheckpoint, the probabilities are
+        flushed there as they come and a checkpoint left by an interrupted
+        run with the same settings is resumed. The caller removes it once
+        the heatmap is saved.
+    Returns:
+      heat_map_prob: float32 array [height, width] at the level used for the
+        tissue mask, heat_map_prob[row, col] is the probability of the
+        PATCH_SIZE patch whose level 0 origin is (col, row) * mag_factor,
+        [height, width, channels] for an EnsemblePredictor.
+      level_used: WSI level of the heatmap pixels.
+      mag_factor: level 0 pixels between two heatmap pixels.
+    """
+    if wsi_mask_path is None:
+        wsi_image, _, level_used = WSIOps.read_wsi_normal(wsi_path, cache_bytes=utils.TILE_CACHE_BYTES,
+                                                          read_rgb=False)
+    else:
+        wsi_image, _, _, _, level_used = WSIOps.read_wsi_tumor(wsi_path, wsi_mask_path,
+                                                               cache_bytes=utils.TILE_CACHE_BYTES, read_rgb=False)
+    assert wsi_image is not None, 'Failed to read Whole Slide Image %s.' % wsi_path
+
+    bounding_boxes, image_open = WSIOps.find_roi_bbox_cached(wsi_path, level_used)
+    channels = getattr(predictor, 'channels', None)
+    assert channels is None or not (adaptive or dense), 'Ensembles are evaluated patch by patch'
+    if dense:
+        stream = DenseHeatmapStream(predictor, tile_size=dense_tile_size, patch_size=predictor.patch_size,
+                                    output_stride=predictor.output_stride)
+    else:
+        stream = HeatmapStream(predictor, channels=channels)
+    mag_factor = WSIOps.get_mag_factor(wsi_image, level_used)
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = HeatmapCheckpoint(checkpoint_dir, stream.allocate(image_open).shape,
+                                       meta={'wsi_path': os.path.realpath(wsi_path), 'level_used': level_used,
+                                             'model': getattr(predictor, 'checkpoint_path', None),
+                                             'adaptive': adaptive, 'lattice_stride': lattice_stride, 'dense': dense,
+                                             'dense_tile_size': dense_tile_size})
+    if adaptive:
+        heat_map_prob, _ = stream.run_adaptive(wsi_image, image_open, bounding_boxes, mag_factor,
+                                               stride=lattice_stride, checkpoint=checkpoint)
+    else:
+        heat_map_prob = stream.run(wsi_image, image_open, bounding_boxes, mag_factor, checkpoint=checkpoint)
+    wsi_image.close()
+    return heat_map_prob, level_used, mag_factor
+
+
+def get_checkpoint_dir(heatmap_prob_path):
+    return heatmap_prob_path + utils.HEATMAP_CHECKPOINT_EXT
+
+
+def get_channel_postfixes(heatmap_prob_postfix, model_names, fuse):
+    """Postfixes of the heatmaps of an ensemble, one per EnsemblePredictor column.
+
+    The first model keeps heatmap_prob_postfix, so that the single model
+    consumers read it as is, the other ones get their name before the
+    extension, e.g. _prob_model8.heatmap, and the fused one _prob_ensemble.heatmap.
+    """
+    root, ext = os.path.splitext(heatmap_prob_postfix)
+    postfixes = [heatmap_prob_postfix] + ['%s_%s%s' % (root, name, ext) for name in model_names[1:]]
+    if fuse:
+        postfixes.append('%s_ensemble%s' % (root, ext))
+    return postfixes
+
+
+def get_pending_slides(wsi_paths, heatmap_dir, heatmap_prob_postfix):
+    """The WSIs without a heatmap yet, the ones with a checkpoint first.
+
+    Args:
+      wsi_paths: paths of the WSIs.
+      heatmap_dir: directory of the heatmaps.
+      heatmap_prob_postfix: postfix of the heatmap names.
+    Returns:
+      list of (wsi_path, heatmap_prob_path) tuples.
+    """
+    pending = []
+    for wsi_path in wsi_paths:
+        heatmap_prob_path = os.path.join(heatmap_dir, utils.get_filename_from_path(wsi_path)) + heatmap_prob_postfix
+        if not os.path.exists(heatmap_prob_path):
+            pending.append((wsi_path, heatmap_prob_path))
+    # sorted() is stable, the slides keep their order within both groups
+    return sorted(pending, key=lambda slide: not os.path.exists(get_checkpoint_dir(slide[1])))
+
+
+def main(unused_argv):
+    assert FLAGS.heatmap_checkpoint_path, 'Set --heatmap_checkpoint_path'
+    assert FLAGS.heatmap_dir, 'Set --heatmap_dir'
+    if not os.path.exists(FLAGS.heatmap_dir):
+        os.makedirs(FLAGS.heatmap_dir)
+
+    wsi_paths = sorted(glob.glob(os.path.join(FLAGS.heatmap_wsi_dir, '*.tif')))
+    checkpoint_paths = FLAGS.heatmap_checkpoint_path.split(',')
+    model_names = FLAGS.heatmap_model_names.split(',') if FLAGS.heatmap_model_names else \
+        ['model%d' % i for i in range(len(checkpoint_paths))]
+    assert len(model_names) == len(checkpoint_paths), 'One --heatmap_model_names entry per checkpoint'
+    postfixes = get_channel_postfixes(FLAGS.heatmap_prob_postfix, model_names, FLAGS.heatmap_fuse)
+    if len(checkpoint_paths) > 1 or FLAGS.heatmap_fuse:
+        predictor = EnsemblePredictor(checkpoint_paths, fuse=FLAGS.heatmap_fuse)
+    elif FLAGS.heatmap_dense:
+        predictor = DenseInceptionPredictor(FLAGS.heatmap_checkpoint_path)
+    else:
+        predictor = InceptionPredictor(FLAGS.heatmap_checkpoint_path)
+    pending = get_pending_slides(wsi_paths, FLAGS.heatmap_dir, FLAGS.heatmap_prob_postfix)
+    print('slides: %d, already done: %d, pending: %d' % (len(wsi_paths), len(wsi_paths) - len(pending),
+                                                         len(pending)))
+    failed = []
+    for index, (wsi_path, heatmap_prob_path) in enumerate(pending):
+        wsi_filename = utils.get_filename_from_path(wsi_path)
+        print('Generating heatmap for: %s (%d / %d)' % (wsi_filename, index + 1, len(pending)))
+        checkpoint_dir = get_checkpoint_dir(heatmap_prob_path)
+        try:
+            heat_map_prob, level_used, mag_factor = generate_heatmap(
+                wsi_path, predictor, adaptive=FLAGS.heatmap_adaptive, lattice_stride=FLAGS.heatmap_lattice_stride,
+                dense=FLAGS.heatmap_dense, dense_tile_size=FLAGS.heatmap_dense_tile_size,
+                checkpoint_dir=checkpoint_dir)
+            if heat_map_prob.ndim == 2:
+                write_heatmap_prob(heatmap_prob_path, heat_map_prob, slide_id=wsi_filename, level=level_used,
+                                   model=FLAGS.heatmap_checkpoint_path, grid_stride=mag_factor)
+            else:
+                # the first model's heatmap is written last, it marks the slide as done
+                models = checkpoint_paths + ['ensemble'] * FLAGS.heatmap_fuse
+                for channel in reversed(range(heat_map_prob.shape[2])):
+                    write_heatmap_prob(os.path.join(FLAGS.heatmap_dir, wsi_filename) + postfixes[channel],
+                                       heat_map_prob[:, :, channel], slide_id=wsi_filename, level=level_used,
+                                       model=models[channel], grid_stride=mag_factor)
+        except Exception as e:  # pylint: disable=broad-except
+            # the checkpoint keeps what was evaluated, the next run resumes from it
+            print('%s failed: %s: %s' % (wsi_filename, type(e).__name__, e))
+            failed.append(wsi_filename)
+            continue
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    predictor.close()
+
+    if failed:
+        print('%d slides failed, rerun to resume them: %s' % (len(failed), ', '.join(failed)))
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -107,14 +107,29 @@ def _bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
 
+def _parse_patch_name(patch_name):
+    """
+        Heatmap coordinates of a patch named 'row_col_level' by extract_patches_heatmap.extract_patch_from_bb().
+
+    """
+    row, col, level = patch_name.split('_')[:3]
+    return int(row), int(col), int(level)
+
+
 def _convert_to_example(image_buffer, patch_name):
     """
         Build an Example proto for an example.
 
-    """
+        The heatmap coordinates are stored as int64 features (image/row, image/col, image/level) so that
+        the heatmap builders scatter the probabilities without parsing patch names.
 
+    """
+    row, col, level = _parse_patch_name(patch_name)
     example = tf.train.Example(features=tf.train.Features(feature={
         'image/patch_name': _bytes_feature(tf.compat.as_bytes(patch_name)),
+        'image/row': _int64_feature(row),
+        'image/col': _int64_feature(col),
+        'image/level': _int64_feature(level),
         'image/encoded': _bytes_feature(tf.compat.as_bytes(image_buffer))}))
     return example
 
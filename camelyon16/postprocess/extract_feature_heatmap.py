@@ -2,6 +2,7 @@ import csv
 import glob
 import os
 import random
+from concurrent.futures import ProcessPoolExecutor
 
 import cv2
 import numpy as np
@@ -10,11 +11,23 @@ from skimage.measure import label
 from skimage.measure import regionprops
 
 from camelyon16 import utils as utils
+from camelyon16.ops.ensemble_merge import merge_threshold
+from camelyon16.ops.feature_cache import FeatureCache
+from camelyon16.ops.heatmap_store import find_heatmap_window, read_heatmap_prob
+from camelyon16.ops.region_features import get_region_features
 from camelyon16.ops.wsi_ops import WSIOps
 
 FILTER_DIM = 2
 N_FEATURES = 31
 MAX, MEAN, VARIANCE, SKEWNESS, KURTOSIS = 0, 1, 2, 3, 4
+# region properties the features use at either threshold
+PROPERTIES_T90 = ('area', 'perimeter', 'eccentricity', 'solidity', 'mean_intensity')
+PROPERTIES_T50 = ('area', 'extent', 'major_axis_length', 'minor_axis_length')
+# t90: prob >= 0.90, t50: prob > 0.50, cut half way between the 8 bit values the classifiers were trained on
+# (>= int(0.90 * 255), > int(0.50 * 255)): 8 bit heatmaps keep their regions, float heatmaps get the regions of
+# their rounded 8 bit values
+THRESHOLD_T90 = (int(0.90 * 255) - 0.5) / 255
+THRESHOLD_T50 = (int(0.50 * 255) + 0.5) / 255
 
 
 def get_region_props(heatmap_threshold_2d, heatmap_prob_2d):
@@ -51,34 +64,19 @@ def draw_bbox(heatmap_threshold, region_props, threshold_label='t90'):
     cv2.imshow('bbox_%s' % threshold_label, heatmap_threshold)
 
 
-def get_largest_tumor_index(region_props):
-    largest_tumor_index = -1
+def get_largest_tumor_index(areas):
+    # first of the largest regions, like a strict > scan
+    return int(np.argmax(areas))
 
-    largest_tumor_area = -1
 
-    n_regions = len(region_props)
-    for index in range(n_regions):
-        if region_props[index]['area'] > largest_tumor_area:
-            largest_tumor_area = region_props[index]['area']
-            largest_tumor_index = index
-
-    return largest_tumor_index
-
-
-def get_longest_axis_in_largest_tumor_region(region_props, largest_tumor_region_index):
-    largest_tumor_region = region_props[largest_tumor_region_index]
-    return max(largest_tumor_region['major_axis_length'], largest_tumor_region['minor_axis_length'])
+def get_longest_axis_in_largest_tumor_region(region_features, largest_tumor_region_index):
+    return max(region_features['major_axis_length'][largest_tumor_region_index],
+               region_features['minor_axis_length'][largest_tumor_region_index])
 
 
-def get_tumor_region_to_tissue_ratio(region_props, image_open):
+def get_tumor_region_to_tissue_ratio(areas, image_open):
     tissue_area = cv2.countNonZero(image_open)
-    tumor_area = 0
-
-    n_regions = len(region_props)
-    for index in range(n_regions):
-        tumor_area += region_props[index]['area']
-
-    return float(tumor_area) / tissue_area
+    return float(np.sum(areas)) / tissue_area
 
 
 def get_tumor_region_to_bbox_ratio(region_props):
@@ -86,10 +84,9 @@ def get_tumor_region_to_bbox_ratio(region_props):
     print()
 
 
-def get_feature(region_props, n_region, feature_name):
+def get_feature(feature_values):
     feature = [0] * 5
-    if n_region > 0:
-        feature_values = [region[feature_name] for region in region_props]
+    if len(feature_values) > 0:
         feature[MAX] = utils.format_2f(np.max(feature_values))
         feature[MEAN] = utils.format_2f(np.mean(feature_values))
         feature[VARIANCE] = utils.format_2f(np.var(feature_values))
@@ -99,10 +96,9 @@ def get_feature(region_props, n_region, feature_name):
     return feature
 
 
-def get_average_prediction_across_tumor_regions(region_props):
-    # close 255
-    region_mean_intensity = [region.mean_intensity for region in region_props]
-    return np.mean(region_mean_intensity)
+def get_average_prediction_across_tumor_regions(mean_intensities):
+    # in 8 bit units (close 255), the unit of the feature CSVs
+    return np.mean(mean_intensities) * 255
 
 
 def extract_features(heatmap_prob, image_open):
@@ -120,78 +116,52 @@ def extract_features(heatmap_prob, image_open):
         -> (22-26) given t = 0.50, max, mean, variance, skewness, and kurtosis of  'rectangularity(extent)'
         -> (27-31) given t = 0.90, max, mean, variance, skewness, and kurtosis of 'solidity'
 
-    :param heatmap_prob:
-    :param image_open:
-    :return:
+    :param heatmap_prob: (rows, cols) probabilities, e.g. the window of find_heatmap_window()
+    :param image_open: tissue mask of the slide
+    :return: list of N_FEATURES features
 
     """
 
-    heatmap_threshold_t90 = np.array(heatmap_prob)
-    heatmap_threshold_t50 = np.array(heatmap_prob)
-    heatmap_threshold_t90[heatmap_threshold_t90 < int(0.90 * 255)] = 0
-    heatmap_threshold_t90[heatmap_threshold_t90 >= int(0.90 * 255)] = 255
-    heatmap_threshold_t50[heatmap_threshold_t50 <= int(0.50 * 255)] = 0
-    heatmap_threshold_t50[heatmap_threshold_t50 > int(0.50 * 255)] = 255
-
-    heatmap_threshold_t90_2d = np.reshape(heatmap_threshold_t90[:, :, :1],
-                                          (heatmap_threshold_t90.shape[0], heatmap_threshold_t90.shape[1]))
-    heatmap_threshold_t50_2d = np.reshape(heatmap_threshold_t50[:, :, :1],
-                                          (heatmap_threshold_t50.shape[0], heatmap_threshold_t50.shape[1]))
-    heatmap_prob_2d = np.reshape(heatmap_prob[:, :, :1],
-                                 (heatmap_prob.shape[0], heatmap_prob.shape[1]))
-
-    region_props_t90 = get_region_props(np.array(heatmap_threshold_t90_2d), heatmap_prob_2d)
-    region_props_t50 = get_region_props(np.array(heatmap_threshold_t50_2d), heatmap_prob_2d)
+    region_features_t90 = get_region_features(heatmap_prob, [THRESHOLD_T90], properties=PROPERTIES_T90)[0]
+    region_features_t50 = get_region_features(heatmap_prob, [THRESHOLD_T50], properties=PROPERTIES_T50)[0]
 
     features = []
 
-    f_count_tumor_region = len(region_props_t90)
+    f_count_tumor_region = len(region_features_t90['area'])
     if f_count_tumor_region == 0:
         return [0.00] * N_FEATURES
 
     features.append(utils.format_2f(f_count_tumor_region))
 
-    f_percentage_tumor_over_tissue_region = get_tumor_region_to_tissue_ratio(region_props_t90, image_open)
+    f_percentage_tumor_over_tissue_region = get_tumor_region_to_tissue_ratio(region_features_t90['area'], image_open)
     features.append(utils.format_2f(f_percentage_tumor_over_tissue_region))
 
-    largest_tumor_region_index_t90 = get_largest_tumor_index(region_props_t90)
-    largest_tumor_region_index_t50 = get_largest_tumor_index(region_props_t50)
-    f_area_largest_tumor_region_t50 = region_props_t50[largest_tumor_region_index_t50].area
+    largest_tumor_region_index_t50 = get_largest_tumor_index(region_features_t50['area'])
+    f_area_largest_tumor_region_t50 = region_features_t50['area'][largest_tumor_region_index_t50]
     features.append(utils.format_2f(f_area_largest_tumor_region_t50))
 
-    f_longest_axis_largest_tumor_region_t50 = get_longest_axis_in_largest_tumor_region(region_props_t50,
+    f_longest_axis_largest_tumor_region_t50 = get_longest_axis_in_largest_tumor_region(region_features_t50,
                                                                                        largest_tumor_region_index_t50)
     features.append(utils.format_2f(f_longest_axis_largest_tumor_region_t50))
 
-    f_pixels_count_prob_gt_90 = cv2.countNonZero(heatmap_threshold_t90_2d)
+    f_pixels_count_prob_gt_90 = np.sum(region_features_t90['area'])
     features.append(utils.format_2f(f_pixels_count_prob_gt_90))
 
-    f_avg_prediction_across_tumor_regions = get_average_prediction_across_tumor_regions(region_props_t90)
+    f_avg_prediction_across_tumor_regions = get_average_prediction_across_tumor_regions(
+        region_features_t90['mean_intensity'])
     features.append(utils.format_2f(f_avg_prediction_across_tumor_regions))
 
-    f_area = get_feature(region_props_t90, f_count_tumor_region, 'area')
-    features += f_area
-
-    f_perimeter = get_feature(region_props_t90, f_count_tumor_region, 'perimeter')
-    features += f_perimeter
-
-    f_eccentricity = get_feature(region_props_t90, f_count_tumor_region, 'eccentricity')
-    features += f_eccentricity
+    features += get_feature(region_features_t90['area'])
+    features += get_feature(region_features_t90['perimeter'])
+    features += get_feature(region_features_t90['eccentricity'])
+    features += get_feature(region_features_t50['extent'])
+    features += get_feature(region_features_t90['solidity'])
 
-    f_extent_t50 = get_feature(region_props_t50, len(region_props_t50), 'extent')
-    features += f_extent_t50
-
-    f_solidity = get_feature(region_props_t90, f_count_tumor_region, 'solidity')
-    features += f_solidity
-
-    # f_longest_axis_largest_tumor_region_t90 = get_longest_axis_in_largest_tumor_region(region_props_t90,
-    #                                                                                    largest_tumor_region_index_t90)
-    # f_area_larget_tumor_region_t90 = region_props_t90[largest_tumor_region_index_t90].area
-
-    # cv2.imshow('heatmap_threshold_t90', heatmap_threshold_t90)
-    # cv2.imshow('heatmap_threshold_t50', heatmap_threshold_t50)
+    # heatmap_threshold_t90 = np.array(heatmap_prob)
+    # heatmap_threshold_t90[heatmap_threshold_t90 < int(0.90 * 255)] = 0
+    # heatmap_threshold_t90[heatmap_threshold_t90 >= int(0.90 * 255)] = 255
+    # region_props_t90 = get_region_props(heatmap_threshold_t90[:, :, 0], heatmap_prob[:, :, 0])
     # draw_bbox(np.array(heatmap_threshold_t90), region_props_t90, threshold_label='t90')
-    # draw_bbox(np.array(heatmap_threshold_t50), region_props_t50, threshold_label='t50')
     # key = cv2.waitKey(0) & 0xFF
     # if key == 27:  # escape
     #     exit(0)
@@ -199,6 +169,69 @@ def extract_features(heatmap_prob, image_open):
     return features
 
 
+def get_heatmap_prob_path(wsi_name, heatmap_prob_name_postfix):
+    return os.path.join(utils.HEAT_MAP_DIR, wsi_name) + heatmap_prob_name_postfix
+
+
+def extract_slide_features(wsi_path, heatmap_prob_name_postfix_first_model, heatmap_prob_name_postfix_second_model,
+                           second_model_max, cache_dir):
+    """
+        Features of one slide, run in the worker processes of extract_features_parallel().
+
+        :return: list of N_FEATURES features
+    """
+    wsi_name = utils.get_filename_from_path(wsi_path)
+    heatmap_prob_path = get_heatmap_prob_path(wsi_name, heatmap_prob_name_postfix_first_model)
+    # every region lies inside the window of the t50 pixels, merge_threshold() never raises a probability
+    window = find_heatmap_window(heatmap_prob_path, THRESHOLD_T50)
+    if window is None:
+        return [0.00] * N_FEATURES
+    location, size = window[:2], window[2:]
+    heatmap_prob = read_heatmap_prob(heatmap_prob_path, location, size)
+
+    if heatmap_prob_name_postfix_second_model is not None:
+        heatmap_prob_second_model = read_heatmap_prob(
+            get_heatmap_prob_path(wsi_name, heatmap_prob_name_postfix_second_model), location, size)
+        heatmap_prob = merge_threshold(heatmap_prob, heatmap_prob_second_model, first_min=0.90,
+                                       second_max=second_model_max)
+
+    # the tissue mask comes from the tissue mask cache (utils.TISSUE_MASK_CACHE_DIR)
+    image_open = WSIOps.get_image_open(wsi_path)
+
+    if cache_dir is None:
+        return extract_features(heatmap_prob, image_open)
+    # the key hashes the merged heatmap, so the merge thresholds need not be part of it
+    return FeatureCache(cache_dir).get(heatmap_prob, image_open, lambda: extract_features(heatmap_prob, image_open),
+                                       slide=wsi_name, params={'n_features': N_FEATURES})
+
+
+def extract_features_parallel(wsi_paths, heatmap_prob_name_postfix_first_model,
+                              heatmap_prob_name_postfix_second_model=None, second_model_max=0.50, num_workers=None,
+                              cache_dir=None):
+    """
+        Features of every slide, one process pool job per slide. Slides whose heatmap and tissue mask are
+        unchanged are read back from the feature cache.
+
+        :param wsi_paths: paths of the WSIs
+        :param heatmap_prob_name_postfix_first_model: heatmaps are read from utils.HEAT_MAP_DIR/<wsi><postfix>
+        :param heatmap_prob_name_postfix_second_model: merged in with merge_threshold() if not None
+        :param second_model_max: second_max of merge_threshold(), as a probability
+        :param num_workers: defaults to utils.FEATURE_NUM_WORKERS
+        :param cache_dir: defaults to utils.HEATMAP_FEATURE_CACHE_DIR, caching is disabled if both are None
+        :return: list of the feature lists, in the order of wsi_paths
+    """
+    if num_workers is None:
+        num_workers = utils.FEATURE_NUM_WORKERS
+    cache_dir = utils.HEATMAP_FEATURE_CACHE_DIR if cache_dir is None else cache_dir
+    print('slides: %d, workers: %d, feature cache: %s' % (len(wsi_paths), num_workers, cache_dir))
+
+    n = len(wsi_paths)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(extract_slide_features, wsi_paths, [heatmap_prob_name_postfix_first_model] * n,
+                                 [heatmap_prob_name_postfix_second_model] * n, [second_model_max] * n,
+                                 [cache_dir] * n))
+
+
 def extract_features_test(heatmap_prob_name_postfix_first_model, heatmap_prob_name_postfix_second_model, f_test):
     print('************************** extract_features_test() ***************************')
     print('heatmap_prob_name_postfix_first_model: %s' % heatmap_prob_name_postfix_first_model)
@@ -212,26 +245,9 @@ def extract_features_test(heatmap_prob_name_postfix_first_model, heatmap_prob_na
 
     wr_test = csv.writer(features_file_test, quoting=csv.QUOTE_NONNUMERIC)
     wr_test.writerow(utils.heatmap_feature_names[:len(utils.heatmap_feature_names) - 1])
-    for wsi_path in test_wsi_paths:
-        wsi_name = utils.get_filename_from_path(wsi_path)
-        print('extracting features for: %s' % wsi_name)
-        heatmap_prob_path = glob.glob(
-            os.path.join(utils.HEAT_MAP_DIR, '*%s*%s' % (wsi_name, heatmap_prob_name_postfix_first_model)))
-        # print(heatmap_prob_path)
-        image_open = wsi_ops.get_image_open(wsi_path)
-        heatmap_prob = cv2.imread(heatmap_prob_path[0])
-
-        if heatmap_prob_name_postfix_second_model is not None:
-            heatmap_prob_path_second_model = glob.glob(
-                os.path.join(utils.HEAT_MAP_DIR, '*%s*%s' % (wsi_name, heatmap_prob_name_postfix_second_model)))
-            heatmap_prob_second_model = cv2.imread(heatmap_prob_path_second_model[0])
-
-            for row in range(heatmap_prob.shape[0]):
-                for col in range(heatmap_prob.shape[1]):
-                    if heatmap_prob[row, col, 0] >= 0.90 * 255 and heatmap_prob_second_model[row, col, 0] < 0.50 * 255:
-                        heatmap_prob[row, col, :] = heatmap_prob_second_model[row, col, :]
-
-        features = extract_features(heatmap_prob, image_open)
+    all_features = extract_features_parallel(test_wsi_paths, heatmap_prob_name_postfix_first_model,
+                                             heatmap_prob_name_postfix_second_model, second_model_max=0.50)
+    for features in all_features:
         print(features)
         wr_test.writerow(features)
 
@@ -253,26 +269,10 @@ def extract_features_train_all(heatmap_prob_name_postfix_first_model, heatmap_pr
 
     wr_train = csv.writer(features_file_train_all, quoting=csv.QUOTE_NONNUMERIC)
     wr_train.writerow(utils.heatmap_feature_names)
-    for wsi_path in wsi_paths:
+    all_features = extract_features_parallel(wsi_paths, heatmap_prob_name_postfix_first_model,
+                                             heatmap_prob_name_postfix_second_model, second_model_max=0.50)
+    for wsi_path, features in zip(wsi_paths, all_features):
         wsi_name = utils.get_filename_from_path(wsi_path)
-        # print('extracting features for: %s' % wsi_name)
-        heatmap_prob_path = glob.glob(
-            os.path.join(utils.HEAT_MAP_DIR, '*%s*%s' % (wsi_name, heatmap_prob_name_postfix_first_model)))
-        # print(heatmap_prob_path)
-        image_open = wsi_ops.get_image_open(wsi_path)
-        heatmap_prob = cv2.imread(heatmap_prob_path[0])
-
-        if heatmap_prob_name_postfix_second_model is not None:
-            heatmap_prob_path_second_model = glob.glob(
-                os.path.join(utils.HEAT_MAP_DIR, '*%s*%s' % (wsi_name, heatmap_prob_name_postfix_second_model)))
-            heatmap_prob_second_model = cv2.imread(heatmap_prob_path_second_model[0])
-
-            for row in range(heatmap_prob.shape[0]):
-                for col in range(heatmap_prob.shape[1]):
-                    if heatmap_prob[row, col, 0] >= 0.90 * 255 and heatmap_prob_second_model[row, col, 0] < 0.50 * 255:
-                        heatmap_prob[row, col, :] = heatmap_prob_second_model[row, col, :]
-
-        features = extract_features(heatmap_prob, image_open)
         if 'umor' in wsi_name:
             features += [1]
         else:
@@ -318,26 +318,10 @@ def extract_features_train_validation(heatmap_prob_name_postfix_first_model, hea
     wr_validation = csv.writer(features_file_validation, quoting=csv.QUOTE_NONNUMERIC)
     wr_train.writerow(utils.heatmap_feature_names)
     wr_validation.writerow(utils.heatmap_feature_names)
-    index = 0
-    for wsi_path in wsi_paths:
+    all_features = extract_features_parallel(wsi_paths, heatmap_prob_name_postfix_first_model,
+                                             heatmap_prob_name_postfix_second_model, second_model_max=0.20)
+    for index, (wsi_path, features) in enumerate(zip(wsi_paths, all_features)):
         wsi_name = utils.get_filename_from_path(wsi_path)
-        # print('extracting features for: %s' % wsi_name)
-        heatmap_prob_path = glob.glob(
-            os.path.join(utils.HEAT_MAP_DIR, '*%s*%s' % (wsi_name, heatmap_prob_name_postfix_first_model)))
-        # print(heatmap_prob_path)
-        image_open = wsi_ops.get_image_open(wsi_path)
-        heatmap_prob = cv2.imread(heatmap_prob_path[0])
-
-        if heatmap_prob_name_postfix_second_model is not None:
-            heatmap_prob_path_second_model = glob.glob(
-                os.path.join(utils.HEAT_MAP_DIR, '*%s*%s' % (wsi_name, heatmap_prob_name_postfix_second_model)))
-            heatmap_prob_second_model = cv2.imread(heatmap_prob_path_second_model[0])
-            for row in range(heatmap_prob.shape[0]):
-                for col in range(heatmap_prob.shape[1]):
-                    if heatmap_prob[row, col, 0] >= 0.90 * 255 and heatmap_prob_second_model[row, col, 0] < 0.20 * 255:
-                        heatmap_prob[row, col, :] = heatmap_prob_second_model[row, col, :]
-
-        features = extract_features(heatmap_prob, image_open)
         if 'umor' in wsi_name:
             features += [1]
         else:
@@ -349,27 +333,25 @@ def extract_features_train_validation(heatmap_prob_name_postfix_first_model, hea
         else:
             wr_train.writerow(features)
 
-        index += 1
-
 
 def extract_features_first_heatmap():
-    # extract_features_train_validation('_prob.png', None, utils.HEATMAP_FEATURE_CSV_TRAIN,
+    # extract_features_train_validation(utils.HEATMAP_PROB_POSTFIX, None, utils.HEATMAP_FEATURE_CSV_TRAIN,
     #                                   utils.HEATMAP_FEATURE_CSV_VALIDATION)
-    # extract_features_train_all('_prob.png', None, utils.HEATMAP_FEATURE_CSV_TRAIN_ALL)
-    extract_features_test('_prob.png', None, utils.HEATMAP_FEATURE_CSV_TEST)
+    # extract_features_train_all(utils.HEATMAP_PROB_POSTFIX, None, utils.HEATMAP_FEATURE_CSV_TRAIN_ALL)
+    extract_features_test(utils.HEATMAP_PROB_POSTFIX, None, utils.HEATMAP_FEATURE_CSV_TEST)
 
 
 def extract_features_both_heatmap():
-    # extract_features_train_validation('_prob.png', '_prob_%s.png' % utils.SECOND_HEATMAP_MODEL,
+    second_model_postfix = '_prob_%s%s' % (utils.SECOND_HEATMAP_MODEL, utils.HEATMAP_STORE_EXT)
+    # extract_features_train_validation(utils.HEATMAP_PROB_POSTFIX, second_model_postfix,
     #                                   utils.HEATMAP_FEATURE_CSV_TRAIN_SECOND_MODEL,
     #                                   utils.HEATMAP_FEATURE_CSV_VALIDATION_SECOND_MODEL)
-    # extract_features_train_all('_prob.png', '_prob_%s.png' % utils.SECOND_HEATMAP_MODEL,
+    # extract_features_train_all(utils.HEATMAP_PROB_POSTFIX, second_model_postfix,
     #                            utils.HEATMAP_FEATURE_CSV_TRAIN_ALL_SECOND_MODEL)
-    extract_features_test('_prob.png', '_prob_%s.png' % utils.SECOND_HEATMAP_MODEL,
+    extract_features_test(utils.HEATMAP_PROB_POSTFIX, second_model_postfix,
                           utils.HEATMAP_FEATURE_CSV_TEST_SECOND_MODEL)
 
 
 if __name__ == '__main__':
-    wsi_ops = WSIOps()
     # extract_features_first_heatmap()
     extract_features_both_heatmap()
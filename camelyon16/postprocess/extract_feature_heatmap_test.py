@@ -0,0 +1,96 @@
+"""Tests for extract_feature_heatmap."""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from camelyon16 import utils as utils
+from camelyon16.ops.heatmap_store import read_heatmap_prob, write_heatmap_prob
+from camelyon16.ops.synthetic_wsi import generate_synthetic_slide
+from camelyon16.ops.wsi_ops import WSIOps
+from camelyon16.postprocess.extract_feature_heatmap import N_FEATURES, extract_features, extract_slide_features
+
+
+class ExtractSlideFeaturesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.slide = generate_synthetic_slide(self.tmp_dir, width=1000, height=700, tile_size=128, levels=3, seed=3)
+        self.heatmap_dir = os.path.join(self.tmp_dir, 'heatmaps')
+        for name, value in (('HEAT_MAP_DIR', self.heatmap_dir), ('TISSUE_MASK_CACHE_DIR', None)):
+            self.addCleanup(setattr, utils, name, getattr(utils, name))
+            setattr(utils, name, value)
+
+        # heatmap of the lowest level, (175, 250): two t90 regions inside a t50 one and a lone t50 pixel
+        self.heatmap = np.zeros((175, 250), dtype=np.float32)
+        self.heatmap[40:90, 60:140] = 0.6
+        self.heatmap[50:60, 70:85] = 0.95
+        self.heatmap[70:85, 100:130] = 0.92
+        self.heatmap[150, 30] = 0.7
+        self.second_heatmap = np.full_like(self.heatmap, 0.1)
+        self.second_heatmap[70:85, 100:130] = 0.8
+        self.write('_prob.heatmap', self.heatmap)
+        self.write('_prob_model8.heatmap', self.second_heatmap)
+        self.image_open = WSIOps.get_image_open(self.slide.wsi_path)
+
+    def write(self, postfix, heatmap):
+        write_heatmap_prob(os.path.join(self.heatmap_dir, 'Tumor_001') + postfix, heatmap, slide_id='Tumor_001',
+                           level=2, grid_stride=4, chunk_size=32)
+
+    def read(self, postfix):
+        # the float16 probabilities of the store
+        return read_heatmap_prob(os.path.join(self.heatmap_dir, 'Tumor_001') + postfix)
+
+    def testWindowedFeaturesMatchWholeHeatmap(self):
+        self.assertEqual(self.image_open.shape, self.heatmap.shape)
+        self.assertGreater(np.count_nonzero(self.image_open), 0)
+
+        features = extract_slide_features(self.slide.wsi_path, '_prob.heatmap', None, 0.50, None)
+        self.assertEqual(len(features), N_FEATURES)
+        # skewness and kurtosis of two regions may be nan
+        np.testing.assert_array_equal(features, extract_features(self.read('_prob.heatmap'), self.image_open))
+        self.assertEqual(features[0], 2)
+        # the largest t50 region holds both t90 ones
+        self.assertEqual(features[2], 50 * 80)
+
+        merged_features = extract_slide_features(self.slide.wsi_path, '_prob.heatmap', '_prob_model8.heatmap', 0.50,
+                                                 None)
+        # the second model drops the t90 region it does not find
+        first, second = self.read('_prob.heatmap'), self.read('_prob_model8.heatmap')
+        merged = np.where((first >= 0.90) & (second < 0.50), second, first)
+        np.testing.assert_array_equal(merged_features, extract_features(merged, self.image_open))
+        self.assertEqual(merged_features[0], 1)
+
+    def testNoTumorRegion(self):
+        self.write('_prob.heatmap', np.minimum(self.heatmap, 0.5))
+        self.assertEqual(extract_slide_features(self.slide.wsi_path, '_prob.heatmap', None, 0.50, None),
+                         [0.00] * N_FEATURES)
+
+    def testFeatureCache(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        features = extract_slide_features(self.slide.wsi_path, '_prob.heatmap', None, 0.50, cache_dir)
+        entries = os.listdir(cache_dir)
+        self.assertEqual(len(entries), 1)
+
+        # a hit returns the stored entry without recomputing it
+        entry_path = os.path.join(cache_dir, entries[0])
+        with open(entry_path) as f:
+            entry = json.load(f)
+        np.testing.assert_array_equal(entry['features'], features)
+        entry['features'] = [-1.0] * N_FEATURES
+        with open(entry_path, 'w') as f:
+            json.dump(entry, f)
+        self.assertEqual(extract_slide_features(self.slide.wsi_path, '_prob.heatmap', None, 0.50, cache_dir),
+                         [-1.0] * N_FEATURES)
+
+        self.write('_prob.heatmap', self.heatmap * 0.99)
+        extract_slide_features(self.slide.wsi_path, '_prob.heatmap', None, 0.50, cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
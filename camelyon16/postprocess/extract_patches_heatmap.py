@@ -15,6 +15,7 @@ import tensorflow as tf
 from PIL import Image
 
 from camelyon16 import utils as utils
+from camelyon16.ops.region_planner import iter_coalesced_patches
 from camelyon16.ops.wsi_ops import WSIOps
 
 
@@ -53,23 +54,26 @@ def extract_patch_from_bb(thread_index, bounding_box, wsi_image, image_open, lev
 
     """
     # factor to map low res cords into high res
-    mag_factor = pow(2, level_used)
+    mag_factor = WSIOps.get_mag_factor(wsi_image, level_used)
     b_x_start = int(bounding_box[0])
     b_y_start = int(bounding_box[1])
     b_x_end = (int(bounding_box[0]) + int(bounding_box[2]))
     b_y_end = (int(bounding_box[1]) + int(bounding_box[3]))
-    col_cords = np.arange(b_x_start, b_x_end)
-    row_cords = np.arange(b_y_start, b_y_end)
-    print('Apx. patch count for thread(%d): %d' % (thread_index, len(row_cords) * len(col_cords)))
+    print('Apx. patch count for thread(%d): %d' % (thread_index, (b_y_end - b_y_start) * (b_x_end - b_x_start)))
 
-    for row in row_cords:
-        for col in col_cords:
-            if int(image_open[row, col]) is not utils.PIXEL_BLACK:
-                wsi_patch = wsi_image.read_region((col * mag_factor, row * mag_factor), 0,
-                                                  (utils.PATCH_SIZE, utils.PATCH_SIZE))
-                file_name = str(row) + '_' + str(col) + '_' + str(level_used)
-                wsi_patch.save(os.path.join(heat_map_dir, file_name), 'PNG')
-                wsi_patch.close()
+    rows, cols = np.nonzero(image_open[b_y_start:b_y_end, b_x_start:b_x_end] != utils.PIXEL_BLACK)
+    rows += b_y_start
+    cols += b_x_start
+
+    # adjacent patches are read together through coalesced super-reads
+    xs = np.round(cols * mag_factor).astype(np.int64)
+    ys = np.round(rows * mag_factor).astype(np.int64)
+    for i, wsi_patch in iter_coalesced_patches(wsi_image, xs, ys, 0,
+                                               (utils.PATCH_SIZE, utils.PATCH_SIZE),
+                                               max_bytes=utils.COALESCED_READ_BYTES,
+                                               min_fill=utils.COALESCED_READ_MIN_FILL):
+        file_name = str(rows[i]) + '_' + str(cols[i]) + '_' + str(level_used)
+        Image.fromarray(wsi_patch).save(os.path.join(heat_map_dir, file_name), 'PNG')
 
 
 def extract_patches(wsi_image_path, wsi_image_name, wsi_mask_path=None):
@@ -89,7 +93,8 @@ def extract_patches(wsi_image_path, wsi_image_name, wsi_mask_path=None):
         wsi_image, rgb_image, _, _, level_used = wsi_ops.read_wsi_tumor(wsi_image_path, wsi_mask_path)
         assert wsi_image is not None, 'Failed to read Whole Slide Image %s.' % wsi_image_name
 
-    bounding_boxes, rgb_contour, image_open = wsi_ops.find_roi_bbox(np.array(rgb_image))
+    bounding_boxes, image_open = wsi_ops.find_roi_bbox_cached(wsi_image_path, level_used, rgb_image=rgb_image)
+    _, rgb_contour = wsi_ops.get_bbox(image_open, rgb_image=np.array(rgb_image))
 
     Image.fromarray(rgb_image).save(os.path.join(utils.HEAT_MAP_WSIs_PATH, wsi_image_name), 'PNG')
     Image.fromarray(rgb_contour).save(os.path.join(utils.HEAT_MAP_WSIs_PATH, wsi_image_name + '_contour'), 'PNG')
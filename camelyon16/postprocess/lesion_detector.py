@@ -0,0 +1,170 @@
+"""
+    Lesion candidates of the heatmaps: local maxima of the tumor probability, thinned out by a non-maximum suppression
+    in level 0 microns, written as one CSV of 'probability, x, y' lines (level 0 coordinates) per slide, the format of
+    the CAMELYON16 lesion level submissions read by ops/froc.py.
+
+    python -m camelyon16.postprocess.lesion_detector <output_dir> [--heatmap-dir ...] [--postfix _prob.heatmap]
+"""
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from camelyon16 import utils as utils
+from camelyon16.ops.heatmap_store import HeatmapStore, read_heatmap_prob
+
+
+def get_disk(radius):
+    size = int(np.floor(radius))
+    rows, cols = np.mgrid[-size:size + 1, -size:size + 1]
+    return rows ** 2 + cols ** 2 <= radius ** 2
+
+
+def find_peaks(heatmap_prob, radius, threshold):
+    """
+        Pixels >= threshold holding the maximum of the disk of radius around them, one max filter over the heatmap.
+
+        :return: (rows, cols, probabilities) of the peaks, a plateau (8-connected peak pixels) yields its pixel
+                 closest to its centroid
+    """
+    footprint = get_disk(max(radius, 1))
+    # the filter runs on the bounding box of the pixels >= threshold padded by the disk, most of a slide is below it
+    rows, cols = np.nonzero(heatmap_prob >= threshold)
+    if len(rows) == 0:
+        return rows, cols, heatmap_prob[rows, cols]
+    pad = footprint.shape[0] // 2
+    top, left = max(rows.min() - pad, 0), max(cols.min() - pad, 0)
+    crop = heatmap_prob[top:rows.max() + pad + 1, left:cols.max() + pad + 1]
+    # grey dilation with the disk, the default border of cv2.dilate() never wins the max
+    peaks = (crop >= threshold) & (crop == cv2.dilate(crop, footprint.astype(np.uint8)))
+    labels, count = ndimage.label(peaks, structure=np.ones((3, 3), dtype=bool))
+    rows, cols = np.nonzero(labels)
+    plateau = labels[rows, cols] - 1
+    size = np.bincount(plateau, minlength=count)
+    distance = (rows - (np.bincount(plateau, weights=rows, minlength=count) / size)[plateau]) ** 2 + \
+               (cols - (np.bincount(plateau, weights=cols, minlength=count) / size)[plateau]) ** 2
+    # sorted by plateau then distance, the first pixel of every plateau is the closest to its centroid
+    order = np.lexsort((distance, plateau))
+    first = order[np.r_[True, plateau[order][1:] != plateau[order][:-1]]]
+    rows, cols = rows[first] + top, cols[first] + left
+    return rows, cols, heatmap_prob[rows, cols]
+
+
+def suppress(rows, cols, probs, radius):
+    """
+        Greedy non-maximum suppression of the peaks: the most probable one is kept and the ones within radius of it
+        dropped, and so on. find_peaks() leaves few points, only peaks whose disks overlap without dominating each
+        other remain to be resolved here.
+
+        :return: indices of the kept peaks, most probable first
+    """
+    # stable sort, ties keep the raster order
+    order = np.argsort(-probs, kind='stable')
+    tree = cKDTree(np.stack([rows, cols], axis=1))
+    suppressed = np.zeros(len(probs), dtype=bool)
+    kept = []
+    for index in order:
+        if suppressed[index]:
+            continue
+        kept.append(index)
+        suppressed[tree.query_ball_point((rows[index], cols[index]), radius)] = True
+    return np.array(kept, dtype=np.int64)
+
+
+def detect_lesions(heatmap_prob, grid_stride, patch_size=None, threshold=None, nms_radius=None, resolution=None):
+    """
+        :param heatmap_prob: (rows, cols) tumor probabilities, heatmap_prob[row, col] is the probability of the
+                             patch_size patch whose level 0 origin is (col, row) * grid_stride
+        :param grid_stride: level 0 pixels between two heatmap pixels
+        :param patch_size: defaults to utils.PATCH_SIZE
+        :param threshold: lowest probability of a detection, defaults to utils.LESION_THRESHOLD
+        :param nms_radius: minimum distance between two detections in microns, defaults to utils.LESION_NMS_RADIUS
+        :param resolution: microns per level 0 pixel, defaults to utils.FROC_PIXEL_RESOLUTION
+        :return: (x, y, probabilities) of the detections, level 0 patch centers, most probable first
+    """
+    patch_size = patch_size or utils.PATCH_SIZE
+    threshold = utils.LESION_THRESHOLD if threshold is None else threshold
+    nms_radius = utils.LESION_NMS_RADIUS if nms_radius is None else nms_radius
+    resolution = resolution or utils.FROC_PIXEL_RESOLUTION
+    radius = nms_radius / (resolution * grid_stride)
+
+    heatmap_prob = np.asarray(heatmap_prob, dtype=np.float32).reshape(heatmap_prob.shape[:2])
+    rows, cols, probs = find_peaks(heatmap_prob, radius, threshold)
+    if len(probs) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    kept = suppress(rows, cols, probs, radius)
+    x = np.round(cols[kept] * grid_stride + patch_size / 2.0).astype(np.int64)
+    y = np.round(rows[kept] * grid_stride + patch_size / 2.0).astype(np.int64)
+    return x, y, probs[kept].astype(np.float64)
+
+
+def write_detections(csv_path, x, y, probs):
+    with open(csv_path, 'w') as f:
+        for prob, x_i, y_i in zip(probs, x, y):
+            f.write('%.6f,%d,%d\n' % (prob, x_i, y_i))
+
+
+def detect_slide(heatmap_prob_path, csv_path, grid_stride=None, patch_size=None, threshold=None, nms_radius=None):
+    """
+        Detections of one heatmap, written to csv_path. Heatmap stores know their grid stride and patch size, they
+        must be given for 8 bit heatmap images.
+
+        :return: number of detections
+    """
+    if os.path.isdir(heatmap_prob_path):
+        meta = HeatmapStore(heatmap_prob_path).meta
+        grid_stride = grid_stride or meta['grid_stride']
+        patch_size = patch_size or meta['patch_size']
+    assert grid_stride, 'Grid stride of %s unknown' % heatmap_prob_path
+    x, y, probs = detect_lesions(read_heatmap_prob(heatmap_prob_path), grid_stride, patch_size, threshold,
+                                 nms_radius)
+    write_detections(csv_path, x, y, probs)
+    return len(probs)
+
+
+def detect_slides(heatmap_dir, heatmap_prob_postfix, output_dir, grid_stride=None, patch_size=None, threshold=None,
+                  nms_radius=None, num_workers=None):
+    """
+        Detections of every <wsi><heatmap_prob_postfix> heatmap of heatmap_dir, one process pool job per slide,
+        written to output_dir/<wsi>.csv.
+
+        :param num_workers: defaults to utils.FEATURE_NUM_WORKERS
+        :return: dict slide -> number of detections
+    """
+    num_workers = num_workers or utils.FEATURE_NUM_WORKERS
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    heatmap_prob_paths = sorted(glob.glob(os.path.join(heatmap_dir, '*%s' % heatmap_prob_postfix)))
+    print('heatmaps: %d, workers: %d' % (len(heatmap_prob_paths), num_workers))
+
+    counts = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {}
+        for heatmap_prob_path in heatmap_prob_paths:
+            slide = os.path.basename(heatmap_prob_path)[:-len(heatmap_prob_postfix)]
+            futures[executor.submit(detect_slide, heatmap_prob_path, os.path.join(output_dir, slide + '.csv'),
+                                    grid_stride, patch_size, threshold, nms_radius)] = slide
+        for future in as_completed(futures):
+            counts[futures[future]] = future.result()
+            print('%s: %d detections (%d / %d)' % (futures[future], counts[futures[future]], len(counts),
+                                                  len(futures)))
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output_dir', help='the <slide>.csv detections are written there')
+    parser.add_argument('--heatmap-dir', default=utils.HEAT_MAP_DIR)
+    parser.add_argument('--postfix', default=utils.HEATMAP_PROB_POSTFIX)
+    parser.add_argument('--grid-stride', type=float, default=None, help='needed for heatmap images only')
+    parser.add_argument('--threshold', type=float, default=None)
+    parser.add_argument('--nms-radius', type=float, default=None, help='microns at level 0')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    detect_slides(args.heatmap_dir, args.postfix, args.output_dir, args.grid_stride, threshold=args.threshold,
+                  nms_radius=args.nms_radius, num_workers=args.workers)
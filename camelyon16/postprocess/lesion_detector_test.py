@@ -0,0 +1,58 @@
+"""Tests for lesion_detector."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from camelyon16.ops.froc import read_candidates
+from camelyon16.ops.heatmap_store import write_heatmap_store
+from camelyon16.postprocess.lesion_detector import detect_lesions, detect_slides
+
+
+def blob(shape, row, col, sigma, peak):
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    return peak * np.exp(-((rows - row) ** 2 + (cols - col) ** 2) / (2.0 * sigma ** 2))
+
+
+class LesionDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        shape = (80, 60)
+        self.heatmap = np.maximum.reduce([blob(shape, 20, 15, 3, 0.95), blob(shape, 22, 19, 3, 0.90),
+                                          blob(shape, 60, 40, 4, 0.70), blob(shape, 5, 55, 2, 0.30)])
+        # a flat topped lesion yields one detection
+        self.heatmap[40:44, 10:14] = 0.8
+
+    def testPeaksAndSuppression(self):
+        # 64 level 0 pixels per heatmap pixel of 0.25 microns: 16 microns per heatmap pixel
+        x, y, probs = detect_lesions(self.heatmap, grid_stride=64, patch_size=256, threshold=0.5, nms_radius=160,
+                                     resolution=0.25)
+        np.testing.assert_allclose(probs, [0.95, 0.8, 0.7], atol=1e-6)
+        self.assertEqual((x[0], y[0]), (15 * 64 + 128, 20 * 64 + 128))
+        self.assertEqual((x[2], y[2]), (40 * 64 + 128, 60 * 64 + 128))
+        self.assertTrue(10 * 64 + 128 <= x[1] <= 13 * 64 + 128 and 40 * 64 + 128 <= y[1] <= 43 * 64 + 128)
+
+        # a smaller radius keeps the second peak of the first lesion
+        _, _, probs = detect_lesions(self.heatmap, grid_stride=64, patch_size=256, threshold=0.5, nms_radius=40,
+                                     resolution=0.25)
+        np.testing.assert_allclose(probs, [0.95, 0.9, 0.8, 0.7], atol=1e-6)
+
+    def testSlidesToCsv(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        for slide in ('Test_001', 'Test_002'):
+            write_heatmap_store(os.path.join(work_dir, slide + '_prob.heatmap'), self.heatmap, slide_id=slide,
+                                grid_stride=64.0, patch_size=256)
+        output_dir = os.path.join(work_dir, 'detections')
+
+        counts = detect_slides(work_dir, '_prob.heatmap', output_dir, threshold=0.5, nms_radius=200, num_workers=2)
+        self.assertEqual(counts, {'Test_001': 3, 'Test_002': 3})
+        x, y, probs = read_candidates(os.path.join(output_dir, 'Test_002.csv'))
+        self.assertEqual((x[0], y[0]), (15 * 64 + 128, 20 * 64 + 128))
+        np.testing.assert_allclose(probs, [0.95, 0.8, 0.7], atol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,9 +8,14 @@ from sklearn.naive_bayes import GaussianNB
 from sklearn.metrics import roc_curve, auc
 
 from camelyon16 import utils as utils
+from camelyon16.ops.auc_bootstrap import auc_confidence_interval, reference_auc_test
 
 FEATURE_START_INDEX = 6
 
+# AUCs of the published CAMELYON16 ROC curves of utils
+REFERENCE_AUCS = [('Harvard&MIT', 0.9250), ('ExB', 0.9173), ('QuincyWong', 0.8680),
+                  ('MiddleEastTechnicalUniversity', 0.8669), ('NLPLOGIX', 0.8332)]
+
 
 def export_tree(forest):
     i_tree = 0
@@ -33,10 +38,16 @@ def plot_roc(gt_y, prob_predicted_y, subset):
     # print('tpr after: ', tpr)
 
     roc_auc = auc(fpr, tpr)
+    interval = auc_confidence_interval(gt_y, predictions)
+    print('%s AUC: %0.4f, 95%% CI [%0.4f, %0.4f]' % (subset, roc_auc, interval.lower, interval.upper))
+    for name, reference_auc in REFERENCE_AUCS:
+        print('%s p-value AUC > %s (%0.4f): %0.4f' % (subset, name, reference_auc,
+                                                      reference_auc_test(interval, reference_auc)))
 
     plt.figure(0).clf()
     # r'$\alpha_i > \beta_i$'
-    plt.plot(fpr, tpr, 'b', label=r'$AUC_{Proposed} = %0.4f$' % roc_auc)
+    plt.plot(fpr, tpr, 'b', label=r'$AUC_{Proposed} = %0.4f$ [%0.4f, %0.4f]' % (roc_auc, interval.lower,
+                                                                                interval.upper))
     plt.plot(utils.fpr_harvard, utils.tpr_harvard, 'r', label=r'$AUC_{Harvard&MIT} = %0.4f$' % 0.9250)
     plt.plot(utils.fpr_exb, utils.tpr_exb, 'g', label=r'$AUC_{ExB} = %0.4f$' % 0.9173)
     plt.plot(utils.fpr_quincy_wong, utils.tpr_quincy_wong, 'c', label=r'$AUC_{QuincyWong} = %0.4f$' % 0.8680)
@@ -0,0 +1,159 @@
+"""
+    Cross validated search over the slide level classifiers (SVM, random forest, kNN, Gaussian naive Bayes) trained on
+    the heatmap features, and persistence of the selected pipeline together with the feature names it was trained on,
+    so that the test slides are scored without retraining.
+
+    python -m camelyon16.postprocess.wsi_classifier_search train <train.csv> [--model models/wsi_classifier.joblib]
+    python -m camelyon16.postprocess.wsi_classifier_search score <test.csv> <predictions.csv> [--model ...]
+"""
+import argparse
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import GridSearchCV, StratifiedKFold
+from sklearn.naive_bayes import GaussianNB
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC
+
+from camelyon16 import utils as utils
+
+# same columns as wsi_classification_modular: the first 6 features are left out
+FEATURE_START_INDEX = 6
+
+
+def get_candidates():
+    """
+        :return: dict name -> (pipeline, parameter grid). The SVMs are searched without Platt scaling, the selected
+                 one is refit with probability=True
+    """
+    return {
+        'svm_linear': (Pipeline([('scaler', StandardScaler()), ('clf', SVC(kernel='linear'))]),
+                       {'clf__C': [0.1, 0.5, 1.0, 1.5, 2.0, 5.0]}),
+        'svm_rbf': (Pipeline([('scaler', StandardScaler()), ('clf', SVC(kernel='rbf'))]),
+                    {'clf__C': [0.5, 1.0, 2.0, 5.0, 10.0], 'clf__gamma': ['scale', 0.01, 0.1]}),
+        'random_forest': (Pipeline([('clf', RandomForestClassifier(n_estimators=50, random_state=0))]),
+                          {'clf__max_depth': [None, 4, 8], 'clf__min_samples_leaf': [1, 3]}),
+        'knn': (Pipeline([('scaler', StandardScaler()), ('clf', KNeighborsClassifier())]),
+                {'clf__n_neighbors': [3, 5, 7, 11], 'clf__weights': ['uniform', 'distance']}),
+        'gaussian_nb': (Pipeline([('clf', GaussianNB())]),
+                        {'clf__var_smoothing': [1e-9, 1e-6, 1e-3]}),
+    }
+
+
+def search_classifiers(x, y, candidate_names=None, cv_folds=None, n_jobs=None, scoring='roc_auc'):
+    """
+        Grid search of every candidate, the fits of a candidate (parameters x folds) run in joblib worker processes.
+
+        :param x: DataFrame of the features
+        :param y: labels, 1 for tumor slides
+        :param candidate_names: keys of get_candidates(), all of them if None
+        :param cv_folds: stratified folds, defaults to utils.CLASSIFIER_CV_FOLDS
+        :param n_jobs: joblib worker processes, defaults to utils.CLASSIFIER_NUM_JOBS
+        :param scoring: sklearn scorer of the search
+        :return: (best, results): best is the dict save_classifier() persists, with the selected pipeline refit on
+                 all of x; results is a list of (name, cv score, parameters), best first
+    """
+    cv_folds = cv_folds or utils.CLASSIFIER_CV_FOLDS
+    n_jobs = utils.CLASSIFIER_NUM_JOBS if n_jobs is None else n_jobs
+    candidates = get_candidates()
+    candidate_names = candidate_names or sorted(candidates)
+    cv = StratifiedKFold(n_splits=cv_folds, shuffle=True, random_state=0)
+
+    results = []
+    for name in candidate_names:
+        pipeline, param_grid = candidates[name]
+        start_time = time.time()
+        search = GridSearchCV(pipeline, param_grid, scoring=scoring, cv=cv, n_jobs=n_jobs, refit=False)
+        search.fit(x, y)
+        results.append((name, search.best_score_, search.best_params_))
+        print('%-14s %s: %.4f %s (%.1fs)' % (name, scoring, search.best_score_, search.best_params_,
+                                             time.time() - start_time))
+    results.sort(key=lambda result: -result[1])
+
+    name, cv_score, params = results[0]
+    model = clone(candidates[name][0]).set_params(**params)
+    if isinstance(model.named_steps['clf'], SVC):
+        model.set_params(clf__probability=True, clf__random_state=0)
+    model.fit(x, y)
+    best = {'classifier': name, 'params': params, 'cv_score': cv_score, 'scoring': scoring,
+            'feature_names': list(x.columns), 'model': model}
+    return best, results
+
+
+def save_classifier(path, best):
+    """
+        Saves the dict returned by search_classifiers() with joblib, next to the sklearn version it was fit with.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    joblib.dump(dict(best, sklearn_version=sklearn.__version__), path)
+
+
+def load_classifier(path):
+    best = joblib.load(path)
+    if best['sklearn_version'] != sklearn.__version__:
+        print('warning: %s was saved with scikit-learn %s, running %s' % (path, best['sklearn_version'],
+                                                                          sklearn.__version__))
+    return best
+
+
+def score_slides(best, df):
+    """
+        :param best: dict of load_classifier()
+        :param df: DataFrame of the slide features, any column order as long as it has the saved feature names
+        :return: tumor probability of every row of df
+    """
+    missing = [name for name in best['feature_names'] if name not in df.columns]
+    assert not missing, 'Features missing from the data: %s' % ', '.join(missing)
+    return best['model'].predict_proba(df[best['feature_names']])[:, 1]
+
+
+def load_train_data(f_train):
+    df_train = pd.read_csv(f_train)
+    feature_column_names = df_train.columns[FEATURE_START_INDEX:len(df_train.columns) - 1]
+    label_column_name = df_train.columns[len(df_train.columns) - 1]
+    return df_train[feature_column_names], df_train[label_column_name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=utils.WSI_CLASSIFIER_PATH, help='saved classifier')
+    subparsers = parser.add_subparsers(dest='command')
+    train_parser = subparsers.add_parser('train', help='search the classifiers and save the best one')
+    train_parser.add_argument('features', help='training features CSV, label in the last column')
+    train_parser.add_argument('--classifiers', default='', help='comma separated subset of %s' %
+                                                                ','.join(sorted(get_candidates())))
+    train_parser.add_argument('--folds', type=int, default=None)
+    train_parser.add_argument('--jobs', type=int, default=None)
+    score_parser = subparsers.add_parser('score', help='score slides with the saved classifier')
+    score_parser.add_argument('features', help='features CSV of the slides to score')
+    score_parser.add_argument('predictions', help='CSV the tumor probabilities are written to')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        train_x, train_y = load_train_data(args.features)
+        best, _ = search_classifiers(train_x, train_y, [name for name in args.classifiers.split(',') if name],
+                                     args.folds, args.jobs)
+        save_classifier(args.model, best)
+        print('saved %s (%s: %.4f) to %s' % (best['classifier'], best['scoring'], best['cv_score'], args.model))
+    elif args.command == 'score':
+        best = load_classifier(args.model)
+        probabilities = score_slides(best, pd.read_csv(args.features))
+        pd.DataFrame({'probability': probabilities}).to_csv(args.predictions, index=False)
+        print('scored %d slides with %s, mean probability %.4f' % (len(probabilities), best['classifier'],
+                                                                   np.mean(probabilities)))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
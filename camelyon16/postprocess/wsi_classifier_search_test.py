@@ -0,0 +1,43 @@
+"""Tests for wsi_classifier_search."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from camelyon16.postprocess.wsi_classifier_search import load_classifier, save_classifier, score_slides, \
+    search_classifiers
+
+
+class WSIClassifierSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.y = pd.Series(np.arange(120) % 2)
+        self.x = pd.DataFrame(rng.normal(size=(120, 5)), columns=['f%d' % i for i in range(5)])
+        self.x['f2'] += 2.5 * self.y
+
+    def testSearchSaveAndScore(self):
+        best, results = search_classifiers(self.x, self.y, ['gaussian_nb', 'svm_linear'], cv_folds=3, n_jobs=2)
+        self.assertEqual(sorted(result[0] for result in results), ['gaussian_nb', 'svm_linear'])
+        self.assertEqual(best['cv_score'], max(result[1] for result in results))
+        self.assertGreater(best['cv_score'], 0.9)
+        self.assertEqual(best['feature_names'], list(self.x.columns))
+
+        model_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, model_dir)
+        path = os.path.join(model_dir, 'models', 'wsi_classifier.joblib')
+        save_classifier(path, best)
+        loaded = load_classifier(path)
+
+        # columns are picked by name, the order of the scored data does not matter
+        shuffled = self.x[list(reversed(self.x.columns))]
+        np.testing.assert_allclose(score_slides(loaded, shuffled), best['model'].predict_proba(self.x)[:, 1])
+        with self.assertRaises(AssertionError):
+            score_slides(loaded, self.x.drop(columns=['f2']))
+
+
+if __name__ == '__main__':
+    unittest.main()
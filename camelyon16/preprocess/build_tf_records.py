@@ -75,6 +75,7 @@ import threading
 import numpy as np
 import tensorflow as tf
 import camelyon16.utils as utils
+from camelyon16.ops.patch_writer import ShardPatchReader
 
 tf.app.flags.DEFINE_string('output_directory', utils.TRAIN_TF_RECORDS_DIR,
                            'Output data directory')
@@ -93,6 +94,10 @@ tf.app.flags.DEFINE_integer('num_val_threads', 5,
 tf.app.flags.DEFINE_boolean('augmentation', False,
                             'Flag for data augmentation.')
 
+tf.app.flags.DEFINE_string('input_format', utils.PATCH_OUTPUT_FORMAT,
+                           'Layout of the patches: "directory" (one file per patch) or "shards" '
+                           '(tar shards written by ops/patch_writer.py).')
+
 FLAGS = tf.app.flags.FLAGS
 
 
@@ -187,18 +192,25 @@ def _is_png(filename):
     return '.png' in filename
 
 
-def _process_image(filename, coder):
+def _process_image(filename, coder, reader=None):
     """Process a single image file.
 
     Args:
-      filename: string, path to an image file e.g., '/path/to/example.JPG'.
+      filename: string, path to an image file e.g., '/path/to/example.JPG', or
+        a ShardRecord when reader is given.
       coder: instance of ImageCoder to provide tf image coding utils.
+      reader: ShardPatchReader holding the record, None for image files.
     Returns:
       image_buffer: string, JPEG encoding of RGB image.
       height: integer, image height in pixels.
       width: integer, image width in pixels.
     """
-    # Read the image file.
+    # Read the image file, or the image straight out of its shard.
+    if reader is not None:
+        image_data = reader.read_bytes(filename)
+        image = coder.decode_png(image_data) if _is_png(filename.name) else coder.decode_jpeg(image_data)
+        return image_data, image.shape[0], image.shape[1]
+
     with tf.gfile.FastGFile(filename, 'r') as f:
         image_data = f.read()
 
@@ -219,7 +231,7 @@ def _process_image(filename, coder):
     return image_data, height, width
 
 
-def _process_image_files_batch(coder, thread_index, ranges, name, file_names, labels, num_shards):
+def _process_image_files_batch(coder, thread_index, ranges, name, file_names, labels, num_shards, reader=None):
     """Processes and saves list of images as TFRecord in 1 thread.
 
     Args:
@@ -231,6 +243,7 @@ def _process_image_files_batch(coder, thread_index, ranges, name, file_names, la
       file_names: list of strings; each string is a path to an image file
       labels: list of integer; each integer identifies the ground truth
       num_shards: integer number of shards for this data set.
+      reader: ShardPatchReader when file_names holds ShardRecords.
     """
     # Each thread produces N shards where N = int(num_shards / num_threads).
     # For instance, if num_shards = 128, and the num_threads = 2, then the first
@@ -258,7 +271,9 @@ def _process_image_files_batch(coder, thread_index, ranges, name, file_names, la
             filename = file_names[i]
             label = labels[i]
 
-            image_buffer, height, width = _process_image(filename, coder)
+            image_buffer, height, width = _process_image(filename, coder, reader)
+            if reader is not None:
+                filename = filename.name
 
             example = _convert_to_example(filename, image_buffer, label, height, width)
             writer.write(example.SerializeToString())
@@ -280,7 +295,7 @@ def _process_image_files_batch(coder, thread_index, ranges, name, file_names, la
     sys.stdout.flush()
 
 
-def _process_image_files(name, file_names, labels, num_shards, num_threads):
+def _process_image_files(name, file_names, labels, num_shards, num_threads, reader=None):
     """Process and save list of images as TFRecord of Example protos.
 
     Args:
@@ -289,6 +304,7 @@ def _process_image_files(name, file_names, labels, num_shards, num_threads):
       texts: list of strings; each string is human readable, e.g. 'dog'
       labels: list of integer; each integer identifies the ground truth
       num_shards: integer number of shards for this data set.
+      reader: ShardPatchReader when file_names holds ShardRecords.
     """
     assert len(file_names) == len(labels)
 
@@ -310,7 +326,7 @@ def _process_image_files(name, file_names, labels, num_shards, num_threads):
 
     threads = []
     for thread_index in range(len(ranges)):
-        args = (coder, thread_index, ranges, name, file_names, labels, num_shards)
+        args = (coder, thread_index, ranges, name, file_names, labels, num_shards, reader)
         t = threading.Thread(target=_process_image_files_batch, args=args)
         t.start()
         threads.append(t)
@@ -385,6 +401,37 @@ def _find_image_files(data_dir):
     return file_names, labels
 
 
+def _find_shard_records(data_dir):
+    """Build a list of all patches and labels from the patch shards of the data set.
+
+    Args:
+      data_dir: string, path to the root directory of the shards. Shards are
+        looked up in data_dir itself and in its label-0 and label-1
+        sub-directories; labels are read from the shard indices.
+
+    Returns:
+      records: list of ShardRecord.
+      labels: list of integer; each integer identifies the ground truth.
+      reader: ShardPatchReader to read the records with.
+    """
+    print('Determining list of patches and labels from the shards in %s.' % data_dir)
+    reader = ShardPatchReader([data_dir] + [os.path.join(data_dir, label) for label in ['label-0', 'label-1']])
+    records = list(reader.records)
+    labels = [int(record.label) for record in records]
+
+    # Same repeatable shuffling as for image files, shard members are stored slide by slide.
+    shuffled_index = list(range(len(records)))
+    random.seed(12345)
+    random.shuffle(shuffled_index)
+
+    records = [records[i] for i in shuffled_index]
+    labels = [labels[i] for i in shuffled_index]
+
+    print('Found %d patches in %d shards inside %s.' %
+          (len(records), len(set(record.shard_path for record in records)), data_dir))
+    return records, labels, reader
+
+
 def _process_dataset(name, directory, num_shards, num_threads):
     """Process a complete data set and save it as a TFRecord.
 
@@ -393,6 +440,12 @@ def _process_dataset(name, directory, num_shards, num_threads):
       directory: string, root path to the data set.
       num_shards: integer number of shards for this data set.
     """
+    if FLAGS.input_format == 'shards':
+        records, labels, reader = _find_shard_records(directory)
+        _process_image_files(name, records, labels, num_shards, num_threads, reader)
+        reader.close()
+        return
+
     file_names, labels = _find_image_files(directory)
     _process_image_files(name, file_names, labels, num_shards, num_threads)
 
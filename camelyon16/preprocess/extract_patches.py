@@ -2,67 +2,99 @@ import glob
 import os
 import sys
 
-import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 
 import camelyon16.utils as utils
+from camelyon16.ops.heatmap_store import read_heatmap_prob
 from camelyon16.ops.wsi_ops import PatchExtractor
 from camelyon16.ops.wsi_ops import WSIOps
 
 
-def extract_positive_patches_from_tumor_wsi(wsi_paths, mask_paths, wsi_ops, patch_extractor, patch_index,
-                                            augmentation=False):
+def extract_positive_patches_from_tumor_slide(image_path, mask_path, wsi_ops, patch_extractor, patch_index,
+                                              patch_save_dir=None, patch_prefix=None, writer=None):
+    if patch_save_dir is None:
+        patch_save_dir = utils.PATCHES_TUMOR_POSITIVE_PATH
+    if patch_prefix is None:
+        patch_prefix = utils.PATCH_TUMOR_PREFIX
 
-    image_mask_pair = zip(wsi_paths, mask_paths)
-    image_mask_pair = list(image_mask_pair)
-    # image_mask_pair = image_mask_pair[67:68]
-
-    patch_save_dir = utils.PATCHES_TUMOR_POSITIVE_PATH
-    patch_prefix = utils.PATCH_TUMOR_PREFIX
-
-    for image_path, mask_path in image_mask_pair:
-        print('extract_positive_patches_from_tumor_wsi(): %s' % utils.get_filename_from_path(image_path))
-        wsi_image, rgb_image, wsi_mask, tumor_gt_mask, level_used = wsi_ops.read_wsi_tumor(image_path, mask_path)
-        assert wsi_image is not None, 'Failed to read Whole Slide Image %s.' % image_path
+    print('extract_positive_patches_from_tumor_wsi(): %s' % utils.get_filename_from_path(image_path))
+    wsi_image, rgb_image, wsi_mask, tumor_gt_mask, level_used = wsi_ops.read_wsi_tumor(
+        image_path, mask_path, cache_bytes=utils.TILE_CACHE_BYTES)
+    assert wsi_image is not None, 'Failed to read Whole Slide Image %s.' % image_path
 
+    # the handles are closed on errors and time outs too, pool workers outlive the slides
+    try:
         bounding_boxes = wsi_ops.find_roi_bbox_tumor_gt_mask(np.array(tumor_gt_mask))
 
         patch_index = patch_extractor.extract_positive_patches_from_tumor_region(wsi_image, np.array(tumor_gt_mask),
                                                                                  level_used, bounding_boxes,
                                                                                  patch_save_dir, patch_prefix,
-                                                                                 patch_index, wsi_mask)
-        # print('Positive patch count: %d' % (patch_index - utils.PATCH_INDEX_POSITIVE))
+                                                                                 patch_index, wsi_mask, writer=writer)
+        wsi_image.print_cache_info()
+        wsi_mask.print_cache_info()
+    finally:
         wsi_image.close()
+        wsi_mask.close()
+    return patch_index
+
 
+def extract_positive_patches_from_tumor_wsi(wsi_paths, mask_paths, wsi_ops, patch_extractor, patch_index,
+                                            augmentation=False):
 
-def extract_negative_patches_from_tumor_wsi(wsi_paths, mask_paths, wsi_ops, patch_extractor, patch_index, augmentation=False):
     image_mask_pair = zip(wsi_paths, mask_paths)
     image_mask_pair = list(image_mask_pair)
     # image_mask_pair = image_mask_pair[67:68]
 
-    patch_save_dir = utils.PATCHES_TUMOR_NEGATIVE_PATH
-    patch_prefix = utils.PATCH_NORMAL_PREFIX
     for image_path, mask_path in image_mask_pair:
-        print('extract_negative_patches_from_tumor_wsi(): %s' % utils.get_filename_from_path(image_path))
-        wsi_image, rgb_image, _, tumor_gt_mask, level_used = wsi_ops.read_wsi_tumor(image_path, mask_path)
-        assert wsi_image is not None, 'Failed to read Whole Slide Image %s.' % image_path
+        patch_index = extract_positive_patches_from_tumor_slide(image_path, mask_path, wsi_ops, patch_extractor,
+                                                                patch_index)
+        # print('Positive patch count: %d' % (patch_index - utils.PATCH_INDEX_POSITIVE))
+
+    return patch_index
+
 
-        bounding_boxes, rgb_contour, image_open = wsi_ops.find_roi_bbox(np.array(rgb_image))
+def extract_negative_patches_from_tumor_slide(image_path, mask_path, wsi_ops, patch_extractor, patch_index,
+                                              patch_save_dir=None, patch_prefix=None, writer=None):
+    if patch_save_dir is None:
+        patch_save_dir = utils.PATCHES_TUMOR_NEGATIVE_PATH
+    if patch_prefix is None:
+        patch_prefix = utils.PATCH_NORMAL_PREFIX
+
+    print('extract_negative_patches_from_tumor_wsi(): %s' % utils.get_filename_from_path(image_path))
+    wsi_image, _, wsi_mask, tumor_gt_mask, level_used = wsi_ops.read_wsi_tumor(image_path, mask_path,
+                                                                               read_rgb=False)
+    assert wsi_image is not None, 'Failed to read Whole Slide Image %s.' % image_path
+
+    try:
+        bounding_boxes, image_open = wsi_ops.find_roi_bbox_cached(image_path, level_used)
 
         patch_index = patch_extractor.extract_negative_patches_from_tumor_wsi(wsi_image, np.array(tumor_gt_mask),
                                                                               image_open, level_used,
                                                                               bounding_boxes, patch_save_dir,
                                                                               patch_prefix,
-                                                                              patch_index)
-
+                                                                              patch_index, writer=writer)
+    finally:
         wsi_image.close()
+        wsi_mask.close()
+    return patch_index
+
+
+def extract_negative_patches_from_tumor_wsi(wsi_paths, mask_paths, wsi_ops, patch_extractor, patch_index,
+                                            augmentation=False):
+    image_mask_pair = zip(wsi_paths, mask_paths)
+    image_mask_pair = list(image_mask_pair)
+    # image_mask_pair = image_mask_pair[67:68]
+
+    for image_path, mask_path in image_mask_pair:
+        patch_index = extract_negative_patches_from_tumor_slide(image_path, mask_path, wsi_ops, patch_extractor,
+                                                                patch_index)
 
     return patch_index
 
 
 def extract_patches_from_heatmap_false_region_tumor(wsi_ops, patch_extractor, patch_index, augmentation=False):
-    tumor_heatmap_prob_paths = glob.glob(os.path.join(utils.HEAT_MAP_DIR, '*umor*prob.png'))
+    tumor_heatmap_prob_paths = glob.glob(os.path.join(utils.HEAT_MAP_DIR, '*umor*%s' % utils.HEATMAP_PROB_POSTFIX))
     tumor_heatmap_prob_paths.sort()
     wsi_paths = glob.glob(os.path.join(utils.TUMOR_WSI_PATH, '*.tif'))
     wsi_paths.sort()
@@ -90,19 +122,16 @@ def extract_patches_from_heatmap_false_region_tumor(wsi_ops, patch_extractor, pa
               (utils.get_filename_from_path(image_path), utils.get_filename_from_path(mask_path),
                utils.get_filename_from_path(heatmap_prob_path)))
 
-        wsi_image, rgb_image, wsi_mask, tumor_gt_mask, level_used = wsi_ops.read_wsi_tumor(image_path, mask_path)
+        wsi_image, _, wsi_mask, tumor_gt_mask, level_used = wsi_ops.read_wsi_tumor(
+            image_path, mask_path, cache_bytes=utils.TILE_CACHE_BYTES, read_rgb=False)
         assert wsi_image is not None, 'Failed to read Whole Slide Image %s.' % image_path
         # tumor_gt_mask = cv2.cvtColor(tumor_gt_mask, cv2.COLOR_BGR2GRAY)
         # not_0_255_cnt += (tumor_gt_mask[tumor_gt_mask != 255].shape[0]-tumor_gt_mask[tumor_gt_mask == 0].shape[0])
         # print(tumor_gt_mask[tumor_gt_mask != 255].shape[0], tumor_gt_mask[tumor_gt_mask == 0].shape[0], not_0_255_cnt)
 
-        bounding_boxes, image_open = wsi_ops.find_roi_bbox(np.array(rgb_image))
+        bounding_boxes, image_open = wsi_ops.find_roi_bbox_cached(image_path, level_used)
 
-        heatmap_prob = cv2.imread(heatmap_prob_path)
-        heatmap_prob = heatmap_prob[:, :, :1]
-        heatmap_prob = np.reshape(heatmap_prob, (heatmap_prob.shape[0], heatmap_prob.shape[1]))
-        heatmap_prob = np.array(heatmap_prob, dtype=np.float32)
-        heatmap_prob /= 255
+        heatmap_prob = read_heatmap_prob(heatmap_prob_path)
 
         patch_index = patch_extractor.extract_patches_from_heatmap_false_region_tumor(wsi_image, wsi_mask,
                                                                                       tumor_gt_mask,
@@ -115,6 +144,8 @@ def extract_patches_from_heatmap_false_region_tumor(wsi_ops, patch_extractor, pa
                                                                                       patch_prefix_neg,
                                                                                       patch_index)
         print('patch count: %d' % (patch_index - utils.PATCH_INDEX_NEGATIVE))
+        wsi_image.print_cache_info()
+        wsi_mask.print_cache_info()
 
         wsi_image.close()
         wsi_mask.close()
@@ -124,7 +155,7 @@ def extract_patches_from_heatmap_false_region_tumor(wsi_ops, patch_extractor, pa
 
 
 def extract_patches_from_heatmap_false_region_normal(wsi_ops, patch_extractor, patch_index, augmentation=False):
-    normal_heatmap_prob_paths = glob.glob(os.path.join(utils.HEAT_MAP_DIR, 'Normal*prob.png'))
+    normal_heatmap_prob_paths = glob.glob(os.path.join(utils.HEAT_MAP_DIR, 'Normal*%s' % utils.HEATMAP_PROB_POSTFIX))
     normal_heatmap_prob_paths.sort()
     wsi_paths = glob.glob(os.path.join(utils.NORMAL_WSI_PATH, '*.tif'))
     wsi_paths.sort()
@@ -141,16 +172,12 @@ def extract_patches_from_heatmap_false_region_normal(wsi_ops, patch_extractor, p
                                                                               , utils.get_filename_from_path(
             heatmap_prob_path)))
 
-        wsi_image, rgb_image, level_used = wsi_ops.read_wsi_normal(image_path)
+        wsi_image, _, level_used = wsi_ops.read_wsi_normal(image_path, read_rgb=False)
         assert wsi_image is not None, 'Failed to read Whole Slide Image %s.' % image_path
 
-        bounding_boxes, image_open = wsi_ops.find_roi_bbox(np.array(rgb_image))
+        bounding_boxes, image_open = wsi_ops.find_roi_bbox_cached(image_path, level_used)
 
-        heatmap_prob = cv2.imread(heatmap_prob_path)
-        heatmap_prob = heatmap_prob[:, :, :1]
-        heatmap_prob = np.reshape(heatmap_prob, (heatmap_prob.shape[0], heatmap_prob.shape[1]))
-        heatmap_prob = np.array(heatmap_prob, dtype=np.float32)
-        heatmap_prob /= 255
+        heatmap_prob = read_heatmap_prob(heatmap_prob_path)
 
         patch_index = patch_extractor.extract_patches_from_heatmap_false_region_normal(wsi_image,
                                                                                        image_open,
@@ -166,6 +193,30 @@ def extract_patches_from_heatmap_false_region_normal(wsi_ops, patch_extractor, p
     return patch_index
 
 
+def extract_negative_patches_from_normal_slide(image_path, wsi_ops, patch_extractor, patch_index,
+                                               patch_save_dir=None, patch_prefix=None, writer=None):
+    if patch_save_dir is None:
+        patch_save_dir = utils.PATCHES_NORMAL_NEGATIVE_PATH
+    if patch_prefix is None:
+        patch_prefix = utils.PATCH_NORMAL_PREFIX
+
+    print('extract_negative_patches_from_normal_wsi(): %s' % utils.get_filename_from_path(image_path))
+    wsi_image, _, level_used = wsi_ops.read_wsi_normal(image_path, read_rgb=False)
+    assert wsi_image is not None, 'Failed to read Whole Slide Image %s.' % image_path
+
+    try:
+        bounding_boxes, image_open = wsi_ops.find_roi_bbox_cached(image_path, level_used)
+
+        patch_index = patch_extractor.extract_negative_patches_from_normal_wsi(wsi_image, image_open,
+                                                                               level_used,
+                                                                               bounding_boxes,
+                                                                               patch_save_dir, patch_prefix,
+                                                                               patch_index, writer=writer)
+    finally:
+        wsi_image.close()
+    return patch_index
+
+
 def extract_negative_patches_from_normal_wsi(wsi_paths, wsi_ops, patch_extractor, patch_index, augmentation=False):
     """
     Extracted up to Normal_060.
@@ -181,21 +232,8 @@ def extract_negative_patches_from_normal_wsi(wsi_paths, wsi_ops, patch_extractor
 
     # wsi_paths = wsi_paths[61:]
 
-    patch_save_dir = utils.PATCHES_NORMAL_NEGATIVE_PATH
-    patch_prefix = utils.PATCH_NORMAL_PREFIX
     for image_path in wsi_paths:
-        print('extract_negative_patches_from_normal_wsi(): %s' % utils.get_filename_from_path(image_path))
-        wsi_image, rgb_image, level_used = wsi_ops.read_wsi_normal(image_path)
-        assert wsi_image is not None, 'Failed to read Whole Slide Image %s.' % image_path
-
-        bounding_boxes, rgb_contour, image_open = wsi_ops.find_roi_bbox(np.array(rgb_image))
-
-        patch_index = patch_extractor.extract_negative_patches_from_normal_wsi(wsi_image, image_open,
-                                                                               level_used,
-                                                                               bounding_boxes,
-                                                                               patch_save_dir, patch_prefix,
-                                                                               patch_index)
-        wsi_image.close()
+        patch_index = extract_negative_patches_from_normal_slide(image_path, wsi_ops, patch_extractor, patch_index)
     return patch_index
 
 
@@ -0,0 +1,225 @@
+import json
+import os
+import signal
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import camelyon16.utils as utils
+from camelyon16.ops.patch_writer import get_patch_writer
+from camelyon16.ops.wsi_ops import PatchExtractor
+from camelyon16.ops.wsi_ops import WSIOps
+from camelyon16.preprocess.extract_patches import extract_positive_patches_from_tumor_slide, \
+    extract_negative_patches_from_tumor_slide, extract_negative_patches_from_normal_slide
+
+TUMOR_POSITIVE = 'tumor_positive'
+TUMOR_NEGATIVE = 'tumor_negative'
+NORMAL_NEGATIVE = 'normal_negative'
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_TIMEOUT = 'timeout'
+
+SlideJob = namedtuple('SlideJob', ['kind', 'wsi_path', 'mask_path', 'patch_index'])
+
+
+def get_patch_save_dir(kind):
+    return {TUMOR_POSITIVE: utils.PATCHES_TUMOR_POSITIVE_PATH,
+            TUMOR_NEGATIVE: utils.PATCHES_TUMOR_NEGATIVE_PATH,
+            NORMAL_NEGATIVE: utils.PATCHES_NORMAL_NEGATIVE_PATH}[kind]
+
+
+class SlideTimeoutError(Exception):
+    pass
+
+
+class ExtractionJournal(object):
+    """
+        # ==========================================================================================
+        # Append-only JSONL journal of the slides processed by the parallel extraction driver.
+        # ==========================================================================================
+
+        Every finished job (successful or not) appends one line holding the job kind, the slide, its status,
+        the patch indices it used and the time it took. A slide counts as completed when its latest entry for
+        a given job kind has status 'done', so rerunning the driver only processes the remaining slides. Only
+        the parent process writes to the journal.
+    """
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+
+    def read_entries(self):
+        entries = []
+        if self.journal_path is None or not os.path.exists(self.journal_path):
+            return entries
+        with open(self.journal_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # line truncated by a crash while it was being written
+                    continue
+        return entries
+
+    def get_completed(self):
+        latest = {}
+        for entry in self.read_entries():
+            latest[(entry['kind'], entry['slide'])] = entry
+        return {key: entry for key, entry in latest.items() if entry['status'] == STATUS_DONE}
+
+    def record(self, entry):
+        if self.journal_path is None:
+            return
+        journal_dir = os.path.dirname(self.journal_path)
+        if journal_dir and not os.path.exists(journal_dir):
+            os.makedirs(journal_dir, exist_ok=True)
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def make_jobs(kind, wsi_paths, mask_paths=None, patch_index=0, index_stride=None):
+    """
+        One job per slide. Slides are processed concurrently, so every slide gets its own block of patch indices
+        (patch_index + i * index_stride for the i-th slide): patch names never collide and rerunning a slide
+        overwrites its own patches. Keep the slide list identical across reruns of the same extraction.
+
+        :param kind: one of TUMOR_POSITIVE, TUMOR_NEGATIVE, NORMAL_NEGATIVE
+        :param wsi_paths:
+        :param mask_paths: required for the tumor kinds, matched with wsi_paths by position
+        :param patch_index: first patch index of the first slide
+        :param index_stride: defaults to utils.PATCH_INDEX_SLIDE_STRIDE
+        :return: list of SlideJob
+    """
+    assert kind in (TUMOR_POSITIVE, TUMOR_NEGATIVE, NORMAL_NEGATIVE), 'Unknown job kind %s' % kind
+    if kind != NORMAL_NEGATIVE:
+        assert mask_paths is not None and len(mask_paths) == len(wsi_paths), 'Every tumor WSI needs a mask!'
+    else:
+        mask_paths = [None] * len(wsi_paths)
+    if index_stride is None:
+        index_stride = utils.PATCH_INDEX_SLIDE_STRIDE
+
+    return [SlideJob(kind, wsi_path, mask_path, patch_index + i * index_stride)
+            for i, (wsi_path, mask_path) in enumerate(zip(wsi_paths, mask_paths))]
+
+
+def _raise_timeout(signum, frame):
+    raise SlideTimeoutError()
+
+
+def process_slide(job, time_limit=None):
+    """
+        Runs in a worker process. The worker opens its own OpenSlide handles through WSIOps, nothing opened
+        in the parent is shared. The time limit is enforced with SIGALRM where it is available (it interrupts
+        Python code, a single long OpenSlide call finishes before the alarm is handled). Patches go through
+        the writer of utils.PATCH_OUTPUT_FORMAT, with shards named after the slide; the shards of a failed
+        slide are never completed and get rewritten by the next run.
+
+        :param job: SlideJob
+        :param time_limit: seconds, None or 0 for no limit
+        :return: journal entry of the slide
+    """
+    wsi_ops = WSIOps()
+    patch_extractor = PatchExtractor()
+    use_alarm = bool(time_limit) and hasattr(signal, 'SIGALRM')
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(int(time_limit))
+
+    entry = {'kind': job.kind,
+             'slide': utils.get_filename_from_path(job.wsi_path),
+             'wsi_path': job.wsi_path,
+             'mask_path': job.mask_path,
+             'patch_index_start': job.patch_index,
+             'pid': os.getpid()}
+    start_time = time.time()
+    try:
+        writer = get_patch_writer(get_patch_save_dir(job.kind), shard_prefix='%s-%s' % (entry['slide'], job.kind))
+        if job.kind == TUMOR_POSITIVE:
+            patch_index = extract_positive_patches_from_tumor_slide(job.wsi_path, job.mask_path, wsi_ops,
+                                                                    patch_extractor, job.patch_index, writer=writer)
+        elif job.kind == TUMOR_NEGATIVE:
+            patch_index = extract_negative_patches_from_tumor_slide(job.wsi_path, job.mask_path, wsi_ops,
+                                                                    patch_extractor, job.patch_index, writer=writer)
+        else:
+            patch_index = extract_negative_patches_from_normal_slide(job.wsi_path, wsi_ops, patch_extractor,
+                                                                     job.patch_index, writer=writer)
+        writer.close()
+        entry['status'] = STATUS_DONE
+        entry['patch_count'] = patch_index - job.patch_index
+    except SlideTimeoutError:
+        entry['status'] = STATUS_TIMEOUT
+        entry['error'] = 'time limit of %d s exceeded' % time_limit
+    except Exception as e:
+        entry['status'] = STATUS_FAILED
+        entry['error'] = '%s: %s' % (type(e).__name__, e)
+        entry['traceback'] = traceback.format_exc()
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+    entry['seconds'] = round(time.time() - start_time, 3)
+    return entry
+
+
+def run_jobs(jobs, journal_path=None, num_workers=None, time_limit=None):
+    """
+        Farms the slides out to a process pool and journals every result. Slides already recorded as done
+        in the journal are skipped.
+
+        :param jobs: list of SlideJob, see make_jobs()
+        :param journal_path: defaults to utils.EXTRACTION_JOURNAL_PATH, None disables resuming
+        :param num_workers: defaults to utils.EXTRACTION_NUM_WORKERS
+        :param time_limit: per slide time limit in seconds, defaults to utils.EXTRACTION_SLIDE_TIME_LIMIT
+        :return: list of the journal entries written by this run
+    """
+    if journal_path is None:
+        journal_path = utils.EXTRACTION_JOURNAL_PATH
+    if num_workers is None:
+        num_workers = utils.EXTRACTION_NUM_WORKERS
+    if time_limit is None:
+        time_limit = utils.EXTRACTION_SLIDE_TIME_LIMIT
+
+    journal = ExtractionJournal(journal_path)
+    completed = journal.get_completed()
+    pending = [job for job in jobs
+               if (job.kind, utils.get_filename_from_path(job.wsi_path)) not in completed]
+    print('slides: %d, already done: %d, pending: %d, workers: %d' %
+          (len(jobs), len(jobs) - len(pending), len(pending), num_workers))
+
+    entries = []
+    if not pending:
+        return entries
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(process_slide, job, time_limit): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                # the worker process itself died (e.g. killed by the OOM killer)
+                entry = {'kind': job.kind,
+                         'slide': utils.get_filename_from_path(job.wsi_path),
+                         'wsi_path': job.wsi_path,
+                         'mask_path': job.mask_path,
+                         'patch_index_start': job.patch_index,
+                         'status': STATUS_FAILED,
+                         'error': '%s: %s' % (type(e).__name__, e)}
+            journal.record(entry)
+            entries.append(entry)
+            print('%s %s: %s, %d patches, %.1f s (%d / %d)' %
+                  (entry['kind'], entry['slide'], entry['status'], entry.get('patch_count', 0),
+                   entry.get('seconds', 0.0), len(entries), len(pending)))
+
+    failed = [entry for entry in entries if entry['status'] != STATUS_DONE]
+    if failed:
+        print('%d slides failed or timed out, rerun to retry them: %s' %
+              (len(failed), ', '.join(entry['slide'] for entry in failed)))
+    return entries
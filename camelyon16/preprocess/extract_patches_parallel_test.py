@@ -0,0 +1,73 @@
+"""Tests for extract_patches_parallel."""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from camelyon16.preprocess.extract_patches_parallel import ExtractionJournal, NORMAL_NEGATIVE, STATUS_DONE, \
+    STATUS_FAILED, TUMOR_POSITIVE, make_jobs, run_jobs
+
+
+def journal_entry(kind, slide, status):
+    return {'kind': kind, 'slide': slide, 'status': status}
+
+
+class ExtractionJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.journal_path = os.path.join(self.work_dir, 'journal', 'extraction.jsonl')
+        self.journal = ExtractionJournal(self.journal_path)
+
+    def testLatestEntryWins(self):
+        self.assertEqual(self.journal.get_completed(), {})
+        self.journal.record(journal_entry(NORMAL_NEGATIVE, 'Normal_001', STATUS_DONE))
+        self.journal.record(journal_entry(NORMAL_NEGATIVE, 'Normal_002', STATUS_FAILED))
+        self.journal.record(journal_entry(NORMAL_NEGATIVE, 'Normal_003', STATUS_FAILED))
+        self.journal.record(journal_entry(NORMAL_NEGATIVE, 'Normal_003', STATUS_DONE))
+        self.journal.record(journal_entry(NORMAL_NEGATIVE, 'Normal_004', STATUS_DONE))
+        self.journal.record(journal_entry(NORMAL_NEGATIVE, 'Normal_004', STATUS_FAILED))
+        # the same slide under another job kind is a separate job
+        self.journal.record(journal_entry(TUMOR_POSITIVE, 'Normal_002', STATUS_DONE))
+        # a line truncated by a crash is ignored
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps(journal_entry(NORMAL_NEGATIVE, 'Normal_005', STATUS_DONE))[:20])
+
+        self.assertEqual(len(self.journal.read_entries()), 7)
+        self.assertEqual(sorted(self.journal.get_completed()),
+                         [(NORMAL_NEGATIVE, 'Normal_001'), (NORMAL_NEGATIVE, 'Normal_003'),
+                          (TUMOR_POSITIVE, 'Normal_002')])
+
+    def testMakeJobsIndexBlocks(self):
+        wsi_paths = ['/data/Tumor_%03d.tif' % i for i in range(1, 4)]
+        mask_paths = ['/data/Tumor_%03d_Mask.tif' % i for i in range(1, 4)]
+        jobs = make_jobs(TUMOR_POSITIVE, wsi_paths, mask_paths, patch_index=100, index_stride=1000)
+        self.assertEqual([job.patch_index for job in jobs], [100, 1100, 2100])
+        self.assertEqual([job.mask_path for job in jobs], mask_paths)
+
+        jobs = make_jobs(NORMAL_NEGATIVE, ['/data/Normal_001.tif'])
+        self.assertEqual(jobs[0].mask_path, None)
+        with self.assertRaises(AssertionError):
+            make_jobs(TUMOR_POSITIVE, wsi_paths, mask_paths[:2])
+
+    def testRunJobsSkipsCompletedSlides(self):
+        wsi_paths = [os.path.join(self.work_dir, 'Normal_%03d.tif' % i) for i in range(1, 4)]
+        jobs = make_jobs(NORMAL_NEGATIVE, wsi_paths)
+        self.journal.record(journal_entry(NORMAL_NEGATIVE, 'Normal_001', STATUS_DONE))
+        self.journal.record(journal_entry(NORMAL_NEGATIVE, 'Normal_002', STATUS_FAILED))
+
+        # the slide files do not exist, the pending slides fail and are journaled as such
+        entries = run_jobs(jobs, journal_path=self.journal_path, num_workers=1, time_limit=0)
+        self.assertEqual(sorted(entry['slide'] for entry in entries), ['Normal_002', 'Normal_003'])
+        self.assertTrue(all(entry['status'] == STATUS_FAILED for entry in entries))
+        self.assertEqual(len(self.journal.read_entries()), 4)
+
+        self.journal.record(journal_entry(NORMAL_NEGATIVE, 'Normal_002', STATUS_DONE))
+        self.journal.record(journal_entry(NORMAL_NEGATIVE, 'Normal_003', STATUS_DONE))
+        self.assertEqual(run_jobs(jobs, journal_path=self.journal_path, num_workers=1, time_limit=0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,8 +21,18 @@ print('user: %s' % user)
 TUMOR_WSI_PATH_DICT = {'thomas': '/media/thomas/Samsung_T5/CAMELYON-16/training/tumor/'}
 TUMOR_WSI_PATH = TUMOR_WSI_PATH_DICT[user]
 # NORMAL_WSI_PATH = DATA_DIR + 'TrainingData/Train_Normal'
+NORMAL_WSI_PATH_DICT = {'thomas': '/media/thomas/Samsung_T5/CAMELYON-16/training/normal/'}
+NORMAL_WSI_PATH = NORMAL_WSI_PATH_DICT[user]
 TUMOR_MASK_PATH_DICT = {'thomas': '/media/thomas/Samsung_T5/CAMELYON-16/testing/evaluation/evaluation_masks/'}
 TUMOR_MASK_PATH = TUMOR_MASK_PATH_DICT[user]
+TISSUE_MASK_CACHE_DIR_DICT = {'thomas': '/media/thomas/Samsung_T5/CAMELYON-16/cache/tissue_masks/'}
+TISSUE_MASK_CACHE_DIR = TISSUE_MASK_CACHE_DIR_DICT.get(user)
+HEATMAP_FEATURE_CACHE_DIR_DICT = {'thomas': '/media/thomas/Samsung_T5/CAMELYON-16/cache/heatmap_features/'}
+HEATMAP_FEATURE_CACHE_DIR = HEATMAP_FEATURE_CACHE_DIR_DICT.get(user)
+FROC_LABEL_CACHE_DIR_DICT = {'thomas': '/media/thomas/Samsung_T5/CAMELYON-16/cache/froc_labels/'}
+FROC_LABEL_CACHE_DIR = FROC_LABEL_CACHE_DIR_DICT.get(user)
+EXTRACTION_JOURNAL_PATH_DICT = {'thomas': '/media/thomas/Samsung_T5/CAMELYON-16/patches/1920/extraction_journal.jsonl'}
+EXTRACTION_JOURNAL_PATH = EXTRACTION_JOURNAL_PATH_DICT.get(user)
 # TEST_WSI_PATH = DATA_DIR + 'Testset'
 #
 # PATCHES_TRAIN_DIR = DATA_DIR + 'Processed/patch-based-classification/raw-data/train/'
@@ -118,6 +128,25 @@ PATCHES_TUMOR_POSITIVE_PATH = PATCHES_TUMOR_POSITIVE_PATH_DICT[user]
 PATCH_SIZE_H = 1536
 PATCH_SIZE_W = 2048
 LEVEL = 1
+# pyramid levels whose downsample is within this relative distance of a requested one are read as is
+# (WSIOps.read_region_scaled()), e.g. 3.9998 for an odd sized slide instead of 4
+LEVEL_DOWNSAMPLE_TOLERANCE = 0.01
+TILE_CACHE_BYTES = 512 * 1024 * 1024
+# share of the tile cache of a Tumor slide given to its mask (WSIOps.read_wsi_tumor()), the mask is only read
+# for tumor patches and hard example checks while the image is read for every patch
+TILE_CACHE_MASK_FRACTION = 0.25
+# OpenSlide handles kept open by every manifest reading worker (inception/manifest_inputs.py), the least recently
+# used one is closed beyond it
+MANIFEST_OPEN_SLIDES = 8
+# neighbouring patches are read through super-reads of at most COALESCED_READ_BYTES (ops/region_planner.py)
+COALESCED_READ_BYTES = 64 * 1024 * 1024
+COALESCED_READ_MIN_FILL = 0.5
+# 'directory': one image file per patch, 'shards': size bounded tar shards with an index,
+# 'manifest': coordinates only, patches are read from the WSIs at training time (ops/patch_writer.py)
+PATCH_OUTPUT_FORMAT = 'directory'
+PATCH_SHARD_BYTES = 1024 * 1024 * 1024
+# where the training pipeline looks for the WSIs of a manifest
+MANIFEST_SLIDE_DIRS = [TUMOR_WSI_PATH, NORMAL_WSI_PATH]
 PATCH_NORMAL_PREFIX = 'normal_'
 PATCH_TUMOR_PREFIX = 'tumor_'
 # PATCH_AUG_NORMAL_PREFIX = 'aug_false_normal_'
@@ -271,10 +300,74 @@ PATCH_TUMOR_PREFIX = 'tumor_'
 #
 NUM_NEGATIVE_PATCHES_FROM_EACH_BBOX = 75
 NUM_POSITIVE_PATCHES_FROM_EACH_BBOX = 100
+# fraction of a patch shared with its grid neighbour and minimum tissue coverage of negative patches
+PATCH_OVERLAP = 0.0
+MIN_TISSUE_FRACTION = 0.5
 # PATCH_INDEX_NEGATIVE = 700000
 PATCH_INDEX_POSITIVE = 700000
-#
-# TUMOR_PROB_THRESHOLD = 0.90
+# parallel extraction: every slide gets its own block of patch indices
+PATCH_INDEX_SLIDE_STRIDE = 100000
+EXTRACTION_NUM_WORKERS = 4
+EXTRACTION_SLIDE_TIME_LIMIT = 2 * 60 * 60
+# slide level heatmap features (postprocess/extract_feature_heatmap.py): slides processed concurrently
+FEATURE_NUM_WORKERS = 4
+# slide level classifier search (postprocess/wsi_classifier_search.py): cross validation folds, joblib worker
+# processes (-1: all cores), and where the selected pipeline is saved with its feature names
+CLASSIFIER_CV_FOLDS = 5
+CLASSIFIER_NUM_JOBS = -1
+WSI_CLASSIFIER_PATH = 'models/wsi_classifier.joblib'
+# bootstrap replicates of the AUC confidence intervals and paired tests (ops/auc_bootstrap.py)
+AUC_BOOTSTRAP_REPLICATES = 10000
+# lesion level FROC (ops/froc.py), as the CAMELYON16 evaluation: masks are labeled at FROC_MASK_LEVEL of slides with
+# FROC_PIXEL_RESOLUTION microns per level 0 pixel, lesions closer than FROC_LESION_DISTANCE microns are merged,
+# lesions shorter than FROC_ITC_MAX_LENGTH microns are isolated tumor cells (neither hits nor false positives),
+# and the sensitivity is averaged at FROC_FP_RATES false positives per slide
+FROC_MASK_LEVEL = 5
+FROC_PIXEL_RESOLUTION = 0.243
+FROC_LESION_DISTANCE = 75
+FROC_ITC_MAX_LENGTH = 275
+FROC_FP_RATES = (0.25, 0.5, 1, 2, 4, 8)
+# lesion candidates (postprocess/lesion_detector.py): local heatmap maxima >= LESION_THRESHOLD, no two detections
+# closer than LESION_NMS_RADIUS microns at level 0
+LESION_THRESHOLD = 0.50
+LESION_NMS_RADIUS = 100
+#
+TUMOR_PROB_THRESHOLD = 0.90
+# two model ensembles (ops/ensemble_merge.py): the second model overrides the first one where the first one is >=
+# ENSEMBLE_FIRST_MIN and the second one < ENSEMBLE_SECOND_MAX
+ENSEMBLE_FIRST_MIN = 0.90
+ENSEMBLE_SECOND_MAX = 0.50
+# heatmap false region mining: patches are PATCH_SIZE x PATCH_SIZE at level 0, like the heatmap patches
+PATCH_SIZE = 256
+FALSE_NEGATIVE_MIN_TUMOR_FRACTION = 0.85
+NUM_HEATMAP_FALSE_PATCHES_PER_WSI = 2000
+HEATMAP_FALSE_REGION_MIN_SPACING = 1
+# streaming heatmap inference (ops/heatmap_stream.py): patches per model batch, batches buffered between the
+# slide readers and the model, and reader threads
+HEATMAP_BATCH_SIZE = 100
+HEATMAP_QUEUE_BATCHES = 8
+HEATMAP_NUM_READERS = 2
+# adaptive heatmaps (HeatmapStream.run_adaptive()): every HEATMAP_LATTICE_STRIDE-th row and column is evaluated
+# first, the pixels around lattice probabilities inside [HEATMAP_REFINE_LOW, HEATMAP_REFINE_HIGH] are evaluated
+# too, the confidently normal / tumor rest is interpolated
+HEATMAP_LATTICE_STRIDE = 4
+HEATMAP_REFINE_LOW = 0.10
+HEATMAP_REFINE_HIGH = 0.90
+# dense heatmaps (ops/dense_heatmap.py): level 0 side of the tiles evaluated in one pass of the fully convolutional
+# model, and level 0 pixels between two outputs of its dense map (inception_v3 OUTPUT_STRIDE at image_size ==
+# PATCH_SIZE)
+DENSE_TILE_SIZE = 2048
+DENSE_OUTPUT_STRIDE = 32
+HEAT_MAP_DIR_DICT = {'thomas': '/media/thomas/Samsung_T5/CAMELYON-16/heatmaps/'}
+HEAT_MAP_DIR = HEAT_MAP_DIR_DICT.get(user)
+# heatmap stores (ops/heatmap_store.py): directories of chunked float16 pyramids, chunk side in heatmap pixels
+HEATMAP_STORE_EXT = '.heatmap'
+HEATMAP_STORE_CHUNK_SIZE = 256
+HEATMAP_PROB_POSTFIX = '_prob' + HEATMAP_STORE_EXT
+# resumable heatmaps (ops/heatmap_checkpoint.py): directory next to the heatmap holding the partial heatmap, and
+# batches between two flushes of it to the disk
+HEATMAP_CHECKPOINT_EXT = '.partial'
+HEATMAP_CHECKPOINT_FLUSH_BATCHES = 20
 PIXEL_WHITE = 1
 PIXEL_BLACK = 0
 
@@ -303,10 +396,10 @@ def get_filename_from_path(file_path):
     return filename
 
 
-# def format_2f(number):
-#     return float("{0:.2f}".format(number))
-#
-#
+def format_2f(number):
+    return float("{0:.2f}".format(number))
+
+
 # def step_range(start, end, step):
 #     while start <= end:
 #         yield start
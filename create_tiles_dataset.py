@@ -1,16 +1,10 @@
-from camelyon16.ops.wsi_ops import PatchExtractor, WSIOps
+from camelyon16.preprocess.extract_patches_parallel import make_jobs, run_jobs, TUMOR_POSITIVE, TUMOR_NEGATIVE, \
+    NORMAL_NEGATIVE
 from glob import glob
-from camelyon16.preprocess.extract_patches import extract_positive_patches_from_tumor_wsi, \
-    extract_negative_patches_from_tumor_wsi, extract_negative_patches_from_normal_wsi
 
 
 if __name__ == '__main__':
     use_tumor_slides = False
-    # Instantiate a wsi-ops object
-    wsi_ops = WSIOps()
-
-    # Instantiate a patch extractor
-    patch_extractor = PatchExtractor()
 
     # Set the queries
     if use_tumor_slides:
@@ -30,11 +24,13 @@ if __name__ == '__main__':
         mask_paths = sorted(mask_paths, key=lambda p: p.split('/')[-1].split('.')[0])
     else:
         image_queries = ['/media/thomas/Samsung_T5/CAMELYON-16/training/normal/*.tif']
-        image_paths = [filepath for query in image_queries for filepath in glob(query)]
+        image_paths = sorted([filepath for query in image_queries for filepath in glob(query)])
 
-    # Extract tumor patches
+    # Extract the patches, one slide per worker process. Finished slides are recorded in
+    # utils.EXTRACTION_JOURNAL_PATH, rerunning the script only processes the remaining ones.
     if use_tumor_slides:
-        extract_positive_patches_from_tumor_wsi(image_paths, mask_paths, wsi_ops, patch_extractor, 0)
-        # extract_negative_patches_from_tumor_wsi(image_paths, mask_paths, wsi_ops, patch_extractor, 0)
+        jobs = make_jobs(TUMOR_POSITIVE, image_paths, mask_paths)
+        # jobs = make_jobs(TUMOR_NEGATIVE, image_paths, mask_paths)
     else:
-        extract_negative_patches_from_normal_wsi(image_paths, wsi_ops, patch_extractor, 0)
\ No newline at end of file
+        jobs = make_jobs(NORMAL_NEGATIVE, image_paths)
+    run_jobs(jobs, num_workers=4)